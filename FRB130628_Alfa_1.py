@@ -13,15 +13,17 @@
 import os
 import subprocess
 from glob import glob #use for wildcards in subprocess?
-import sys
+import argparse
+import multiprocessing as mp
 import time
+import traceback
 import pandas as pd
 import numpy as np
 
 def execute(command,working_dir=None):
 	print command
 	p = subprocess.Popen(command, shell=True, executable='/bin/bash',cwd=working_dir)
-	p.wait() #careful. necessary in order to allow this child process to finish before script continues. look at communicate.
+	return p.wait() #careful. necessary in order to allow this child process to finish before script continues. look at communicate.
 def make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir):
 	execute("prepsubband -nsub 120 -noscales -nooffsets -noweights -nobary -downsamp %d -lodm %f\
 			-dmstep %f -numdms %d -zerodm -mask %s -o\
@@ -47,85 +49,52 @@ base = os.path.basename(base_path)#"4bit-p2030.20160702.FRB130628_1"
 #pointing = int(base[-1])
 beams = range(7)
 subbands = range(2)
-dmstep = 1.00
-numdms = 96
-downsamp = 3
-lodm = 0.
-dsubDM = 96.
-calls = 7
-calls = range(calls)
-
-for beam in beams:
-	for subband in subbands:
+
+#De-dispersion plan of each subband starting from DM 0:
+#(dmstep, numdms per prepsubband call, downsamp, number of calls, single_pulse_search -m)
+dm_plans = {
+	0: [(0.50, 50, 2, 19, 100),
+		(1.00, 50, 3, 2, 70)],
+	1: [(0.30, 50, 2, 21, 100),
+		(0.50, 50, 3, 9, 70),
+		(1.00, 50, 6, 1, 30)]
+}
+
+
+def process_beam(unit):
+	"""Search a subband of a beam for single pulses and store the candidates in '<base>_b<beam>s<subband>_proc.hdf5'.
+
+		Inputs:
+			unit: Tuple (beam, subband).
+
+		Outputs:
+			(beam, subband, error): error is None if the unit completed.
+	"""
+	beam, subband = unit
+	try:
 		print "NOW PROCESSING SUBBAND %d of BEAM %d"%(subband,beam)
-		execute("mkdir %s_b%ds%d"%(base,beam,subband))
 		outdir = '%s/%s_b%ds%d'%(base_path,base,beam,subband)		
-		execute("mkdir %s/obs_data"%outdir)
-		execute("mkdir %s/pulses"%outdir)
-		execute("mkdir %s/TEMP"%outdir)
+		execute("mkdir -p %s/obs_data %s/pulses %s/TEMP"%(outdir,outdir,outdir))
+		temp_dir = "%s/TEMP"%outdir
 		#infile = glob("%s/%s.b%ds%d*.fits"%(fits_dir,base,beam,subband))[0]
 		infile = glob("%s/*b%ds%d*.fits"%(fits_dir,beam,subband))[0]
-		execute("rfifind -time 2.0 -psrfits -noscales -nooffsets -noweights -o %s_b%ds%d %s"%(base,beam,subband,infile), working_dir="%s/TEMP"%outdir)
+		execute("rfifind -time 2.0 -psrfits -noscales -nooffsets -noweights -o %s_b%ds%d %s"%(base,beam,subband,infile), working_dir=temp_dir)
 		maskfile = glob("%s/TEMP/%s_b%ds%d*_rfifind.mask"%(outdir,base,beam,subband))[0]
-		lodm = 0.
-		if subband == 0:
-			dmstep = 0.50
-			numdms = 50
-			downsamp = 2
-			dsubDM = 25.
-			calls = 19
-			calls = range(calls)
-			for call in calls:
-				make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir="%s/TEMP"%outdir)
-				lodm +=  dsubDM
-			execute("ls %s_b%ds%d_ZERO*.dat | xargs -n 1 single_pulse_search.py --noplot -m 100 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
-			dmstep = 1.00
-			numdms = 50
-			downsamp = 3
-			dsubDM = 50.
-			calls = 2
-			calls = range(calls)
-			for call in calls:
-				make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir="%s/TEMP"%outdir)
-				lodm +=  dsubDM
-			execute("ls %s_b%ds%d_ZERO_DM47[5-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
-			execute("ls %s_b%ds%d_ZERO_DM4[8-9][0-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
-			execute("ls %s_b%ds%d_ZERO_DM5[0-9][0-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
 
-		else:
-			dmstep = 0.30
-			numdms = 50
-			downsamp = 2
-			dsubDM = 15.
-			calls = 21
-			calls = range(calls)
-			for call in calls:
-				make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir="%s/TEMP"%outdir)
-				lodm +=  dsubDM
-			execute("ls %s_b%ds%d_ZERO*.dat | xargs -n 1 single_pulse_search.py --noplot -m 100 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
-			dmstep = 0.50
-			numdms = 50
-			downsamp = 3
-			dsubDM = 25.
-			calls = 9
-			calls = range(calls)
-			for call in calls:
-				make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir="%s/TEMP"%outdir)
-				lodm +=  dsubDM
-			execute("ls %s_b%ds%d_ZERO_DM31[5-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)	
-			execute("ls %s_b%ds%d_ZERO_DM3[2-9][0-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)	
-			execute("ls %s_b%ds%d_ZERO_DM4[0-9][0-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)	
-			execute("ls %s_b%ds%d_ZERO_DM5[0-3][0-9]*.dat | xargs -n 1 single_pulse_search.py --noplot -m 70 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)	
-			dmstep = 1.00
-			numdms = 50
-			downsamp = 6
-			dsubDM = 50.
-			calls = 1
-			make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir="%s/TEMP"%outdir)
-			execute("ls %s_b%ds%d_ZERO_DM5[4-8][0-9].dat | xargs -n 1 single_pulse_search.py --noplot -m 30 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
+		lodm = 0.
+		for dmstep, numdms, downsamp, calls, max_width in dm_plans[subband]:
+			dat_files = []
+			for call in range(calls):
+				make_prepsubband(infile,downsamp,lodm,dmstep,numdms,maskfile,base,beam,subband,working_dir=temp_dir)
+				dat_files.extend(["%s_b%ds%d_ZERO_DM%.2f.dat"%(base,beam,subband,lodm+n*dmstep) for n in range(numdms)])
+				lodm += numdms * dmstep
+			#Search for single pulses the time series of this downsampling factor
+			with open("%s/sps_ds%d.txt"%(temp_dir,downsamp), 'w') as f:
+				f.write('\n'.join(dat_files) + '\n')
+			execute("xargs -n 1 single_pulse_search.py --noplot -m %d -t 5.0 -b < sps_ds%d.txt"%(max_width,downsamp), working_dir=temp_dir)
 
 		#execute("ls %s_b%ds%d_ZERO*.dat | xargs -n 1 single_pulse_search.py --noplot -m 150 -t 5.0 -b"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
-		execute("single_pulse_search.py -t 10 %s_b%ds%d_ZERO*singlepulse"%(base,beam,subband), working_dir="%s/TEMP"%outdir)
+		execute("single_pulse_search.py -t 10 %s_b%ds%d_ZERO*singlepulse"%(base,beam,subband), working_dir=temp_dir)
 		
 		#execute("mv %s_b%ds%d_ZERO* %s_b%ds%d_TEST_proc"%(base,beam,subband,base,beam,subband))
 		#execute("mv %s_b%ds%d_rfifind.* %s_b%ds%d_TEST_proc"%(base,beam,subband,base,beam,subband))
@@ -139,22 +108,52 @@ for beam in beams:
 
 
 ##### STEP 2: ONCE SINGLEPULSE FILES ARE CREATED FOR EACH DM #####
-		execute("python %s/pulses_extract.py -db_name %s_b%ds%d_proc.hdf5 -fits %s\
+		if execute("python %s/pulses_extract.py -db_name %s_b%ds%d_proc.hdf5 -fits %s\
 		 		-store_events -idL %s_b%ds%d_ZERO_DM -store_dir %s \
 					-beam_num %d -group_num %d -plot_statistics -parameters_id FRB130628_Alfa_s%d > /dev/null"\
-				%(script_dir,base,beam,subband,infile,base,beam,subband,outdir,beam,subband,subband), working_dir="%s/TEMP"%outdir)
+				%(script_dir,base,beam,subband,infile,base,beam,subband,outdir,beam,subband,subband), working_dir=temp_dir):
+			return beam, subband, "pulses_extract.py failed"
 		execute("cp %s/TEMP/%s_b%ds%d_ZERO_singlepulse.ps %s/obs_data"%(outdir,base,beam,subband,outdir))
 		execute("cp %s/TEMP/%s_b%ds%d_ZERO_DM470.00.dat %s/obs_data"%(outdir,base,beam,subband,outdir))
 		execute("cp %s/TEMP/%s_b%ds%d_ZERO_DM470.00.inf %s/obs_data"%(outdir,base,beam,subband,outdir))
 		execute("cp %s/%s_b%ds%d_proc.hdf5 %s "%(outdir,base,beam,subband,base_path))
 		#execute("rm -rf %s/TEMP"%outdir)
-		sys.exit() #REMOVE THIS. This is so that only one file is processed.
-
-execute("mkdir pulses")
-execute("python %s/pulses_extract.py -beam_comparison *_proc.hdf5"%script_dir)
-execute("python %s/pulses_extract.py -fits %s -pulses_database -store_dir %s/pulses\
-   -plot_pulses -plot_statistics -parameters_id FRB130628_Alfa_s0"%(script_dir,fits_dir,base)) #doesn't matter which subband param ID to use.
-execute("python %s/beams_plot.py > /dev/null"%script_dir)
+	except Exception:
+		return beam, subband, traceback.format_exc()
+	return beam, subband, None
+
+
+def parser():
+	# Command-line options
+	parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+									description="FRB130628 arecibo search pipeline. Must be run in the pointing's directory.")
+	parser.add_argument('-ncpus', help="Number of (beam, subband) units processed at the same time.", type=int, default=mp.cpu_count())
+	parser.add_argument('-beams', help="Beams to process.", type=int, nargs='+', default=beams)
+	parser.add_argument('-subbands', help="Subbands to process.", type=int, nargs='+', default=subbands)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parser()
+	start = time.time()
+	units = [(beam, subband) for beam in args.beams for subband in args.subbands]
+	#Each unit runs one command at a time, so the pool size is the core budget
+	pool = mp.Pool(processes=max(min(args.ncpus, len(units)), 1))
+	failed = []
+	for beam, subband, error in pool.imap_unordered(process_beam, units):
+		if error is None: print "SUBBAND %d of BEAM %d COMPLETED"%(subband,beam)
+		else:
+			print "SUBBAND %d of BEAM %d FAILED:\n%s"%(subband,beam,error)
+			failed.append((beam, subband))
+	pool.close()
+	pool.join()
+	print "%d of %d units completed in %.0f s"%(len(units)-len(failed),len(units),time.time()-start)
+
+	execute("mkdir -p pulses")
+	execute("python %s/pulses_extract.py -beam_comparison *_proc.hdf5"%script_dir)
+	execute("python %s/pulses_extract.py -fits %s -pulses_database -store_dir %s/pulses\
+	   -plot_pulses -plot_statistics -parameters_id FRB130628_Alfa_s0"%(script_dir,fits_dir,base)) #doesn't matter which subband param ID to use.
+	execute("python %s/beams_plot.py > /dev/null"%script_dir)
 #Use this for debugging so can print messages within pulses_extract.py 
 #remove > dev/null since otherwise won't print output on command line
 #process = subprocess.Popen("python %s/pulses_extract.py -db_name %s_b%ds%d_SinglePulses.hdf5 -fits %s\
@@ -2,12 +2,12 @@ import argparse
 import os
 from glob import glob
 
-import astropy.io.fits as pyfits
-
-from extract_psrfits_subints import extract_subints_from_observation
+from extract_psrfits_subints import extract_subints_from_observation, files_index
 from create_psrchives import dspsr
 
 
+#Default path of the raw data
+RAW_PATH = "/psr_archive/hessels/hessels/AO-FRB/raw_data"
 
 
 
@@ -19,7 +19,7 @@ def parser():
     parser.add_argument('time_list', help="List of times to extract, either in seconds from beginning of observation or MJD.", nargs='+', type=float)
     parser.add_argument('-output_folder', help="Path of the folder to store the bursts.", default='.')
     parser.add_argument('-time_window', help="Time window to extract around the pulse, in sec.", default=0.04194304, type=float)
-    parser.add_argument('-raw_path', help="Path to raw data", default="/psr_archive/hessels/hessels/AO-FRB/raw_data")
+    parser.add_argument('-raw_path', help="Path to raw data", default=RAW_PATH)
     return parser.parse_args()
  
 
@@ -30,11 +30,11 @@ def main():
   if max(args.time_list) < 36000:
     print "Seconds from the start of observation inserted."
     t_sec = args.time_list
-    t_mjd, mjd = sec2mjd(t_sec, args.obsID)
+    t_mjd, mjd = sec2mjd(t_sec, args.obsID, RAW_DIR=raw_path)
     print "Equivalent MJDs: {}".format([mjd + t / 24. / 3600. for t in t_mjd])
   else:
     print "MJD values inserted."
-    t_sec, mjd = mjd2sec(args.time_list, args.obsID)
+    t_sec, mjd = mjd2sec(args.time_list, args.obsID, RAW_DIR=raw_path)
     t_mjd = [(t - mjd)*24.*3600. for t in args.time_list]
     print "Equivalent seconds from the start of observation: {}".format(t_sec)
     
@@ -46,34 +46,32 @@ def main():
   for i in range(len(args.time_list)):
     if not os.path.exists(os.path.join(out_dir,'%.2f'%t_sec[i])):
       os.makedirs(os.path.join(out_dir,'%.2f'%t_sec[i]))
-    extract_archive(t_sec[i], t_mjd[i], args.obsID, out_dir=out_dir, width=args.time_window)
+    extract_archive(t_sec[i], t_mjd[i], args.obsID, out_dir=out_dir, width=args.time_window, RAW_DIR=raw_path)
   
   return
 
 
   
-def sec2mjd(t_sec, obsID):
-  obs_start, mjd = start_of_obs(obsID)
+def sec2mjd(t_sec, obsID, RAW_DIR=RAW_PATH):
+  obs_start, mjd = start_of_obs(obsID, RAW_DIR=RAW_DIR)
   return [t + obs_start for t in t_sec], mjd
 
-def mjd2sec(t_mjd, obsID):
-  obs_start, mjd = start_of_obs(obsID)
+def mjd2sec(t_mjd, obsID, RAW_DIR=RAW_PATH):
+  obs_start, mjd = start_of_obs(obsID, RAW_DIR=RAW_DIR)
   return [(t - mjd) * 24. * 3600. - obs_start for t in t_mjd], mjd
   
-def start_of_obs(obsID,RAW_DIR=raw_path):
+def start_of_obs(obsID,RAW_DIR=RAW_PATH):
   raw_files = os.path.join(RAW_DIR, obsID)
-  raw_fits_files = glob(raw_files+'*')
-  file_starts = []
-  for obs in raw_fits_files:
-    with pyfits.open(obs,memmap=True) as fits:
-      header = fits['SUBINT'].header + fits['PRIMARY'].header
-      file_starts.append(header['STT_SMJD'] + header['STT_OFFS'] + header['NSUBOFFS'] * header['NSBLK'] * header['TBIN'])
-  mjd = header['STT_IMJD']
-  return min(file_starts), mjd
+  #All the files starting with the observation name, whatever their suffix
+  index = files_index(sorted(glob(raw_files+'*')))
+  if index.size == 0: raise IOError("No PSRFITS files found for %s" % raw_files)
+  file_starts = index['stt_smjd'] + index['stt_offs'] + index['nsuboffs'] * index['nsblk'] * index['tbin']
+  mjd = index['stt_imjd'][-1]
+  return file_starts.min(), mjd
   
   
   
-def extract_archive(t_sec, t_mjd, obsID, out_dir='.', width=0.04194304,RAW_DIR=raw_path):
+def extract_archive(t_sec, t_mjd, obsID, out_dir='.', width=0.04194304,RAW_DIR=RAW_PATH):
   out_dir = os.path.abspath(out_dir)
   #Create fits file
   fits_file = os.path.join(out_dir,'%.2f'%t_sec,'%s_%.2f.fits'%(obsID,t_sec))
@@ -16,18 +16,33 @@ import psr_utils
 import rfifind
 import psrfits
 import spectra
+import fdmt
+import profiling
 import os
 import pandas as pd
 import matplotlib.lines as mlines
 import matplotlib.patches as mpatches
 from matplotlib import ticker
+from matplotlib.transforms import Bbox
 from math import ceil
-import subprocess
+import multiprocessing as mp
 from PIL import Image
 from glob import glob
+from functools import partial
+from timeit import default_timer as timer
 
+#Resolution (dpi) and suffix of the file names of the candidate plots.
+#Thumbnails (about 770x560 px, the size of the images on screen in viewer.py) are meant for the triage
+#of many candidates, full resolution plots of the promoted candidates are written beside them.
+PLOT_RESOLUTIONS = {'full': (300, ''), 'thumbnail': (100, ''), 'promoted': (300, '_full')}
+
+#Above this number of pulses the statistics plots show densities instead of single pulses
+DENSITY_THRESHOLD = 10000
+DENSITY_BINS = 2000
+
+@profiling.profile('plotter')
 def plotter(data, start, plot_duration, t, DM, IMJD, SMJD, duration, top_freq, sigma, 
-			directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_id, pulse_events, zoom=True, idx='', downsamp=True):
+			directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_id, pulse_events, zoom=True, idx='', downsamp=True, dpi=300, suffix=''):
 	
 	fig = plt.figure(figsize=(8,5))
 	ax1 = plt.subplot2grid((3,3), (1,1), rowspan=2, colspan=3)
@@ -76,12 +91,136 @@ def plotter(data, start, plot_duration, t, DM, IMJD, SMJD, duration, top_freq, s
 		title = name = ''
 	plt.suptitle('%s %.8f %s\n %s'%(FRB_name, IMJD + SMJD, title, observation), y=1.05)
 	if not os.path.isdir('%s/%s'%(directory, pulse_id)): os.makedirs('%s/%s'%(directory, pulse_id))
-	plt.savefig('%s/%s/%s_%s%s.png'%(directory, pulse_id, observation, pulse_id, name),\
-									   bbox_inches='tight', pad_inches=0.2, dpi=300)
+	plt.savefig('%s/%s/%s_%s%s%s.png'%(directory, pulse_id, observation, pulse_id, name, suffix),\
+									   bbox_inches='tight', pad_inches=0.2, dpi=dpi)
 	fig.clf()
 	plt.close('all')
 
 
+class CandidatePlotter(object):
+	"""
+	Four-panel candidate plot (same layout as plotter) built once and reused for many pulses.
+	For each plot only the data of the artists and the texts are updated, and the figure is saved
+	with a fixed bounding box instead of computing the tight one.
+	"""
+	def __init__(self, dpi=300, bbox=((0.4, -0.1), (8.1, 5.5)), suffix=''):
+		"""
+		Inputs:
+
+			dpi: resolution of the saved plots
+			suffix: added to the file names of the saved plots
+			bbox: bounding box (in inches) of the saved plots
+
+		"""
+		self.dpi = dpi
+		self.suffix = suffix
+		self.bbox = Bbox(bbox)
+		self.n_plots = 0
+		self.time_plots = 0.
+
+		self.fig = plt.figure(figsize=(8,5))
+		self.ax1 = plt.subplot2grid((3,3), (1,1), rowspan=2, colspan=3)
+		self.ax2 = plt.subplot2grid((3,3), (1,0), rowspan=3) #row = right, col = left, row = left, col=right
+		self.ax3 = plt.subplot2grid((3,3), (0,1), colspan=3)
+		self.ax4 = plt.subplot2grid((3,3), (0,0))
+
+		#Pulse information
+		fontsize = 11
+		self.ax2.axis([0,7,0,11])
+		self.info = [self.ax2.annotate('', xy=(0,y), fontsize=fontsize) for y in [9, 7.5, 6, 4.5, 3, 1.5, 0]]
+		self.ax2.axis('off')
+
+		#Dynamic spectrum
+		self.img = self.ax1.imshow(np.zeros((2,2)), aspect='auto', cmap=matplotlib.cm.cmap_d["gist_yarg"],\
+			interpolation='nearest', origin='upper')
+		self.ax1.xaxis.get_major_formatter().set_useOffset(False)
+		self.ax1.set_xlabel('Time (s)')
+		self.ax1.set_ylabel("Observing frequency (MHz)")
+
+		#Time series
+		self.zero_dm_ts, = self.ax3.plot([], [], c="0.6", zorder=2, label='zero-dm filtering')
+		self.ts, = self.ax3.plot([], [], 'k')
+		self.toa = self.ax3.axvline(0, c='r')
+		self.ax3.legend(loc=1, fontsize=8, frameon=False)
+		plt.setp(self.ax3.get_xticklabels(), visible = False)
+		plt.setp(self.ax3.get_yticklabels(), visible = False)
+
+		#DM vs S/N of the events
+		self.events = self.ax4.scatter([], [], marker='o', s=10, facecolors='none', edgecolors ='k')
+		self.ax4.set_xlabel(r'DM (pc cm$^{-3}$)', fontsize=10)
+		self.ax4.set_ylabel('S/N', fontsize=10)
+		self.ax4.tick_params(axis='x', labelsize=10)
+		self.ax4.tick_params(axis='y', labelsize=10)
+		self.ax4.locator_params(axis='x',nbins=3)
+		self.ax4.locator_params(axis='y',nbins=5)
+
+		self.title = self.fig.suptitle('', y=1.05)
+		self.fig.tight_layout(w_pad = 2, h_pad = 0.0)
+		plt.subplots_adjust(hspace=0.3)
+
+	@profiling.profile('plotter')
+	def plot(self, data, start, plot_duration, t, DM, IMJD, SMJD, duration, top_freq, sigma,
+			directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_id, pulse_events, zoom=True, downsamp=True):
+		"""
+		Updates the figure with a new pulse and saves it. Same inputs as plotter.
+		"""
+		t0 = timer()
+
+		self.info[0].set_text('Pulse ID: %i'%pulse_id)
+		self.info[1].set_text('DM: %d'%DM)
+		self.info[2].set_text('MJD: %.8f'%(IMJD+SMJD))
+		self.info[3].set_text('Time (s): %0.3f'%t)
+		self.info[4].set_text('Duration (ms): %0.2f'%(duration*1000.))
+		self.info[5].set_text('Top frequency: %0.2f'%top_freq)
+		self.info[6].set_text('Sigma: %0.2f'%sigma)
+
+		nbinlim = np.int(plot_duration/data.dt)
+		extent = (data.starttime, data.starttime + nbinlim*data.dt, data.freqs.min(), data.freqs.max())
+		self.img.set_data(data.data[..., :nbinlim])
+		self.img.set_extent(extent)
+		self.img.autoscale()
+		self.ax1.set_xlim(extent[:2])
+		self.ax1.set_ylim(extent[2:])
+
+		times = (np.arange(nbinlim)*data.dt + start)
+		self.ts.set_data(times, np.array(data.data[..., :nbinlim]).sum(axis=0))
+		nbinlim = np.int(plot_duration/zero_dm_data.dt)
+		zero_dm_times = (np.arange(nbinlim)*zero_dm_data.dt + zero_dm_start)
+		self.zero_dm_ts.set_data(zero_dm_times, np.array(zero_dm_data.data[..., :nbinlim]).sum(axis=0))
+		self.toa.set_xdata([t, t])
+		self.ax3.relim()
+		self.ax3.autoscale_view(scalex=False)
+		self.ax3.set_xlim([times.min(), times.max()])
+
+		offsets = np.column_stack((np.asarray(pulse_events.DM, dtype=float), np.asarray(pulse_events.Sigma, dtype=float)))
+		self.events.set_offsets(offsets)
+		if offsets.shape[0] > 0:
+			self.ax4.dataLim.update_from_data_xy(offsets, ignore=True)
+			self.ax4.autoscale_view()
+
+		if zoom and downsamp:
+			title = (' [close up with downsamp = %d]'%downsamp)
+			name = '_zoomed_downsamped'
+		elif zoom:
+			title = (' [close up]')
+			name = '_zoomed'
+		else:
+			title = name = ''
+		if zoom: self.ax1.ticklabel_format(style='sci', axis='x', scilimits=(0,0), useOffset=True)
+		else: self.ax1.ticklabel_format(style='plain', axis='x', useOffset=False)
+		self.title.set_text('%s %.8f %s\n %s'%(FRB_name, IMJD + SMJD, title, observation))
+
+		if not os.path.isdir('%s/%s'%(directory, pulse_id)): os.makedirs('%s/%s'%(directory, pulse_id))
+		self.fig.savefig('%s/%s/%s_%s%s%s.png'%(directory, pulse_id, observation, pulse_id, name, self.suffix),\
+										   bbox_inches=self.bbox, dpi=self.dpi)
+
+		self.n_plots += 1
+		self.time_plots += timer() - t0
+
+	def close(self):
+		plt.close(self.fig)
+
+
 def zerodm_timeseries(ax, plot_duration, data, zero_dm_start):
 		nbinlim = np.int(plot_duration/data.dt)
 		Data = np.array(data.data[..., :nbinlim])
@@ -135,10 +274,12 @@ def histogram(data, ax, title='', xlabel='', color='', bins=None, stacked=False,
 	ax.tick_params(axis='x', labelsize=8)
 	ax.tick_params(axis='y', labelsize=8)
 
-def toa_plotter(time, SN, duration, Rank, observation, ax=None):
+def toa_plotter(time, SN, duration, Rank, observation, ax=None, density=False):
 	"""
 	Plots a bar at each candidate time. Bar width corresponds to pulse duration, while its
 	height corresponds to the signal to noise ratio of the burst.
+	In density mode the times are binned and the highest signal to noise ratio of each bin
+	is plotted as a step histogram for each group of ranks.
 
 	Inputs:
 
@@ -149,24 +290,43 @@ def toa_plotter(time, SN, duration, Rank, observation, ax=None):
 	Optional Input:
 		Rank: numpy array of pulse rankings for color-mapping. Default is no coloring.
 		observation: observation name (str). Default is none.
+		density: bin the pulses instead of plotting a bar for each of them. Default is False.
 
 
 	"""
 	rank_colors = cm.colors.LinearSegmentedColormap.from_list('rank_colors', [(0,'green'), (0.5,'#D4AC0D'), (1,'red')]) 
 	norm=cm.colors.Normalize(vmin=0, vmax=2)
-	ranks=norm(Rank)
-	ax.bar(time, SN, duration, color=rank_colors(ranks), edgecolor=rank_colors(ranks))
+	if density:
+		edges = np.linspace(time.min(), time.max(), DENSITY_BINS + 1)
+		idx = np.clip(np.searchsorted(edges, time, side='right') - 1, 0, DENSITY_BINS - 1)
+		for sel, rank in [(Rank <= 0, 0), (Rank == 1, 1), (Rank >= 2, 2)]:
+			if not sel.any(): continue
+			peak = np.zeros(DENSITY_BINS)
+			np.maximum.at(peak, idx[sel], SN[sel])
+			ax.step(edges, np.append(peak, peak[-1]), where='post', color=rank_colors(norm(rank)), lw=0.5)
+		ax.set_xlim([edges[0], edges[-1]])
+	else:
+		ranks=norm(Rank)
+		ax.bar(time, SN, duration, color=rank_colors(ranks), edgecolor=rank_colors(ranks))
 	ax.set_xlabel('Time (s)',fontsize=8)
 	ax.set_ylabel('S/N', fontsize=8)
 	ax.set_title('%s\n\nTimes of Arrival v. Signal to Noise Ratio'%observation, fontsize=8)
 	ax.tick_params(axis='x', labelsize=8)
 	ax.tick_params(axis='y', labelsize=8)
 
-def scatter(xdata, ydata, ax, Rank, title='', xlabel='', ylabel=''):
+def scatter(xdata, ydata, ax, Rank, title='', xlabel='', ylabel='', density=False):
 	rank_colors = cm.colors.LinearSegmentedColormap.from_list('rank_colors', [(0,'green'), (0.5,'#D4AC0D'), (1,'red')]) 
 	norm=cm.colors.Normalize(vmin=0, vmax=2)
-	ranks=norm(Rank)
-	ax.scatter(xdata, ydata, c=rank_colors(ranks), marker='.', edgecolors=rank_colors(ranks))
+	if density:
+		#Number of pulses in hexagonal bins, with the pulses ranked as real on top if they are few
+		ax.hexbin(xdata, ydata, gridsize=DENSITY_BINS/20, bins='log', mincnt=1, cmap='gist_yarg', linewidths=0)
+		real = (Rank == 0) | (Rank == 1)
+		if 0 < real.sum() <= DENSITY_THRESHOLD:
+			ranks=norm(Rank[real])
+			ax.scatter(xdata[real], ydata[real], c=rank_colors(ranks), marker='.', edgecolors=rank_colors(ranks))
+	else:
+		ranks=norm(Rank)
+		ax.scatter(xdata, ydata, c=rank_colors(ranks), marker='.', edgecolors=rank_colors(ranks))
 	ax.set_xlabel(xlabel, fontsize=8)
 	ax.set_ylabel(ylabel, fontsize=8)
 	t = ax.set_title(title, fontsize=8)
@@ -174,7 +334,9 @@ def scatter(xdata, ydata, ax, Rank, title='', xlabel='', ylabel=''):
 	ax.tick_params(axis='x', labelsize=8)
 	ax.tick_params(axis='y', labelsize=8)
 
-def plot_statistics(dm, time, SNR, duration, Rank, folder='.', observation='', ranked=False):
+def plot_statistics(dm, time, SNR, duration, Rank, folder='.', observation='', ranked=False, density=None):
+	#Density plots are used for large numbers of pulses unless specified
+	if density is None: density = dm.size > DENSITY_THRESHOLD
 	#fig = plt.figure(figsize=(8,6))
 	ax1 = plt.subplot2grid((3,3), (1,0))
 	ax2 = plt.subplot2grid((3,3), (1,1))
@@ -185,7 +347,7 @@ def plot_statistics(dm, time, SNR, duration, Rank, folder='.', observation='', r
 	ax7 = plt.subplot2grid((3,3), (2,2))
 
 	colors = ['green', '#D4AC0D', 'red']
-	toa_plotter(time, SNR, duration, Rank, observation, ax=ax4)
+	toa_plotter(time, SNR, duration, Rank, observation, ax=ax4, density=density)
 
 	if ranked:
 		DMs = [dm[Rank==0], dm[Rank==1], dm[Rank>=2]]
@@ -210,11 +372,11 @@ def plot_statistics(dm, time, SNR, duration, Rank, folder='.', observation='', r
 		                                            xlabel='Duration (ms)')
 
 	scatter(dm, SNR, ax5, title='Dispersion Measure v. Signal to Noise Ratio',\
-									 xlabel=(r'DM (pc cm$^{-3}$)'), ylabel='SNR', Rank=Rank)
+									 xlabel=(r'DM (pc cm$^{-3}$)'), ylabel='SNR', Rank=Rank, density=density)
 	scatter(duration*1000., SNR, ax6, title='Pulse Duration v. Signal to Noise Ratio',\
-									 xlabel='Duration (ms)', ylabel='SNR', Rank=Rank)
+									 xlabel='Duration (ms)', ylabel='SNR', Rank=Rank, density=density)
 	scatter(duration*1000., dm, ax7, title='Pulse Duration v. Dispersion Measure',\
-									 xlabel='Duration (ms)', ylabel=(r'DM (pc cm$^{-3}$)'), Rank=Rank)
+									 xlabel='Duration (ms)', ylabel=(r'DM (pc cm$^{-3}$)'), Rank=Rank, density=density)
 	ax5.locator_params(axis='x',nbins=8)
 	ax7.locator_params(axis='y', nbins=8)
 	plt.tight_layout(w_pad = 0.3, h_pad = 0.1)
@@ -229,8 +391,10 @@ def plot_statistics(dm, time, SNR, duration, Rank, folder='.', observation='', r
 		rank = ''
 	plt.savefig('%s/statistical_plots_%s%s.png'%(folder,observation,rank), bbox_inches='tight')
 
-def master_statistics(dm, SNR, duration, figtitle, figname):
+def master_statistics(dm, SNR, duration, figtitle, figname, density=None):
 	Rank = np.zeros(len(dm))
+	#Density plots are used for large numbers of pulses unless specified
+	if density is None: density = dm.size > DENSITY_THRESHOLD
 	#fig = plt.figure(figsize=(8,6))
 	ax1 = plt.subplot2grid((2,3), (0,0)) #row,col,row,col
 	ax2 = plt.subplot2grid((2,3), (0,1))
@@ -249,25 +413,104 @@ def master_statistics(dm, SNR, duration, figtitle, figname):
 		                                            xlabel='Duration (ms)')
 
 	scatter(dm, SNR, ax4, title='Dispersion Measure v. Signal to Noise Ratio',\
-									 xlabel=(r'DM (pc cm$^{-3}$)'), ylabel='SNR', Rank=Rank)
+									 xlabel=(r'DM (pc cm$^{-3}$)'), ylabel='SNR', Rank=Rank, density=density)
 	scatter(duration*1000., SNR, ax5, title='Pulse Duration v. Signal to Noise Ratio',\
-									 xlabel='Duration (ms)', ylabel='SNR', Rank=Rank)
+									 xlabel='Duration (ms)', ylabel='SNR', Rank=Rank, density=density)
 	scatter(duration*1000., dm, ax6, title='Pulse Duration v. Dispersion Measure',\
-									 xlabel='Duration (ms)', ylabel=(r'DM (pc cm$^{-3}$)'), Rank=Rank)
+									 xlabel='Duration (ms)', ylabel=(r'DM (pc cm$^{-3}$)'), Rank=Rank, density=density)
 	ax4.locator_params(axis='x',nbins=8)
 	ax6.locator_params(axis='y', nbins=8)
 	plt.tight_layout(w_pad = 0.3, h_pad = 0.1)
 	plt.suptitle(figtitle, y=1.04)
 	plt.savefig(figname, bbox_inches='tight')
 
-def psrchive_plots(archive_name): #assuming: (full name of the archive with path)
+def psrchive_plots(archive_name, dpi=100): #assuming: (full name of the archive with path)
+	#Diagnostic plot of the archive drawn in-process from the psrchive Python bindings
+	try: import psrchive
+	except ImportError:
+		psrchive_plots_ps(archive_name)
+		return
+
+	folder, ar_name = os.path.split(archive_name)
+	plot_name = ar_name.split('.')[0]
+
+	#Frequency-phase of the (polarisation scrunched) archive
+	ar = psrchive.Archive_load(archive_name)
+	ar.pscrunch()
+	ar.tscrunch()
+	ar.dedisperse()
+	ar.remove_baseline()
+	freq_phase = ar.get_data()[0, 0]
+	weights = ar.get_weights()[0]
+	freq_phase = np.ma.masked_array(freq_phase)
+	freq_phase[weights == 0] = np.ma.masked
+	f_c = ar.get_centre_frequency()
+	bw = ar.get_bandwidth()
+	if bw < 0: freq_phase = freq_phase[::-1]
+	f_lo, f_hi = f_c - abs(bw) / 2., f_c + abs(bw) / 2.
+
+	#Stokes profile of the full-polarisation archive, total intensity only if it has less than 4 polarisations
+	stokes_ar = psrchive.Archive_load(os.path.join(folder, '%s.ar'%plot_name))
+	full_pol = stokes_ar.get_npol() == 4
+	if full_pol: stokes_ar.convert_state('Stokes')
+	else: stokes_ar.pscrunch()
+	stokes_ar.tscrunch()
+	stokes_ar.fscrunch()
+	stokes_ar.dedisperse()
+	stokes_ar.remove_baseline()
+	stokes = stokes_ar.get_data()[0, :, 0, :]
+	I = stokes[0]
+	phase = np.linspace(0., 1., I.size, endpoint=False)
+
+	fig = plt.figure(figsize=(16, 8))
+	ax_PA = plt.subplot2grid((4, 2), (0, 0))
+	ax_stokes = plt.subplot2grid((4, 2), (1, 0), rowspan=3, sharex=ax_PA)
+	ax_fp = plt.subplot2grid((4, 2), (0, 1), rowspan=4)
+
+	ax_stokes.plot(phase, I, 'k-', label='I')
+	if full_pol:
+		Q, U, V = stokes[1:]
+		L = np.sqrt(Q**2 + U**2)
+		PA = np.rad2deg(0.5 * np.arctan2(U, Q))
+
+		#Position angle where the linear polarisation is significant
+		PA_mask = L > 3 * np.std(I[:max(I.size / 4, 1)])
+		ax_PA.plot(phase[PA_mask], PA[PA_mask], 'k.', markersize=2)
+		ax_PA.set_ylim(-90, 90)
+		ax_PA.set_ylabel('P.A. (deg)')
+		plt.setp(ax_PA.get_xticklabels(), visible=False)
+
+		ax_stokes.plot(phase, L, 'r-', label='L')
+		ax_stokes.plot(phase, V, 'b-', label='V')
+	else:
+		ax_PA.axis('off')
+	ax_stokes.set_xlim(0, 1)
+	ax_stokes.set_xlabel('Pulse phase')
+	ax_stokes.set_ylabel('Flux (arbitrary units)')
+	ax_stokes.legend(loc='upper right')
+
+	ax_fp.imshow(freq_phase, origin='lower', aspect='auto', cmap=cm.Greys, interpolation='nearest', extent=[0, 1, f_lo, f_hi])
+	ax_fp.set_xlabel('Pulse phase')
+	ax_fp.set_ylabel('Frequency (MHz)')
+	ax_fp.set_title(plot_name)
+
+	fig.tight_layout()
+	#Written aside and moved in place once complete, so that an interrupted plot is drawn again in the next run
+	diagnostic = os.path.join(folder, '%s_diagnostic.png'%plot_name)
+	fig.savefig(diagnostic + '.tmp', dpi=dpi, format='png')
+	os.rename(diagnostic + '.tmp', diagnostic)
+	plt.close(fig)
+	return
+
+def psrchive_plots_ps(archive_name): #assuming: (full name of the archive with path)
+		#Diagnostic plot of the archive produced by psrplot and pav
 		folder, ar_name = os.path.split(archive_name)
 		plot_name = ar_name.split('.')[0]
 		#subprocess.call(['pav','-GTpd','-g',"%s_DS.ps /CPS"%plot_name, archive_name], cwd=folder)
-		subprocess.call(['psrplot','-p','freq+','-c','psd=0','-c','above:l=','-c','above:c=%s'%plot_name,'-D', "%s.ps /CPS"%plot_name, ar_name], cwd=folder)
-		subprocess.call(['convert', '%s.ps'%plot_name,'-border','10x10','-fill','white','-opaque','none','-rotate','90','%s.png'%plot_name], cwd=folder)
-		subprocess.call(['pav','-SFT','-g',"%s_stokes.ps /CPS"%plot_name, '%s.ar'%plot_name], cwd=folder)
-		subprocess.call(['convert', '%s_stokes.ps'%plot_name,'-border','10x10','-fill','white','-opaque','none','-rotate','90','%s_stokes.png'%plot_name], cwd=folder)
+		profiling.call(['psrplot','-p','freq+','-c','psd=0','-c','above:l=','-c','above:c=%s'%plot_name,'-D', "%s.ps /CPS"%plot_name, ar_name], cwd=folder)
+		profiling.call(['convert', '%s.ps'%plot_name,'-border','10x10','-fill','white','-opaque','none','-rotate','90','%s.png'%plot_name], cwd=folder)
+		profiling.call(['pav','-SFT','-g',"%s_stokes.ps /CPS"%plot_name, '%s.ar'%plot_name], cwd=folder)
+		profiling.call(['convert', '%s_stokes.ps'%plot_name,'-border','10x10','-fill','white','-opaque','none','-rotate','90','%s_stokes.png'%plot_name], cwd=folder)
 		
 		stokes = Image.open(folder + '/' + '%s_stokes.png'%plot_name)
 		DS = Image.open(folder + '/' + '%s.png'%plot_name)
@@ -278,7 +521,8 @@ def psrchive_plots(archive_name): #assuming: (full name of the archive with path
 		diagnostic = Image.new('RGB', (width, height), 'white')
 		diagnostic.paste(im=stokes, box=(0,0))
 		diagnostic.paste(im=DS, box=(width_stokes,(height_stokes-height_DS)))
-		diagnostic.save(folder + '/' +'%s_diagnostic.png'%plot_name)
+		diagnostic.save(folder + '/' +'%s_diagnostic.png.tmp'%plot_name, 'PNG')
+		os.rename(folder + '/' +'%s_diagnostic.png.tmp'%plot_name, folder + '/' +'%s_diagnostic.png'%plot_name)
 
 		os.remove('%s.ps'%os.path.join(folder,plot_name))
 		os.remove('%s.png'%os.path.join(folder,plot_name))
@@ -292,84 +536,300 @@ def psrchive_plots(archive_name): #assuming: (full name of the archive with path
 		#psrplot -p freq+ -c psd=0 archive.ar
 
 def main(fits, database, time, DM, IMJD, SMJD, sigma, duration=0.01, pulse_id=4279, top_freq=0., directory='.',\
-		  FRB_name='FRB121102', downsamp=1., beam=0, group=0, plot_standard=True, plot_zoom=True, plot_wide=False):
+		  FRB_name='FRB121102', downsamp=1., beam=0, group=0, plot_standard=True, plot_zoom=True, plot_wide=False,\
+		  plot_dm_time=False, ncpus=1, resolution='full'):
+
+	if isinstance(time, float) or isinstance(time, int): time = np.array([time])
+	num_elements = time.size
+	if isinstance(DM, float) or isinstance(DM, int): DM = np.zeros(num_elements) + DM
+	if isinstance(sigma, float) or isinstance(sigma, int): sigma = np.zeros(num_elements) + sigma
+	if isinstance(duration, float) or isinstance(duration, int): duration = np.zeros(num_elements) + duration
+	if isinstance(pulse_id, float) or isinstance(pulse_id, int): pulse_id = np.zeros(num_elements) + pulse_id
+	if isinstance(downsamp, float) or isinstance(downsamp, int): downsamp = np.zeros(num_elements) + downsamp
+	if isinstance(IMJD, float) or isinstance(IMJD, int): IMJD = np.zeros(num_elements) + IMJD
+	if isinstance(SMJD, float) or isinstance(SMJD, int): SMJD = np.zeros(num_elements) + SMJD
+	if isinstance(beam, float) or isinstance(beam, int): beam = np.zeros(num_elements, dtype=int) + beam
+	if isinstance(group, float) or isinstance(group, int): group = np.zeros(num_elements, dtype=int) + group
+
+	#Fractional day
+	SMJD = SMJD / 86400.
 
-  if isinstance(time, float) or isinstance(time, int): time = np.array([time])
-  num_elements = time.size
-  if isinstance(DM, float) or isinstance(DM, int): DM = np.zeros(num_elements) + DM
-  if isinstance(sigma, float) or isinstance(sigma, int): sigma = np.zeros(num_elements) + sigma
-  if isinstance(duration, float) or isinstance(duration, int): duration = np.zeros(num_elements) + duration
-  if isinstance(pulse_id, float) or isinstance(pulse_id, int): pulse_id = np.zeros(num_elements) + pulse_id
-  if isinstance(downsamp, float) or isinstance(downsamp, int): downsamp = np.zeros(num_elements) + downsamp
-  if isinstance(IMJD, float) or isinstance(IMJD, int): IMJD = np.zeros(num_elements) + IMJD
-  if isinstance(SMJD, float) or isinstance(SMJD, int): SMJD = np.zeros(num_elements) + SMJD
+	#Pulses are plotted in order of time to read the raw data sequentially
+	order = np.argsort(time, kind='mergesort')
+	pulses = [(time[i], DM[i], IMJD[i], SMJD[i], sigma[i], duration[i], pulse_id[i], beam[i], group[i]) for i in order]
+	options = {'top_freq': top_freq, 'directory': directory, 'FRB_name': FRB_name, 'plot_standard': plot_standard,\
+			   'plot_zoom': plot_zoom, 'plot_wide': plot_wide, 'plot_dm_time': plot_dm_time, 'dpi': PLOT_RESOLUTIONS[resolution][0],\
+			   'suffix': PLOT_RESOLUTIONS[resolution][1]}
 
-  if not FRB_name.startswith('FRB130628'):
-		rawdata = psrfits.PsrfitsFile(fits)
-		observation = os.path.basename(fits)
-		observation = observation[:observation.find('_subs_')]	
+	ncpus = max(min(int(ncpus), len(pulses)), 1)
+	if ncpus == 1:
+		failed = plot_pulses((fits, database, pulses, options))
+	else:
+		#Each process handles a contiguous block of pulses in time
+		chunks = [[pulses[i] for i in idx] for idx in np.array_split(np.arange(len(pulses)), ncpus)]
+		pool = mp.Pool(ncpus)
+		try:
+			failed = sum(pool.map(plot_pulses, [(fits, database, chunk, options) for chunk in chunks]), [])
+		finally:
+			pool.close()
+			pool.join()
 
-	events = pd.read_hdf(database, 'events')
+	if failed:
+		print "Plots of %d pulses failed: %s" % (len(failed), ', '.join([str(p) for p in failed]))
+	return failed
 
-	#Fractional day
-	SMJD = SMJD / 86400.
 
-	for i, t in enumerate(time):
-		if FRB_name.startswith('FRB130628'):
-			fits = glob("%s/*b%ds%d*.fits"%(fits,beam[i],group[i]))[0]
-			rawdata = psrfits.PsrfitsFile(fits)
-			observation = os.path.basename(fits)
-			observation = os.path.splitext(observation)[0]
-		pulse_events = events[events.Pulse == pulse_id[i]]
-
-                #zero-DM filering version
-		start_time = t - 0.05
-		plot_duration = 0.1
-                if plot_standard:
-			zero_dm_data, nbinsextra, nbins, zero_dm_start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-				nbins=None, nsub=None, subdm = DM, zerodm=True, downsamp=1,\
-				scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-				bandpass_corr=False, ref_freq=None)
-			#non-zero-DM filtering version
-			data, nbinsextra, nbins, start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-				nbins=None, nsub=None, subdm = DM, zerodm=False, downsamp=1,\
-				scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-				bandpass_corr=False, ref_freq=None)
-			plotter(data, start, plot_duration, t, DM[i], IMJD[i], SMJD[i], duration[i], top_freq,\
-				sigma[i], directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_events=pulse_events, zoom=False, idx=i, pulse_id=pulse_id[i], downsamp=False)
-
-	        #Zoomed version
- 		start_time = t - 0.01
-		plot_duration = 0.03
-		if plot_zoom:
-			zero_dm_data, nbinsextra, nbins, zero_dm_start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-				nbins=None, nsub=None, subdm = DM, zerodm=True, downsamp=1,\
-				scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-				bandpass_corr=False, ref_freq=None)
-			data, nbinsextra, nbins, start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-				nbins=None, nsub=None, subdm = DM, zerodm=False, downsamp=1,\
-				scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-				bandpass_corr=False, ref_freq=None)
-			plotter(data, start, plot_duration, t, DM[i], IMJD[i], SMJD[i], duration[i], top_freq,\
-				sigma[i], directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_events=pulse_events, zoom=True, idx=i, pulse_id=pulse_id[i], downsamp=False)               
-
-	        #Wide version
-                start_time = t - 0.5
-                plot_duration = 1.
-                if plot_wide:
-                        zero_dm_data, nbinsextra, nbins, zero_dm_start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-                                nbins=None, nsub=None, subdm = DM, zerodm=True, downsamp=1,\
-                                scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-                                bandpass_corr=False, ref_freq=None)
-                        #non-zero-DM filtering version
-                        data, nbinsextra, nbins, start = waterfall(rawdata, start_time, plot_duration, DM[i],\
-                                nbins=None, nsub=None, subdm = DM, zerodm=False, downsamp=1,\
-                                scaleindep=False, width_bins=1, mask=False, maskfn=None,\
-                                bandpass_corr=False, ref_freq=None)
-
-                        plotter(data, start, plot_duration, t, DM[i], IMJD[i], SMJD[i], duration[i], top_freq,\
-                                sigma[i], directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_events=pulse_events, zoom=False, idx=i, pulse_id=pulse_id[i], downsamp=False)
-	
+def plot_pulses(args):
+	"""
+	Plots a list of pulses sharing the same raw data and events database.
+	It is the unit of work of main, the argument is a single tuple so that it can be used with multiprocessing.Pool.map.
+
+	Inputs:
+
+		args: tuple (fits, database, pulses, options)
+			fits: name of the .fits file (folder of the .fits files for FRB130628)
+			database: HDF5 database containing the events
+			pulses: list of tuples (time, DM, IMJD, SMJD, sigma, duration, pulse_id, beam, group)
+			options: dictionary of keyword arguments of plot_pulse
+
+	Outputs:
+
+		failed: list of the identifiers of the pulses that could not be plotted
+
+	"""
+	fits, database, pulses, options = args
+	events = PulseEvents(database)
+
+	#Raw data files are opened once and kept open for all the pulses
+	rawdata_files = {}
+	renderer = None
+	failed = []
+	try:
+		renderer = CandidatePlotter(dpi=options['dpi'], suffix=options['suffix'])
+		for t, DM, IMJD, SMJD, sigma, duration, pulse_id, beam, group in pulses:
+			try:
+				if options['FRB_name'].startswith('FRB130628'):
+					fits_name = glob("%s/*b%ds%d*.fits"%(fits,beam,group))[0]
+					observation = os.path.splitext(os.path.basename(fits_name))[0]
+				else:
+					fits_name = fits
+					observation = os.path.basename(fits)
+					observation = observation[:observation.find('_subs_')]
+				if fits_name not in rawdata_files: rawdata_files[fits_name] = psrfits.PsrfitsFile(fits_name)
+				rawdata = rawdata_files[fits_name]
+
+				pulse_events = events[pulse_id]
+				plot_pulse(rawdata, observation, pulse_events, t, DM, IMJD, SMJD, sigma, duration, pulse_id, renderer=renderer, **options)
+			except Exception, e:
+				#A bad pulse must not stop the others
+				print "Pulse %s: plot failed (%s: %s)" % (pulse_id, type(e).__name__, e)
+				failed.append(pulse_id)
+				#Figures left open by the plot (e.g. dm_time_plotter or plotter)
+				for num in plt.get_fignums():
+					if num != renderer.fig.number: plt.close(num)
+
+		if renderer.n_plots > 0:
+			print "%d plots in %.1f s (%.2f plots/s)" % (renderer.n_plots, renderer.time_plots, renderer.n_plots / renderer.time_plots)
+
+	finally:
+		if renderer is not None: renderer.close()
+		for rawdata in rawdata_files.values():
+			rawdata.fits.close()
+		events.close()
+		plt.close('all')
+
+	return failed
+
+
+class PulseEvents(object):
+	"""
+	Gives the events of single pulses without scanning the whole events table for each pulse.
+	If the events are stored in table format with Pulse as data column, the events of a pulse
+	are selected with an (indexed) query on the table. Otherwise the table is read once and
+	sorted by pulse, and the row range of each pulse is kept in a dictionary.
+	"""
+	def __init__(self, database):
+		self.store = pd.HDFStore(database, 'r')
+		storer = self.store.get_storer('events')
+		self.query = storer.is_table and ('Pulse' in storer.data_columns)
+		if not self.query:
+			self.events = self.store['events'].sort_values('Pulse', kind='mergesort')
+			self.store.close()
+			pulse_ids, starts = np.unique(self.events.Pulse.values, return_index=True)
+			ends = np.append(starts[1:], self.events.shape[0])
+			self.offsets = dict(zip(pulse_ids, zip(starts, ends)))
+
+	def __getitem__(self, pulse_id):
+		pulse_id = int(pulse_id)
+		if self.query:
+			return self.store.select('events', where='Pulse == %d' % pulse_id)
+		start, end = self.offsets.get(pulse_id, (0, 0))
+		return self.events.iloc[start : end]
+
+	def close(self):
+		if self.query: self.store.close()
+
+
+def plot_pulse(rawdata, observation, pulse_events, t, DM, IMJD, SMJD, sigma, duration, pulse_id, top_freq=0., directory='.',\
+		  FRB_name='FRB121102', plot_standard=True, plot_zoom=True, plot_wide=False, plot_dm_time=False, dpi=300, suffix='', renderer=None):
+	"""
+	Produces all the plots of a single pulse.
+	The plots are drawn on the CandidatePlotter renderer if given, otherwise with plotter.
+	"""
+	if renderer is None: plot = partial(plotter, dpi=dpi, suffix=suffix)
+	else: plot = renderer.plot
+
+	#Windows (start, duration, zoom) of the standard, zoomed and wide versions
+	windows = []
+	if plot_standard: windows.append((t - 0.05, 0.1, False))
+	if plot_zoom: windows.append((t - 0.01, 0.03, True))
+	if plot_wide: windows.append((t - 0.5, 1., False))
+
+	#Read the data once and derive all the versions from the same buffer
+	if windows:
+		dedisp_data, zero_dm_dedisp_data = read_pulse(rawdata, DM, min([w[0] for w in windows]),\
+			max([w[0] + w[1] for w in windows]))
+
+	for start_time, plot_duration, zoom in windows:
+		#zero-DM filering version
+		zero_dm_data, zero_dm_start = pulse_window(zero_dm_dedisp_data, rawdata, start_time, plot_duration, DM)
+		#non-zero-DM filtering version
+		data, start = pulse_window(dedisp_data, rawdata, start_time, plot_duration, DM)
+		plot(data, start, plot_duration, t, DM, IMJD, SMJD, duration, top_freq,\
+			sigma, directory, FRB_name, observation, zero_dm_data, zero_dm_start, pulse_events=pulse_events, zoom=zoom, pulse_id=pulse_id, downsamp=False)
+
+	#DM-time plane around the candidate
+	if plot_dm_time:
+		dm_time_plotter(rawdata, t, DM, IMJD, SMJD, sigma, directory, FRB_name, observation, pulse_id, dpi=dpi, suffix=suffix)
+
+
+def dispersion_bins(rawdata, DM):
+	"""
+	Number of time samples spanned by the dispersion sweep at the given DM across the band.
+	"""
+	dmfac = 4.15e3 * np.abs(1./rawdata.frequencies[0]**2 - 1./rawdata.frequencies[-1]**2)
+	return dmfac * DM / rawdata.tsamp
+
+@profiling.profile('read_pulse')
+def read_pulse(rawdata, DM, start_time, end_time):
+	"""
+	Reads the data between start_time and end_time (plus the dispersion sweep) once and dedisperses them
+	with and without zero-DM filtering, as done by waterfaller.waterfall.
+
+	Inputs:
+
+		rawdata: psrfits.PsrfitsFile instance
+		DM: dedispersion measure
+		start_time, end_time: limits (s) of the union of the windows to plot
+
+	Outputs:
+
+		data: dedispersed Spectra object (not scaled)
+		zero_dm_data: zero-DM filtered, dedispersed Spectra object (not scaled)
+
+	"""
+	start_bin = max(np.round(start_time / rawdata.tsamp).astype('int'), 0)
+	nbinsextra = np.round(end_time / rawdata.tsamp).astype('int') - start_bin + np.round(dispersion_bins(rawdata, DM)).astype('int')
+	if (start_bin + nbinsextra) > rawdata.specinfo.N-1:
+		nbinsextra = rawdata.specinfo.N-1-start_bin
+	data = rawdata.get_spectra(start_bin, nbinsextra)
+	data.data = np.ma.masked_array(data.data)
+
+	zero_dm_data = copy.deepcopy(data)
+	zero_dm_data.data -= zero_dm_data.data.mean(axis=0)
+
+	if DM:
+		data.dedisperse(DM, padval='mean')
+		zero_dm_data.dedisperse(DM, padval='mean')
+	return data, zero_dm_data
+
+def pulse_window(dedisp_data, rawdata, start_time, plot_duration, DM):
+	"""
+	Slices a window out of the Spectra object returned by read_pulse and scales it.
+	The window contains the same samples that waterfaller.waterfall would read.
+
+	Inputs:
+
+		dedisp_data: Spectra object returned by read_pulse
+		rawdata: psrfits.PsrfitsFile instance
+		start_time: start of the window (s)
+		plot_duration: duration of the window (s)
+		DM: dedispersion measure
+
+	Outputs:
+
+		data: scaled Spectra object
+		start: start time of the window
+
+	"""
+	start_bin = np.round(start_time / rawdata.tsamp).astype('int')
+	nbinsextra = np.round(plot_duration / rawdata.tsamp).astype('int')
+	if DM:
+		nbinsextra = np.round(plot_duration / rawdata.tsamp + dispersion_bins(rawdata, DM)).astype('int')
+	if (start_bin + nbinsextra) > rawdata.specinfo.N-1:
+		nbinsextra = rawdata.specinfo.N-1-start_bin
+
+	offset = start_bin - np.round(dedisp_data.starttime / dedisp_data.dt).astype('int')
+	offset = max(offset, 0)
+	data = spectra.Spectra(dedisp_data.freqs, dedisp_data.dt, dedisp_data.data[:, offset : offset + nbinsextra],\
+		starttime=dedisp_data.starttime + offset * dedisp_data.dt)
+	data.dm = dedisp_data.dm
+	return data.scaled(False), start_time
+
+def dm_time_plotter(rawdata, t, DM, IMJD, SMJD, sigma, directory, FRB_name, observation, pulse_id,\
+					dm_range=20., plot_duration=0.1, max_trials=256, dpi=300, suffix=''):
+	"""
+	Plots the DM-time plane ("bowtie") around a candidate, computed with the FDMT.
+
+	Inputs:
+
+		rawdata: psrfits.PsrfitsFile instance
+		t: candidate time (s) at the top of the band
+		DM: candidate DM
+
+	Optional Input:
+		dm_range: width of the DM interval centred on the candidate DM
+		plot_duration: duration of the plot (s)
+		max_trials: the data are downsampled in time to keep the number of trial DMs below this value
+		dpi: resolution of the plot
+		suffix: added to the file name of the plot
+
+	"""
+	dm_lo = max(DM - dm_range / 2., 0.)
+	dm_hi = dm_lo + dm_range
+	start_time = t - plot_duration / 2.
+
+	#Read the window plus the dispersion sweep of the highest DM
+	sweep = dm_hi * fdmt.delay_per_dm(rawdata.freqs.min(), rawdata.freqs.max())
+	start_bin = max(np.round(start_time / rawdata.tsamp).astype('int'), 0)
+	nbinsextra = np.round((plot_duration + sweep) / rawdata.tsamp).astype('int')
+	if (start_bin + nbinsextra) > rawdata.specinfo.N-1:
+		nbinsextra = rawdata.specinfo.N-1-start_bin
+	data = rawdata.get_spectra(start_bin, nbinsextra)
+
+	n_trials = (dm_hi - dm_lo) * fdmt.delay_per_dm(rawdata.freqs.min(), rawdata.freqs.max()) / rawdata.tsamp
+	downsamp = max(int(ceil(n_trials / max_trials)), 1)
+	data.downsample(downsamp)
+
+	dms, plane = fdmt.dm_time_plane(data, dm_lo, dm_hi)
+	nbins = min(np.int(plot_duration / data.dt), plane.shape[1])
+	plane = plane[:, :nbins]
+	#The number of samples summed in each trial DM changes, scale each row independently
+	plane = (plane - np.median(plane, axis=1)[:, np.newaxis]) / (plane.std(axis=1)[:, np.newaxis] + 1e-10)
+
+	fig = plt.figure(figsize=(8,5))
+	ax = fig.add_subplot(111)
+	ax.imshow(plane, aspect='auto', origin='lower', cmap='gist_yarg', interpolation='nearest',\
+		extent=(data.starttime, data.starttime + nbins * data.dt, dms[0], dms[-1]))
+	ax.axvline(t, c='r', ls='--', lw=0.5)
+	ax.axhline(DM, c='r', ls='--', lw=0.5)
+	ax.set_xlabel('Time (s)')
+	ax.set_ylabel(r'DM (pc cm$^{-3}$)')
+	ax.set_title('%s %.8f [DM-time, downsamp = %d]\n%s - Pulse ID: %i - Sigma: %0.2f'%(FRB_name, IMJD + SMJD, downsamp, observation, pulse_id, sigma), fontsize=10)
+	if not os.path.isdir('%s/%s'%(directory, pulse_id)): os.makedirs('%s/%s'%(directory, pulse_id))
+	plt.savefig('%s/%s/%s_%s_dm_time%s.png'%(directory, pulse_id, observation, pulse_id, suffix),\
+									   bbox_inches='tight', pad_inches=0.2, dpi=dpi)
+	plt.close(fig)
 
 def dm_snr(pulse_events, ax=None):
 	plt.scatter(pulse_events.DM, pulse_events.Sigma, marker='o', s=10, facecolors='none', edgecolors ='k')
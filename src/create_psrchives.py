@@ -1,9 +1,14 @@
-import subprocess
 from glob import glob
 import os
 import argparse
 import shutil
+import tempfile
 import StringIO
+import multiprocessing as mp
+import multiprocessing.queues
+import signal
+import sys
+import time
 
 import psrchive
 import astropy.io.fits as pyfits
@@ -12,6 +17,7 @@ import pandas as pd
 from presto import psr_utils
 
 from auto_waterfaller import psrchive_plots
+import profiling
 
 
 ephemeris = '''PSRJ J0531+33
@@ -32,6 +38,12 @@ def parser():
     parser.add_argument('-obsPATH', help="Path of the observation output folder.", default='.')
     #parser.add_argument('-par_file', help="Name of the parameter file for the puls.", default='')
     parser.add_argument('-profile_bins', help="Number of bins within the profile.", default=4096, type=int)
+    parser.add_argument('-full_fold', help="Fold the whole fits file instead of a window around the pulse.", action='store_true')
+    parser.add_argument('-ncpus', help="Number of pulses processed in parallel.", default=1, type=int)
+    parser.add_argument('-tmp_dir', help="Folder of the temporary files.", default='/dev/shm')
+    parser.add_argument('-shm_budget', help="Maximum size (MB) of the temporary files of the pulses processed in parallel (default: free space).", default=None, type=float)
+    parser.add_argument('-timeout', help="Maximum time (s) to process a pulse before considering it failed (default: no limit).", default=None, type=float)
+    parser.add_argument('-profile', help="Write a profile of the run (time and memory of the external programs) in this folder.", nargs='?', const='.', default=None)
     return parser.parse_args()
 
 def read_fits(fits_file):
@@ -43,11 +55,223 @@ def read_fits(fits_file):
     time_resolution = header['TBIN']
     freq_c = header['OBSFREQ']
     bandwidth = abs(header['OBSBW'])
+    #Duration of the fits file
+    duration = header['NAXIS2'] * header['NSBLK'] * header['TBIN']
     
-  return {'time_resolution': time_resolution, 'freq_c': freq_c, 'bandwidth': bandwidth}
+  return {'time_resolution': time_resolution, 'freq_c': freq_c, 'bandwidth': bandwidth, 'start': mjds_chop, 'duration': duration}
+
+
+def archive_start(archive):
+  #Starting time (s) of an archive
+  start_time = psrchive.Archive_load(archive).start_time()
+  return start_time.get_secs() + start_time.get_fracsec()
 
   
-def dspsr(fits_file, puls=None, par_file=False, profile_bins=4096, parallel=False, DM=560.5, Downfact=False, SMJD=False, width=0.04194304):
+def downsampling_factor(Downfact, profile_bins):
+  #Closest factor of the number of profile bins to the downsampling factor of the pulse
+  downfact = int(Downfact)
+  while profile_bins % downfact != 0:
+    downfact -= 1
+  return downfact
+
+
+def diagnostic_plot(archive_name):
+  #Name of the plot written by psrchive_plots for the archives of a pulse
+  folder, name = os.path.split(archive_name)
+  return os.path.join(folder, '%s_diagnostic.png' % name.split('.')[0])
+
+
+def products(fits_file, Downfact, profile_bins=4096):
+  #List of the files created by dspsr for a pulse
+  archive_name = os.path.splitext(fits_file)[0]
+  files = [archive_name + '.ar', archive_name + '.ar.paz']
+  if Downfact:
+    downfact = downsampling_factor(Downfact, profile_bins)
+    files.extend([archive_name + '.ar.paz.pb'+str(downfact), archive_name + '.ar.paz.Fpb'+str(downfact), diagnostic_plot(archive_name)])
+  return files
+
+
+def psrchive_step(command, product, cwd):
+  #Run a psrchive program writing product + '.tmp', moved in place only once complete,
+  #so that a failed or interrupted step never leaves a product considered done
+  temp_name = product + '.tmp'
+  returncode = profiling.call(command, cwd=cwd)
+  if returncode != 0 or not os.path.isfile(temp_name):
+    if os.path.isfile(temp_name): os.remove(temp_name)
+    raise RuntimeError("{} exited with code {} creating {}".format(command[0], returncode, product))
+  os.rename(temp_name, product)
+
+
+#Seconds between two checks of the running workers
+POLL_INTERVAL = 0.2
+
+#Queue where the workers of the pool write (pulse id, pid) when they start a pulse
+_started = None
+
+def init_worker(started):
+  global _started
+  _started = started
+  #The worker leads a process group with the external programs it runs, so that they are stopped together
+  os.setpgrp()
+  signal.signal(signal.SIGTERM, stop_worker)
+
+
+def stop_worker(signum, frame):
+  #Stop the external programs of the pulse (timeout or terminated pool) and unwind, so that the temporary folder is removed
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  os.killpg(os.getpgrp(), signal.SIGTERM)
+  raise SystemExit(128 + signum)
+
+
+def create_psrchive(args):
+  #Create the psrchives of a pulse, used by the workers of the pool
+  idx_p, fits_file, puls, profile_bins, windowed, tmp_dir = args
+  if _started is not None: _started.put((idx_p, os.getpid()))
+  try:
+    dspsr(fits_file, puls=puls, profile_bins=profile_bins, windowed=windowed, tmp_dir=tmp_dir)
+  except Exception, e:
+    return idx_p, str(e)
+  return idx_p, None
+
+
+def process_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError:
+    return False
+  return True
+
+
+def process_pulses(jobs, ncpus=1, shm_budget=None, tmp_dir='/dev/shm', profile_bins=4096, windowed=True, timeout=None):
+  #Create the psrchives of many pulses in parallel.
+  #jobs is a list of (pulse id, fits file, pulse) and shm_budget the maximum number of bytes (by default the free space) that
+  #the running workers can write in tmp_dir, estimated as the size of their fits files. The pulses whose worker dies
+  #(e.g. killed by the OOM killer) or that run for longer than timeout seconds are failed. Return the ids of the failed pulses.
+  if shm_budget is None:
+    stat = os.statvfs(tmp_dir)
+    shm_budget = stat.f_bavail * stat.f_frsize
+
+  #Written synchronously, so that the pid is known even if the worker is killed just after
+  started = mp.queues.SimpleQueue()
+  pool = mp.Pool(ncpus, initializer=init_worker, initargs=(started,))
+  pending = list(jobs)
+  running = {}
+  workers = {}
+  failed = []
+  lost = False
+  try:
+    while pending or running:
+      #Start new workers as long as the pool and the temporary space allow it
+      while pending and len(running) < ncpus:
+        idx_p, fits_file, puls = pending[0]
+        size = os.path.getsize(fits_file)
+        if running and sum([r[0] for r in running.values()]) + size > shm_budget: break
+        pending.pop(0)
+        running[idx_p] = (size, time.time(), pool.apply_async(create_psrchive, ((idx_p, fits_file, puls, profile_bins, windowed, tmp_dir),)))
+
+      #Workers that started a pulse
+      while not started.empty():
+        idx_p, pid = started.get()
+        if idx_p in running: workers[idx_p] = pid
+
+      #Check the running pulses
+      finished = []
+      for idx_p, (size, start, result) in running.items():
+        error = None
+        if result.ready():
+          try: error = result.get()[1]
+          except Exception, e: error = '%s: %s' % (type(e).__name__, e)
+        elif idx_p in workers and not process_alive(workers[idx_p]):
+          error = 'worker %d died' % workers[idx_p]
+        elif timeout is not None and time.time() - start > timeout:
+          error = 'timeout after %.0f s' % timeout
+          #The worker stops its external programs and removes its temporary folder (see stop_worker)
+          if idx_p in workers: os.kill(workers[idx_p], signal.SIGTERM)
+        else: continue
+        #The results of the lost pulses never arrive, so the pool cannot be joined normally
+        if not result.ready(): lost = True
+        finished.append(idx_p)
+        if error is None: print "  Pulse n. {} processed".format(idx_p)
+        else:
+          print "  Pulse n. {} failed: {}".format(idx_p, error)
+          failed.append(idx_p)
+
+      for idx_p in finished:
+        del running[idx_p]
+        workers.pop(idx_p, None)
+      if not finished: time.sleep(POLL_INTERVAL)
+  except:
+    lost = True
+    raise
+  finally:
+    #Workers still running after an interruption or a lost pulse are stopped
+    if lost: pool.terminate()
+    else: pool.close()
+    pool.join()
+
+  return failed
+
+
+def fold_pulse(fits_file, par_file, temp_dir, SMJD, DM, profile_bins, width, windowed):
+  #Fold the fits file in temp_dir and return the phase of the pulse and the single-pulse archive containing it
+  readfile = read_fits(fits_file)
+  period = width #readfile['time_resolution'] * profile_bins
+
+  #Delay between maximum and central frequencies
+  DM_delay = psr_utils.delay_from_DM(DM, readfile['freq_c']) - psr_utils.delay_from_DM(DM, readfile['freq_c'] + readfile['bandwidth'] / 2. )
+  n_puls = int(DM_delay / period)
+
+  #Window of data to fold: from two periods before the pulse to the archive containing it, plus the dispersion sweep across the band
+  if windowed:
+    file_start = readfile['start']
+    if file_start > 86400: file_start = file_start - 86400  #Deal with observations taken over midnight
+    sweep = psr_utils.delay_from_DM(DM, readfile['freq_c'] - readfile['bandwidth'] / 2.) - psr_utils.delay_from_DM(DM, readfile['freq_c'] + readfile['bandwidth'] / 2.)
+    window_start = max(SMJD - file_start - 2 * period, 0.)
+    window_length = min((n_puls + 4) * period + sweep, readfile['duration'] - window_start)
+
+  temp_folder = os.path.join(temp_dir, 'archives')
+      
+  def archive_creation(phase_start=0):
+    if os.path.exists(temp_folder): shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+    
+    #Fold the fits file to create single-pulse archives
+    if phase_start: start = period / 2.
+    else: start = 0
+    
+    if windowed: window = ['-S', str(window_start + start), '-T', str(window_length)]
+    else: window = ['-S', str(start)]
+    with open(os.devnull, 'w') as FNULL:
+      returncode = profiling.call(['dspsr'] + window + ['-K', '-b', str(profile_bins), '-s', '-E', par_file, fits_file], cwd=temp_folder, stdout=FNULL)
+    if returncode != 0: raise RuntimeError("dspsr exited with code {}".format(returncode))
+      
+    #Lists of archive names and starting times (s)
+    archive_list = np.array(glob(os.path.join(temp_folder,'pulse_*.ar')))
+    archive_time_list = np.array([archive_start(ar) for ar in archive_list])
+    idx_sorted = np.argsort(archive_time_list)
+    archive_list = archive_list[idx_sorted]
+    archive_time_list = archive_time_list[idx_sorted]
+  
+    #Find archive where dispersed pulse would start
+    start_dispersed_puls = SMJD - archive_time_list
+    idx_puls = np.where( (start_dispersed_puls > 0) & (start_dispersed_puls < period))[0][0]
+  
+    #Check that puls is centered
+    phase = start_dispersed_puls[idx_puls] / period - start / period
+    
+    idx_puls += n_puls
+    if phase_start > 0.75: idx_puls += 1
+    
+    return phase, archive_list[idx_puls]
+  
+  phase, archive = archive_creation()
+  
+  if abs(phase - 0.5) > 0.25: phase, archive = archive_creation(phase_start=phase)
+
+  return phase, archive
+
+
+def dspsr(fits_file, puls=None, par_file=False, profile_bins=4096, parallel=False, DM=560.5, Downfact=False, SMJD=False, width=0.04194304, windowed=True, tmp_dir='/dev/shm'):
   #Read puls
   if isinstance(puls, pd.Series):
     DM = puls.DM
@@ -60,87 +284,49 @@ def dspsr(fits_file, puls=None, par_file=False, profile_bins=4096, parallel=Fals
   
   if SMJD > 86400: SMJD = SMJD - 86400  #Deal with observations taken over midnight
   
-  #Read par_file
-  if not par_file:
-    obs_id = os.path.splitext(os.path.basename(fits_file))[0]
-    par_file = '/dev/shm/{}_ephemeris'.format(obs_id)
-    with open(par_file, 'w') as f:
-      f.write(ephemeris.format(width, DM))
-    
   archive_name = os.path.splitext(fits_file)[0]
   puls_folder = os.path.split(archive_name)[0]
   if not os.path.isfile(archive_name + '.ar'):
-    readfile = read_fits(fits_file)
-    period = width #readfile['time_resolution'] * profile_bins
-
-    #Delay between maximum and central frequencies
-    DM_delay = psr_utils.delay_from_DM(DM, readfile['freq_c']) - psr_utils.delay_from_DM(DM, readfile['freq_c'] + readfile['bandwidth'] / 2. )
-    n_puls = int(DM_delay / period)
-
-    temp_folder = os.path.join('/dev/shm', os.path.basename(archive_name))
-        
-    def archive_creation(phase_start=0):
-      if os.path.exists(temp_folder): shutil.rmtree(temp_folder)
-      os.makedirs(temp_folder)
-      
-      #Fold the fits file to create single-pulse archives
-      if phase_start: start = period / 2.
-      else: start = 0
-      
-      with open(os.devnull, 'w') as FNULL:
-        _ = subprocess.call(['dspsr', '-S', str(start), '-K', '-b', str(profile_bins), '-s', '-E', par_file, fits_file], cwd=temp_folder, stdout=FNULL)
-        
-      #Lists of archive names and starting times (s)
-      archive_list = np.array(glob(os.path.join(temp_folder,'pulse_*.ar')))
-      archive_time_list = np.array([psrchive.Archive_load(ar).start_time().get_secs() + psrchive.Archive_load(ar).start_time().get_fracsec() for ar in archive_list])
-      idx_sorted = np.argsort(archive_list)
-      archive_list = archive_list[idx_sorted]
-      archive_time_list = archive_time_list[idx_sorted]
-    
-      #Find archive where dispersed pulse would start
-      start_dispersed_puls = SMJD - archive_time_list
-      idx_puls = np.where( (start_dispersed_puls > 0) & (start_dispersed_puls < period))[0][0]
-    
-      #Check that puls is centered
-      phase = start_dispersed_puls[idx_puls] / period - start / period
-      
-      idx_puls += n_puls
-      if phase_start > 0.75: idx_puls += 1
-      
-      return phase, archive_list[idx_puls]
-    
-    phase, archive = archive_creation()
-    
-    if abs(phase - 0.5) > 0.25: phase, archive = archive_creation(phase_start=phase)
-   
-    shutil.copyfile(os.path.join(temp_folder,archive), archive_name + '.ar')
-    shutil.rmtree(temp_folder)
-    if os.path.isfile('/dev/shm/{}_ephemeris'.format(obs_id)): os.remove('/dev/shm/{}_ephemeris'.format(obs_id))
+    #Private temporary folder, so that concurrent runs on the same observation do not collide
+    temp_dir = tempfile.mkdtemp(prefix=os.path.basename(archive_name) + '_', dir=tmp_dir)
+    try:
+      #Read par_file
+      if not par_file:
+        par_file = os.path.join(temp_dir, 'ephemeris')
+        with open(par_file, 'w') as f:
+          f.write(ephemeris.format(width, DM))
+
+      phase, archive = fold_pulse(fits_file, par_file, temp_dir, SMJD, DM, profile_bins, width, windowed)
+      shutil.copyfile(archive, archive_name + '.ar.tmp')
+      os.rename(archive_name + '.ar.tmp', archive_name + '.ar')
+    finally:
+      shutil.rmtree(temp_dir)
     
-  #Clean the archive
+  #Clean the archive (the programs replace the last extension of the input with the one given by -e)
   if not os.path.isfile(archive_name + '.ar.paz'):
-    subprocess.call(['paz', '-e', 'ar.paz', '-r', archive_name + '.ar'], cwd=puls_folder)
+    psrchive_step(['paz', '-e', 'ar.paz.tmp', '-r', archive_name + '.ar'], archive_name + '.ar.paz', puls_folder)
   
   #Create downsampled archive at the closest factor scrunched in polarisation
   if Downfact:
-    downfact = int(Downfact)
-    while profile_bins % downfact != 0:
-      downfact -= 1
+    downfact = downsampling_factor(Downfact, profile_bins)
     
     if not os.path.isfile(archive_name + '.ar.paz.pb'+str(downfact)):  
-      subprocess.call(['pam', '-e', 'paz.pb'+str(downfact), '-p', '-b', str(downfact), archive_name + '.ar.paz'], cwd=puls_folder)  
-      #Plot the archive
-      psrchive_plots(os.path.join(puls_folder, archive_name + '.ar.paz.pb'+str(downfact)))
+      psrchive_step(['pam', '-e', 'paz.pb'+str(downfact)+'.tmp', '-p', '-b', str(downfact), archive_name + '.ar.paz'], archive_name + '.ar.paz.pb'+str(downfact), puls_folder)
+    
+    #Plot the archive
+    if not os.path.isfile(diagnostic_plot(archive_name)):
+      psrchive_plots(archive_name + '.ar.paz.pb'+str(downfact))
     
     #Create compressed archive
     if not os.path.isfile(archive_name + '.ar.paz.Fpb'+str(downfact)):
-      subprocess.call(['pam', '-e', 'Fpb'+str(downfact), '-F',  archive_name + '.ar.paz.pb'+str(downfact)], cwd=puls_folder)  
+      psrchive_step(['pam', '-e', 'Fpb'+str(downfact)+'.tmp', '-F',  archive_name + '.ar.paz.pb'+str(downfact)], archive_name + '.ar.paz.Fpb'+str(downfact), puls_folder)
 
   return
 
   
 if __name__ == '__main__':
   args = parser()
+  if args.profile is not None: profiling.enable(args.profile)
   
   pulses = pd.read_hdf(args.db_name,'pulses')
   pulses = pulses[(pulses.Pulse == 0) | (pulses.Pulse == 1)]
@@ -150,8 +336,8 @@ if __name__ == '__main__':
 
   fits_path = os.path.join(args.obsPATH, '{}', args.fits_file)
     
+  jobs = []
   for idx_p, puls in pulses.iterrows():
-    print "  Pulse n. {} processing".format(idx_p)
     fits_file = fits_path.format(idx_p) 
     try: 
       if '*' in fits_file: fits_file = glob(fits_file)[0]
@@ -160,7 +346,17 @@ if __name__ == '__main__':
       with open(os.path.join(args.obsPATH, 'ERRORS.txt'), 'w') as error_file:
         error_file.write("PSRCHIVE for pulse {} cannot be created.".format(idx_p))      
       continue
-    dspsr(fits_file, puls=puls, profile_bins=args.profile_bins)
-    
-    #if args.par_file: os.remove(par_file)
 
+    #Skip pulses already processed
+    if all([os.path.isfile(f) for f in products(fits_file, puls.Downfact, profile_bins=args.profile_bins)]):
+      print "  Pulse n. {} already processed".format(idx_p)
+      continue
+    jobs.append((idx_p, fits_file, puls))
+
+  if args.shm_budget is None: shm_budget = None
+  else: shm_budget = args.shm_budget * 1024**2
+  failed = process_pulses(jobs, ncpus=args.ncpus, shm_budget=shm_budget, tmp_dir=args.tmp_dir, profile_bins=args.profile_bins, windowed=not args.full_fold,
+                          timeout=args.timeout)
+  if failed:
+    print "PSRCHIVES of pulses {} cannot be created.".format(failed)
+    sys.exit(1)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+dm_plan.py
+
+De-dispersion plans in the style of PRESTO's DDplan.py.
+The DM range is covered by steps of increasing DM spacing and
+downsampling factor, chosen so that the smearing introduced by
+the de-dispersion stays close to the unavoidable smearing of the
+observation (sampling time and intra-channel dispersion).
+The prepsubband calls of a plan are then distributed among a
+number of jobs balanced by their estimated cost.
+
+"""
+
+import collections
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+import psr_utils
+
+
+# DM spacings available to the plans (pc/cm^3), as in DDplan.py
+DM_STEPS = [0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 3.0, 5.0,
+            10.0, 20.0, 30.0, 50.0, 100.0, 200.0, 300.0, 500.0, 1000.0]
+
+PlanStep = collections.namedtuple('PlanStep', ['lodm', 'dmstep', 'numdms', 'downsamp'])
+PrepsubbandCall = collections.namedtuple('PrepsubbandCall', ['lodm', 'dmstep', 'numdms', 'downsamp', 'cost'])
+
+
+def dm_smearing(dm, f_ctr, bw):
+    """Return the dispersive smearing (in seconds) of a 'dm' across a
+        bandwidth 'bw' centered at 'f_ctr' (both in MHz).
+    """
+    bw = abs(bw)
+    return psr_utils.delay_from_DM(dm, f_ctr - bw / 2.) - \
+           psr_utils.delay_from_DM(dm, f_ctr + bw / 2.)
+
+
+def total_smearing(dm, dmstep, tsamp, f_ctr, bw, nchan, nsub=0):
+    """Return the total smearing (in seconds) of a pulse at 'dm' de-dispersed
+        with trials spaced by 'dmstep' and a sampling time 'tsamp'.
+
+        Inputs:
+            dm: Dispersion measure of the pulse.
+            dmstep: Spacing of the DM trials (half of it is the largest DM error).
+            tsamp: Effective sampling time, including downsampling (s).
+            f_ctr: Central frequency (MHz).
+            bw: Bandwidth (MHz).
+            nchan: Number of channels.
+            nsub: Number of subbands (Default: 0, i.e. no subbanding).
+
+        Outputs:
+            smearing: Quadrature sum of the smearing terms (s).
+    """
+    terms = [tsamp, dm_smearing(dm, f_ctr, bw / float(nchan)), dm_smearing(dmstep / 2., f_ctr, bw)]
+    if nsub:
+        #Residual smearing within the subbands at the largest DM error
+        terms.append(dm_smearing(dmstep / 2., f_ctr, bw / float(nsub)))
+    return np.sqrt(np.sum(np.square(terms)))
+
+
+def plan(lodm, hidm, f_ctr, bw, nchan, tsamp, smearing=1.1, nsub=0, max_downsamp=64):
+    """Compute a de-dispersion plan between two DMs.
+        A new step, with twice the downsampling factor, starts when the
+        intra-channel smearing becomes larger than its sampling time.
+        Within each step, the widest DM spacing is used that keeps the total
+        smearing below 'smearing' times the unavoidable smearing.
+
+        Inputs:
+            lodm: Lowest DM.
+            hidm: Highest DM.
+            f_ctr: Central frequency (MHz).
+            bw: Bandwidth (MHz).
+            nchan: Number of channels.
+            tsamp: Sampling time (s).
+            smearing: Maximum ratio between the total and the unavoidable smearing.
+            nsub: Number of subbands (Default: 0, i.e. no subbanding).
+            max_downsamp: Largest downsampling factor.
+
+        Outputs:
+            steps: List of PlanStep.
+    """
+    if smearing <= 1.:
+        raise ValueError("The smearing ratio must be larger than 1.")
+    chan_smearing = dm_smearing(1., f_ctr, bw / float(nchan))
+    steps = []
+    downsamp = 1
+    dm = float(lodm)
+    while dm < hidm:
+        dt = tsamp * downsamp
+        #DM at which the data can be downsampled further without losing resolution
+        if downsamp < max_downsamp: step_hidm = min(2 * dt / chan_smearing, hidm)
+        else: step_hidm = hidm
+        if step_hidm > dm:
+            limit = smearing * total_smearing(dm, 0., dt, f_ctr, bw, nchan)
+            dmsteps = [d for d in DM_STEPS if total_smearing(dm, d, dt, f_ctr, bw, nchan, nsub=nsub) <= limit]
+            if dmsteps: dmstep = dmsteps[-1]
+            else: dmstep = DM_STEPS[0]
+            numdms = int(np.ceil((step_hidm - dm) / dmstep - 1e-6))
+            steps.append(PlanStep(dm, dmstep, numdms, downsamp))
+            dm = round(dm + numdms * dmstep, 6)
+        downsamp *= 2
+    return steps
+
+
+def prepsubband_calls(steps, nsamp, ncalls, max_numdms=1000):
+    """Split the steps of a plan into prepsubband calls of similar cost.
+
+        Inputs:
+            steps: List of PlanStep.
+            nsamp: Number of samples of the observation.
+            ncalls: Approximate number of calls.
+            max_numdms: Maximum number of DMs of a prepsubband call.
+
+        Outputs:
+            calls: List of PrepsubbandCall, with the cost estimated as
+                output samples times number of DMs.
+    """
+    total = sum([nsamp / float(s.downsamp) * s.numdms for s in steps])
+    calls = []
+    for s in steps:
+        cost_dm = nsamp / float(s.downsamp)
+        n_step = max(int(round(s.numdms * cost_dm / total * ncalls)), int(np.ceil(s.numdms / float(max_numdms))), 1)
+        n_step = min(n_step, s.numdms)
+        first = 0
+        for n in range(n_step):
+            numdms = s.numdms / n_step + (n < s.numdms % n_step)
+            calls.append(PrepsubbandCall(round(s.lodm + first * s.dmstep, 6), s.dmstep, numdms, s.downsamp, cost_dm * numdms))
+            first += numdms
+    return calls
+
+
+def balance(calls, njobs):
+    """Distribute prepsubband calls among jobs so that they finish together
+        (longest processing time first scheduling).
+
+        Inputs:
+            calls: List of PrepsubbandCall.
+            njobs: Number of jobs.
+
+        Outputs:
+            jobs: List of lists of PrepsubbandCall, one per job, sorted by DM.
+    """
+    jobs = [[] for n in range(max(njobs, 1))]
+    load = np.zeros(len(jobs))
+    for call in sorted(calls, key=lambda c: c.cost, reverse=True):
+        n = load.argmin()
+        jobs[n].append(call)
+        load[n] += call.cost
+    return [sorted(job, key=lambda c: c.lodm) for job in jobs if job]
+
+
+def partition(steps, nsamp, njobs, max_numdms=1000, imbalance=0.05, max_calls_job=8):
+    """Split a plan into jobs of balanced cost.
+        Every prepsubband call reads the whole observation, so the steps are
+        split into as few calls as possible for the most loaded job to be
+        within 'imbalance' of the average load.
+
+        Inputs:
+            steps: List of PlanStep.
+            nsamp: Number of samples of the observation.
+            njobs: Number of jobs.
+            max_numdms: Maximum number of DMs of a prepsubband call.
+            imbalance: Accepted excess load of the most loaded job.
+            max_calls_job: Largest average number of calls per job tried.
+
+        Outputs:
+            jobs: List of lists of PrepsubbandCall, one per job.
+    """
+    njobs = max(njobs, 1)
+    best = None
+    for calls_job in range(1, max_calls_job + 1):
+        jobs = balance(prepsubband_calls(steps, nsamp, calls_job * njobs, max_numdms=max_numdms), njobs)
+        loads = [sum([c.cost for c in job]) for job in jobs]
+        excess = max(loads) * njobs / sum(loads) - 1.
+        if best is None or excess < best[0]: best = (excess, jobs)
+        if excess <= imbalance: break
+    return best[1]
+
+
+def fits_parameters(fits_file):
+    """Read the observing parameters needed by a plan from a PSRFITS file.
+
+        Outputs:
+            params: Dictionary with f_ctr, bw, nchan, tsamp and nsamp.
+    """
+    with pyfits.open(fits_file, memmap=True) as fits:
+        header = fits['SUBINT'].header
+        params = {'f_ctr': fits['PRIMARY'].header['OBSFREQ'],
+                  'bw': fits['PRIMARY'].header['OBSBW'],
+                  'nchan': header['NCHAN'],
+                  'tsamp': header['TBIN'],
+                  'nsamp': header['NSBLK'] * header['NAXIS2']}
+    return params
+
+
+def describe(steps, nsamp=None):
+    """Return a table of the steps of a plan, similar to the output of DDplan.py.
+    """
+    lines = ["  Low DM    High DM     dDM  DownSamp   #DMs  Cost"]
+    if nsamp is None: nsamp = 1
+    total = sum([nsamp / float(s.downsamp) * s.numdms for s in steps])
+    for s in steps:
+        cost = nsamp / float(s.downsamp) * s.numdms
+        lines.append("%8.3f %10.3f %7.2f %9d %6d  %4.1f%%" % (s.lodm, s.lodm + s.numdms * s.dmstep, s.dmstep, s.downsamp, s.numdms, 100. * cost / total))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="The program prints the de-dispersion plan of an observation.")
+    parser.add_argument('fits', help="Name of the fits file.")
+    parser.add_argument('-lodm', help="Lowest DM.", type=float, default=0.)
+    parser.add_argument('-hidm', help="Highest DM.", type=float, default=1000.)
+    parser.add_argument('-smearing', help="Maximum ratio between the total and the unavoidable smearing.", type=float, default=1.1)
+    parser.add_argument('-nsub', help="The number of sub-bands to use.", type=int, default=64)
+    args = parser.parse_args()
+    params = fits_parameters(args.fits)
+    print describe(plan(args.lodm, args.hidm, params['f_ctr'], params['bw'], params['nchan'], params['tsamp'], smearing=args.smearing, nsub=args.nsub), params['nsamp'])
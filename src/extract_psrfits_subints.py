@@ -2,8 +2,107 @@
 
 import numpy as np
 import os
+import re
+from multiprocessing.pool import ThreadPool
 from astropy.io import fits
 
+# Size of the FITS blocks and of the buffer used to copy the raw data
+FITS_BLOCK=2880
+COPY_BUFSIZE=16*1024*1024
+
+# Fields of the observation index
+INDEX_FIELDS=[('stt_imjd','i4'),('stt_smjd','i4'),('stt_offs','f8'),('nsblk','i4'),('tbin','f8'),('nsuboffs','i8'),('nsub','i8')]
+
+# Read the header of a PSRFITS file
+def read_file_header(fname):
+    """Retrieve information about a PSRFITS file
+
+    Input:
+       fname: PSRFITS filename
+
+    Output:
+       row: tuple with the filename and the fields of INDEX_FIELDS, None if the file cannot be read
+
+    """  
+    try:
+        fits_file=fits.open(fname,memmap=True)
+    except IOError:
+        return None
+
+    try:
+        # Read headers
+        fits_hdr=fits_file[0].header
+        subint_hdr=fits_file['SUBINT'].header
+
+        # Get information
+        return (fname,fits_hdr['STT_IMJD'],fits_hdr['STT_SMJD'],fits_hdr['STT_OFFS'],
+                subint_hdr['NSBLK'],subint_hdr['TBIN'],subint_hdr['NSUBOFFS'],subint_hdr['NAXIS2'])
+    finally:
+        fits_file.close()
+
+
+# Build the index of a list of PSRFITS files
+def files_index(files,ncpus=8):
+    """Retrieve information about a list of PSRFITS files
+
+    Input:
+       files: list of PSRFITS filenames
+       ncpus: number of threads reading the headers
+
+    Output:
+       index: numpy structured array with one entry per readable file, in the order of files.
+              Fields are 'file' and the ones of INDEX_FIELDS
+
+    """  
+    # Read each header once
+    if ncpus>1 and len(files)>1:
+        pool=ThreadPool(min(ncpus,len(files)))
+        try:
+            rows=pool.map(read_file_header,files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rows=map(read_file_header,files)
+    rows=[row for row in rows if row is not None]
+
+    # Compact array with one entry per file
+    name_size=max([len(row[0]) for row in rows]+[1])
+    return np.array(rows,dtype=[('file','S%d'%name_size)]+INDEX_FIELDS)
+
+
+# Build the index of the files of an observation
+def observation_index(froot,ncpus=8):
+    """Retrieve information about the PSRFITS files of an observation
+
+    Input:
+       froot: Root of PSRFITS filenames, string
+              e.g. fits/puppi_57614_C0531+33_0803 for fits/puppi_57614_C0531+33_0803_*.fits
+       ncpus: number of threads reading the headers
+
+    Output:
+       index: numpy structured array with one entry per file, sorted by file number.
+              Fields are 'file' and the ones of INDEX_FIELDS
+
+    Raises IOError if there is no file froot_0001.fits.
+
+    """  
+    # Find the sequential parts of the observation with a single directory scan
+    directory,basename=os.path.split(froot)
+    pattern=re.compile(re.escape(basename)+r'_(\d{4})\.fits$')
+    parts={}
+    for name in os.listdir(directory or os.curdir):
+        match=pattern.match(name)
+        if match: parts[int(match.group(1))]=os.path.join(directory,name)
+    files=[]
+    while len(files)+1 in parts:
+        files.append(parts[len(files)+1])
+    if not files:
+        raise IOError("No PSRFITS files %s_NNNN.fits starting from %s_0001.fits"%(froot,froot))
+
+    return files_index(files,ncpus=ncpus)
+
+
 # Read FITS start times
 def get_starttimes(froot):
     """Retrieve information about PSRFITS files
@@ -23,72 +122,9 @@ def get_starttimes(froot):
        nsub: numpy array of number of subints within each file
 
     """  
-    # Start file
-    ifile=1
-
-    # Empty lists
-    files=[]
-    stt_imjd=[]
-    stt_smjd=[]
-    stt_offs=[]
-    tbin=[]
-    nsblk=[]
-    nsub=[]
-    nsuboffs=[]
-
-    # Loop over files
-    while True:
-        # Format filename
-        fname="%s_%04d.fits"%(froot,ifile)
-
-        # Check if the file exists
-        if os.path.isfile(fname):
-            # Increment counter
-            ifile+=1
-
-
-            try:
-              # Read headers
-              fits_file=fits.open(fname,memmap=True)
-              fits_hdr=fits_file[0].header
-              subint_hdr=fits_file['SUBINT'].header                                                                                              
-
-              # Store file name
-              files.append(fname)
-
-              # Get information
-              stt_imjd.append(fits_hdr['STT_IMJD'])
-              stt_smjd.append(fits_hdr['STT_SMJD'])
-              stt_offs.append(fits_hdr['STT_OFFS'])
-              tbin.append(subint_hdr['TBIN'])
-              nsblk.append(subint_hdr['NSBLK'])
-              nsuboffs.append(subint_hdr['NSUBOFFS'])
-              nsub.append(subint_hdr['NAXIS2'])
-            except IOError: pass 
-
-            # Store file name
-            files.append(fname)
-
-            # Read headers
-            fits_file=fits.open(fname,memmap=True)
-            fits_hdr=fits_file[0].header
-            subint_hdr=fits_file['SUBINT'].header                                                                                              
-
-            # Get information
-            stt_imjd.append(fits_hdr['STT_IMJD'])
-            stt_smjd.append(fits_hdr['STT_SMJD'])
-            stt_offs.append(fits_hdr['STT_OFFS'])
-            tbin.append(subint_hdr['TBIN'])
-            nsblk.append(subint_hdr['NSBLK'])
-            nsuboffs.append(subint_hdr['NSUBOFFS'])
-            nsub.append(subint_hdr['NAXIS2'])
-        #elif ifile==14: ###TEMPORARY EDIT TO PROCESS 57645###
-        #    ifile +=1
+    index=observation_index(froot)
 
-        else:
-            break
-
-    return files,np.array(stt_imjd),np.array(stt_smjd),np.array(stt_offs),np.array(nsblk),np.array(tbin),np.asarray(nsuboffs),np.asarray(nsub)
+    return list(index['file']),index['stt_imjd'],index['stt_smjd'],index['stt_offs'],index['nsblk'],index['tbin'],index['nsuboffs'],index['nsub']
 
 # Extract subints from a single file
 def extract_subints_from_single_file(infname,outfname,isubmin,isubmax):
@@ -100,38 +136,181 @@ def extract_subints_from_single_file(infname,outfname,isubmin,isubmax):
        isubmin,isubmax: subint range to extract and store
 
     """  
-    # Open file
-    fits_file=fits.open(infname,memmap=True)
+    extract_subints_batch(infname,[(outfname,isubmin,isubmax)])
+
+    return
 
-    # Read HDU 0 and 1 and their headers
-    fits_hdu=fits_file[0]
-    fits_hdr=fits_hdu.header
-    subint_hdu=fits_file[1]
-    subint_hdr=subint_hdu.header
 
-    # Copy subint header
-    new_subint_hdr=subint_hdr
+# Write a subint range to a new FITS file
+def write_subints(fits_hdr,subint_hdr,rows,outfname,isubmin):
+    """Store a range of subints as a different FITS file
 
-    # Adjust NSUBOFFS
+    Input:
+       fits_hdr: primary header of the input FITS file
+       subint_hdr: SUBINT header of the input FITS file
+       rows: subint rows to store
+       outfname: Name of output FITS file
+       isubmin: index of the first row in the input file
+
+    """  
+    # Copy subint header and adjust NSUBOFFS
+    new_subint_hdr=subint_hdr.copy()
     new_subint_hdr['NSUBOFFS']+=isubmin
 
     # Create a new primary HDU and binary table HDU
     new_fits_hdu=fits.PrimaryHDU(data=None,header=fits_hdr)
-    new_subint_hdu=fits.BinTableHDU(data=subint_hdu.data[isubmin:isubmax],header=new_subint_hdr)
+    new_subint_hdu=fits.BinTableHDU(data=rows,header=new_subint_hdr)
     new_fits_file=fits.HDUList([new_fits_hdu,new_subint_hdu])
 
     # Write to new file
     new_fits_file.writeto(outfname,clobber=True)
+    new_fits_file.close()
 
-    # Close files
+    return
+
+
+# Copy a byte range between two files
+def copy_bytes(infile,outfile,offset,nbytes):
+    """Copy a range of bytes of a file at the current position of another file
+
+    Input:
+       infile: input file object
+       outfile: output file object
+       offset: position of the first byte to copy in infile
+       nbytes: number of bytes to copy
+
+    """  
+    if hasattr(os,'sendfile'):
+        # Copy inside the kernel
+        outfile.flush()
+        while nbytes>0:
+            sent=os.sendfile(outfile.fileno(),infile.fileno(),offset,nbytes)
+            if sent==0: break
+            offset+=sent
+            nbytes-=sent
+    else:
+        # Buffered copy
+        infile.seek(offset)
+        while nbytes>0:
+            chunk=infile.read(min(nbytes,COPY_BUFSIZE))
+            if not chunk: break
+            outfile.write(chunk)
+            nbytes-=len(chunk)
+
+    if nbytes>0:
+        raise IOError("File %s is truncated"%infile.name)
+
+    return
+
+
+# Copy a subint range to a new FITS file without decoding the rows
+def write_subints_raw(infname,primary_size,subint_hdr,data_offset,outfname,isubmin,isubmax):
+    """Store a range of subints as a different FITS file, copying the bytes of the rows
+
+    Input:
+       infname: Name of input FITS file
+       primary_size: size in bytes of the primary HDU of the input file
+       subint_hdr: SUBINT header of the input FITS file
+       data_offset: position in bytes of the first subint in the input file
+       outfname: Name of output FITS file
+       isubmin,isubmax: subint range to store
+
+    """  
+    # Copy subint header and adjust NAXIS2 and NSUBOFFS
+    new_subint_hdr=subint_hdr.copy()
+    new_subint_hdr['NAXIS2']=isubmax-isubmin
+    new_subint_hdr['NSUBOFFS']+=isubmin
+    for key in ['CHECKSUM','DATASUM']:
+        if key in new_subint_hdr: del new_subint_hdr[key]
+
+    # Size of the rows
+    row_size=subint_hdr['NAXIS1']
+    nbytes=(isubmax-isubmin)*row_size
+
+    # Primary HDU as it is, new header, rows and padding to a full FITS block
+    with open(infname,'rb') as infile, open(outfname,'wb') as outfile:
+        copy_bytes(infile,outfile,0,primary_size)
+        outfile.write(new_subint_hdr.tostring())
+        copy_bytes(infile,outfile,data_offset+isubmin*row_size,nbytes)
+        outfile.write('\0'*(-nbytes%FITS_BLOCK))
+
+    return
+
+
+# Merge overlapping subint ranges
+def merge_windows(windows):
+    """Group subint windows that overlap
+
+    Input:
+       windows: list of (outfname,isubmin,isubmax)
+
+    Output:
+       groups: list of (isubmin,isubmax,windows) where isubmin,isubmax cover
+               all the windows of the group, sorted by isubmin
+
+    """  
+    groups=[]
+    for window in sorted(windows,key=lambda w: w[1]):
+        if groups and window[1]<groups[-1][1]:
+            groups[-1][1]=max(groups[-1][1],window[2])
+            groups[-1][2].append(window)
+        else:
+            groups.append([window[1],window[2],[window]])
+    return [tuple(g) for g in groups]
+
+
+# Extract many subint ranges from a single file
+def extract_subints_batch(infname,windows,ncpus=1):
+    """Extract many subint ranges from a single FITS file, opening it only once
+
+    Input:
+       infname: Name of input FITS file
+       windows: list of (outfname,isubmin,isubmax)
+       ncpus: number of threads writing the output files
+
+    """  
+    # Open file
+    fits_file=fits.open(infname,memmap=True)
+
+    # Read HDU 0 and 1 and their headers
+    fits_hdr=fits_file[0].header
+    subint_hdu=fits_file[1]
+    subint_hdr=subint_hdu.header
+
+    if subint_hdr.get('PCOUNT',0)==0:
+        # Rows have a fixed size: copy their bytes directly
+        primary_size=fits_file.fileinfo(1)['hdrLoc']
+        data_offset=fits_file.fileinfo(1)['datLoc']
+        jobs=[(write_subints_raw,(infname,primary_size,subint_hdr,data_offset,outfname,imin,imax)) for outfname,imin,imax in sorted(windows,key=lambda w: w[1])]
+    else:
+        # Rows point to a heap: overlapping windows are read in a single pass over the memory-mapped file.
+        # Variable length columns are decoded first, otherwise slices of the table lose the heap.
+        for name in subint_hdu.data.columns.names: subint_hdu.data.field(name)
+        jobs=[]
+        for isubmin,isubmax,group in merge_windows(windows):
+            block=subint_hdu.data[isubmin:isubmax]
+            for outfname,imin,imax in group:
+                jobs.append((write_subints,(fits_hdr,subint_hdr,block[imin-isubmin:imax-isubmin],outfname,imin)))
+
+    # Write output files, in parallel by a pool of threads if requested
+    if ncpus>1 and len(jobs)>1:
+        pool=ThreadPool(min(ncpus,len(jobs)))
+        try:
+            pool.map(lambda job: job[0](*job[1]),jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs: job[0](*job[1])
+
+    # Close file
     fits_file.close()
-    new_fits_file.close()
 
     return
 
 
 # Extract subints from an observation
-def extract_subints_from_observation(froot,path,tbursts,isub0,isub1,pulseID=''):
+def extract_subints_from_observation(froot,path,tbursts,isub0,isub1,pulseID='',ncpus=1):
     """Extract subints from a PSRFITS observation
 
     Input:
@@ -141,22 +320,28 @@ def extract_subints_from_observation(froot,path,tbursts,isub0,isub1,pulseID=''):
        isub0: number of subints to extract before the pulse (negative)
        isub1: number of subints to extract after the pulse
        pulseID: list of burst ID numbers
+       ncpus: number of threads writing the output files of each input file
 
     """  
     # Check that pulseID is an array
     if isinstance(pulseID, str): pulseID = [pulseID,] * len(tbursts)
 
-    # Get start times
-    files,stt_imjd,stt_smjd,stt_offs,nsblk,tbin,nsuboffs,nsub=get_starttimes(froot)
+    # Index of the observation files
+    index=observation_index(froot)
+    files=index['file']
+    nsblk=index['nsblk']
+    tbin=index['tbin']
+    nsub=index['nsub']
 
     # File offsets
-    offsets=nsblk*nsuboffs*tbin
+    offsets=nsblk*index['nsuboffs']*tbin
 
     # Start and end times
     tstart=offsets
     tend=offsets+nsblk*nsub*tbin
 
-    # Loop over bursts
+    # Group the bursts by file
+    windows={}
     for idx, tburst in enumerate(tbursts):
         # Output filename
         fname="%s_%s.fits"%(os.path.join(path,pulseID[idx],os.path.basename(froot)),pulseID[idx])
@@ -181,13 +366,16 @@ def extract_subints_from_observation(froot,path,tbursts,isub0,isub1,pulseID=''):
                 # Some logic for dealing with file breaks
                 if isubmin>=0 and isubmax<nsub[i]:
                     print "Extracting subints %03d to %03d from %s to %s"%(isubmin,isubmax,files[i],fname) 
-                  
-                    # Extract subints
-                    extract_subints_from_single_file(files[i],fname,isubmin,isubmax)
+                    windows.setdefault(files[i],[]).append((fname,isubmin,isubmax))
                 else:
                     print "Pulse %s extends over a file break and it was not processed."%(pulseID[idx])
-                    with open(os.path.join(path, 'ERRORS.txt'), 'w') as error_file:
-                      error_file.write("Pulse %s extends over a file break and it was not processed."%(pulseID[idx]))
+                    with open(os.path.join(path, 'ERRORS.txt'), 'a') as error_file:
+                      error_file.write("Pulse %s extends over a file break and it was not processed.\n"%(pulseID[idx]))
+                break
+
+    # Extract subints, opening each file once
+    for infname in sorted(windows.keys()):
+        extract_subints_batch(infname,windows[infname],ncpus=ncpus)
                       
     return
     
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+fdmt.py
+
+Fast Dispersion Measure Transform of Spectra objects.
+Computes the dedispersed time series of many trial DMs at once
+(i.e. a DM-time plane) in O(N log N) operations, instead of
+dedispersing the data once per trial DM.
+
+Algorithm from Zackay & Ofek (2017, ApJ 835, 11).
+
+"""
+
+import copy
+
+import numpy as np
+
+import psr_utils
+
+
+def delay_per_dm(f_lo, f_hi):
+    """Return the dispersive delay (in seconds) between the frequencies
+        'f_lo' and 'f_hi' (in MHz) for a DM of 1 pc/cm^3.
+    """
+    return psr_utils.delay_from_DM(1., float(f_lo)) - \
+           psr_utils.delay_from_DM(1., float(f_hi))
+
+
+def _fdmt_initialization(data, f_min, f_max, max_dt):
+    """Integrate each channel over the delays that are possible
+        within the channel itself.
+
+        Inputs:
+            data: 2D numpy array with channels in ascending frequency
+                along axis 0 and time along axis 1.
+            f_min, f_max: Lower and upper edges of the band (in MHz).
+            max_dt: Number of delay bins across the full band.
+
+        Output:
+            state: 3D numpy array (channel, delay, time).
+    """
+    nchan, nsamp = data.shape
+    df = (f_max - f_min) / nchan
+    ddt = int(np.ceil((max_dt - 1) * (1./f_min**2 - 1./(f_min+df)**2) / \
+                                     (1./f_min**2 - 1./f_max**2)))
+    state = np.zeros((nchan, ddt+1, nsamp), dtype=data.dtype)
+    state[:, 0, :] = data
+    for idt in range(1, ddt+1):
+        state[:, idt, idt:] = state[:, idt-1, idt:] + data[:, :-idt]
+    return state
+
+
+def _fdmt_iteration(state, f_min, f_max, nchan, max_dt, iteration):
+    """Merge pairs of adjacent subbands of 'state'.
+        See Zackay & Ofek (2017), Algorithm 1.
+    """
+    nsub_in, _, nsamp = state.shape
+    nsub = nsub_in // 2
+    df = (f_max - f_min) / nchan
+    sub_bw = 2**iteration * df
+    ddt = int(np.ceil((max_dt - 1) * (1./f_min**2 - 1./(f_min+sub_bw)**2) / \
+                                     (1./f_min**2 - 1./f_max**2)))
+    output = np.zeros((nsub, ddt+1, nsamp), dtype=state.dtype)
+
+    if iteration > 0:
+        correction = df / 2.
+    else:
+        correction = 0.
+
+    for isub in range(nsub):
+        f_start = (f_max - f_min) / float(nsub) * isub + f_min
+        f_end = (f_max - f_min) / float(nsub) * (isub+1) + f_min
+        f_middle = (f_end - f_start) / 2. + f_start - correction
+        f_middle_larger = (f_end - f_start) / 2. + f_start + correction
+        ddt_local = int(np.ceil((max_dt - 1) * (1./f_start**2 - 1./f_end**2) / \
+                                               (1./f_min**2 - 1./f_max**2)))
+        for idt in range(ddt_local+1):
+            dt_middle = int(round(idt * (1./f_middle**2 - 1./f_start**2) / \
+                                        (1./f_end**2 - 1./f_start**2)))
+            dt_middle_larger = int(round(idt * (1./f_middle_larger**2 - 1./f_start**2) / \
+                                               (1./f_end**2 - 1./f_start**2)))
+            dt_rest = idt - dt_middle_larger
+            output[isub, idt, :dt_middle_larger] = \
+                state[2*isub, dt_middle, :dt_middle_larger]
+            output[isub, idt, dt_middle_larger:] = \
+                state[2*isub, dt_middle, dt_middle_larger:] + \
+                state[2*isub+1, dt_rest, :nsamp-dt_middle_larger]
+    return output
+
+
+def fdmt(data, f_min, f_max, max_dt):
+    """Fast Dispersion Measure Transform of a dynamic spectrum.
+
+        Inputs:
+            data: 2D numpy array with channels in ascending frequency
+                along axis 0 and time along axis 1. The number of
+                channels must be a power of 2.
+            f_min, f_max: Lower and upper edges of the band (in MHz).
+            max_dt: Number of delay bins (across the full band) to compute.
+
+        Output:
+            plane: 2D numpy array of shape (max_dt, nsamp). Row 'i' is
+                the time series dedispersed with a delay of 'i' bins
+                across the band, referenced to the bottom of the band.
+    """
+    nchan = data.shape[0]
+    niter = int(np.log2(nchan))
+    if 2**niter != nchan:
+        raise ValueError("Number of channels must be a power of 2 (%d)" % nchan)
+
+    state = _fdmt_initialization(data, f_min, f_max, max_dt)
+    for iteration in range(1, niter+1):
+        state = _fdmt_iteration(state, f_min, f_max, nchan, max_dt, iteration)
+    return state[0, :max_dt, :]
+
+
+def dm_time_plane(spec, dm_lo, dm_hi, padval='mean'):
+    """Dedisperse a Spectra object at all the DMs resolvable
+        between 'dm_lo' and 'dm_hi' using the FDMT.
+
+        Inputs:
+            spec: A Spectra object (not modified). The mean of each
+                channel is removed and masked channels are set to zero.
+            dm_lo: Lowest DM (in pc/cm^3) of the plane.
+            dm_hi: Highest DM (in pc/cm^3) of the plane.
+            padval: Value used for the samples at the end of each
+                time series that are not fully covered by the data.
+                This can be a numeric value or 'mean'. (Default: 'mean')
+
+        Outputs:
+            dms: 1D numpy array of the trial DMs (one per delay bin).
+            plane: 2D numpy array (DM, time). Each row is the time series
+                dedispersed to the top of the band, starting at
+                'spec.starttime' with sampling time 'spec.dt'.
+
+        The FDMT sums each channel over the delays spanned within the
+        channel, as expected from the intra-channel smearing. Pulses narrower
+        than the smearing of a channel are therefore recovered with a lower
+        S/N than with brute-force dedispersion (~25-35% less for pulses of
+        one sample in simulations, ~10% for smeared pulses). Transforming
+        from a DM of 0 instead of pre-dedispersing to 'dm_lo' does not
+        reduce this loss. Narrow pulses should be confirmed by dedispersing
+        the data at the DM of the candidate (e.g. Spectra.dedisperse).
+    """
+    assert dm_hi > dm_lo >= 0
+
+    # Remove the DM offset by brute force, then transform the residual sweep
+    spec = copy.deepcopy(spec)
+    if dm_lo > 0:
+        spec.dedisperse(dm_lo, padval='mean')
+
+    data = np.ma.asarray(spec.data)
+    data = np.ma.filled(data - data.mean(axis=1)[:, np.newaxis], 0.)
+    freqs = np.asarray(spec.freqs)
+    order = np.argsort(freqs)
+    data = np.asarray(data[order], dtype=np.float32)
+    freqs = freqs[order]
+
+    # Band edges
+    if freqs.size > 1:
+        chan_bw = np.abs(np.median(np.diff(freqs)))
+    else:
+        chan_bw = 1.
+    f_max = freqs[-1] + chan_bw / 2.
+    f_min = freqs[0] - chan_bw / 2.
+
+    # Pad the bottom of the band with empty channels up to a power of 2
+    nchan = 2**int(np.ceil(np.log2(data.shape[0])))
+    npad = nchan - data.shape[0]
+    if npad > 0:
+        data = np.concatenate([np.zeros((npad, data.shape[1]), dtype=data.dtype), data])
+        f_min -= npad * chan_bw
+
+    sec_per_dm = delay_per_dm(f_min, f_max)
+    max_dt = int(np.ceil((dm_hi - dm_lo) * sec_per_dm / spec.dt)) + 1
+    plane = fdmt(data, f_min, f_max, max_dt)
+
+    # Move the reference time from the bottom to the top of the band
+    nsamp = plane.shape[1]
+    for idt in range(1, max_dt):
+        if idt >= nsamp:
+            plane[idt] = 0
+            continue
+        row = plane[idt]
+        row[:-idt] = row[idt:]
+        if padval == 'mean':
+            row[-idt:] = np.mean(row[:-idt])
+        else:
+            row[-idt:] = padval
+
+    dms = dm_lo + np.arange(max_dt) * spec.dt / sec_per_dm
+    return dms, plane
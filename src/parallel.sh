@@ -1,52 +1,8 @@
 #!/bin/bash
 
-# Maximum number of jobs
-if [ -z $2 ]; then
-    MAXJOBS=1
-else
-    MAXJOBS=$2
-fi
+# Run the commands of a file (one per line) in parallel.
+# Usage: bash parallel.sh jobs_file [max_jobs (Default: 1)]
+# The commands are also admitted according to their memory and disk I/O footprints,
+# learned in previous runs and stored in footprints.json next to the jobs file.
 
-# Get job ID from scrint
-function jobidfromstring()
-{
-    local STRING;
-    local RET;
-
-    STRING=$1;
-    RET="$(echo $STRING | sed 's/^[^0-9]*//' | sed 's/[^0-9].*$//')"
-
-    echo $RET;
-}
-
-# Ready to spawn job
-function clearToSpawn
-{
-    local JOBCOUNT="$(jobs -r | grep -c .)"
-    if [ $JOBCOUNT -lt $MAXJOBS ] ; then
-        echo 1;
-        return 1;
-    fi
-
-    echo 0;
-    return 0;
-}
-
-# Loop over commands
-JOBLIST=""
-while read line; do
-  while [ `clearToSpawn` -ne 1 ] ; do
-      sleep 0.5
-  done
-
-  # Run command
-  #echo "Running" $line
-  echo $line | sh &
-
-  LASTJOB=`jobidfromstring $(jobs %%)`
-  JOBLIST="$JOBLIST $LASTJOB"
-done < $1
-# Wait for jobs to finish
-for JOB in $JOBLIST ; do
-    wait %$JOB
-done
+python "$( cd -P "$( dirname "$0" )" && pwd )/pipeline.py" run "$1" -ncpus ${2:-1}
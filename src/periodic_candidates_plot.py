@@ -1,13 +1,13 @@
 import sys
 import re
 import glob
-import subprocess
 import argparse
 import os
 
 import numpy as np
 
 import sifting
+import profiling
 
 #From ACCEL_sift.py
 
@@ -96,7 +96,7 @@ if __name__ == '__main__':
   if not isinstance(dm_list, np.ndarray): exit()
   
   for idx,[dm, p] in enumerate(zip(dm_list, p_list)):
-    if subprocess.call(['prepfold', '-noscales', '-nooffsets', '-noweights', '-nsub', '64', '-p', str(p), '-dm', str(dm), '-noxwin', '-o', '{}_periodic_cand_{}'.format(basename, idx), args.fits], cwd=args.folder):
+    if profiling.call(['prepfold', '-noscales', '-nooffsets', '-noweights', '-nsub', '64', '-p', str(p), '-dm', str(dm), '-noxwin', '-o', '{}_periodic_cand_{}'.format(basename, idx), args.fits], cwd=args.folder):
      print "Error in prepfold!"
 
 
@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+
+"""
+pipeline.py
+
+Runner of the processing pipelines as a graph of tasks. Each task is a
+shell command that starts as soon as the tasks it depends on are
+finished, so that every DM trial flows through its stages independently
+of the others instead of waiting for all the DM trials at each stage.
+Finished processes are collected with os.wait4() as they exit and the
+wall time of each stage is reported at the end.
+
+Besides the number of CPUs, tasks are admitted only if their memory and
+disk I/O footprints fit in the memory and I/O bandwidth still available.
+The footprints are declared for a task or learned for its stage: the
+peak resident memory and the disk I/O rate of every finished task are
+measured and stored in a JSON file, so that each run schedules the
+following ones better.
+
+The state of the pipeline can be stored in a JSON file. Each completed
+task is recorded with a signature of its command, of its input files
+and of the tasks it depends on, together with its output files. When
+the pipeline is run again, the tasks whose signature and outputs did
+not change are skipped, so that only the products invalidated by a
+change (e.g. of obs_parameters.py) are computed again. Tasks that do not
+declare their outputs are always run again.
+
+The FRB121102 pipelines (formerly the FRB121102_*.sh scripts) are:
+    identify: search a subbanded fits file for single pulses and
+        periodic candidates, storing them in a HDF5 database.
+    chop: extract raw data and psrchives around the pulses of a
+        database that have been ranked.
+A file of independent commands, one per line, can also be run
+(formerly parallel.sh).
+
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import dm_plan
+import profiling
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#Input files smaller than this (bytes) are identified by their content, larger ones by their size and modification time
+HASH_LIMIT = 1024**2
+
+#Name of the file storing the footprints of the stages learned in previous runs
+FOOTPRINTS_FILE = 'footprints.json'
+
+
+def save_json(filename, content):
+    """Write a JSON file atomically.
+    """
+    temp_name = filename + '.tmp'
+    with open(temp_name, 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    os.rename(temp_name, filename)
+
+
+def available_memory():
+    """Memory (MB) available to new processes without swapping.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict([(line.split(':')[0], line.split()[1]) for line in f])
+        return int(meminfo.get('MemAvailable', meminfo['MemFree'])) / 1024.
+    except (IOError, KeyError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1024.**2
+
+
+def file_signature(filename):
+    """Return an identifier of the content of a file, None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if stat.st_size > HASH_LIMIT:
+        return [stat.st_size, stat.st_mtime]
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def file_stat(filename):
+    """Return the size and modification time of a file, None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+class Task(object):
+    """A shell command of the pipeline.
+    """
+    def __init__(self, name, command, stage, deps=(), cwd=None, inputs=(), outputs=(), memory=None, io=None):
+        """Task constructor.
+
+            Inputs:
+                name: Unique name of the task.
+                command: Shell command to run.
+                stage: Name of the stage of the pipeline the task belongs to.
+                deps: Tasks that must be successfully completed before this one.
+                cwd: Working directory of the command (Default: current directory).
+                inputs: Files read by the command, other than the outputs of deps.
+                outputs: Files written by the command.
+                memory: Peak memory used by the command (MB) (Default: learned for the stage).
+                io: Disk I/O rate of the command (MB/s) (Default: learned for the stage).
+
+            Output:
+                task: Task object.
+        """
+        self.name = name
+        self.command = command
+        self.stage = stage
+        self.deps = list(deps)
+        self.cwd = cwd
+        self.inputs = [os.path.join(cwd or '', f) for f in inputs]
+        self.outputs = [os.path.join(cwd or '', f) for f in outputs]
+        self.memory = memory
+        self.io = io
+        self.status = 'waiting'
+        self.cached = False
+        self.signature = None
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.peak_memory = None
+        self.io_rate = None
+
+    def ready(self):
+        return all([dep.status == 'done' for dep in self.deps])
+
+    def blocked(self):
+        return any([dep.status in ['failed', 'skipped'] for dep in self.deps])
+
+    def compute_signature(self):
+        """Signature of the command, the inputs and the dependencies (with their outputs) of the task.
+        """
+        deps = [[dep.signature, [file_signature(f) for f in dep.outputs]] for dep in self.deps]
+        content = [self.command, [[f, file_signature(f)] for f in self.inputs], deps]
+        self.signature = hashlib.sha1(json.dumps(content)).hexdigest()
+        return self.signature
+
+
+class Pipeline(object):
+    """A graph of tasks run by a fixed number of processes.
+    """
+    def __init__(self, ncpus=1, quiet=True, state_file=None, memory=None, io=None, footprints_file=None):
+        """Pipeline constructor.
+
+            Inputs:
+                ncpus: Maximum number of tasks running at the same time.
+                quiet: Discard the standard output of the commands.
+                state_file: JSON file storing the completed tasks (Default: None, tasks are always run).
+                    The completed tasks stored in an existing file are not run again.
+                memory: Memory available to the tasks (MB) (Default: None, not limited).
+                io: Disk I/O bandwidth available to the tasks (MB/s) (Default: None, not limited).
+                footprints_file: JSON file storing the footprints of the stages learned in previous runs
+                    (Default: None, the footprints are learned during the run only).
+
+            Output:
+                pipeline: Pipeline object.
+        """
+        self.ncpus = max(ncpus, 1)
+        self.quiet = quiet
+        self.tasks = OrderedDict()
+        self.state_file = state_file
+        self.state = {}
+        if state_file and os.path.isfile(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        self.memory = memory
+        self.io = io
+        self.footprints_file = footprints_file
+        self.footprints = {}
+        self.observed = {}
+        if footprints_file and os.path.isfile(footprints_file):
+            with open(footprints_file) as f:
+                self.footprints = json.load(f)
+
+    def add(self, name, command, stage, deps=(), cwd=None, inputs=(), outputs=(), memory=None, io=None):
+        """Add a task to the pipeline. Tasks are started in the order
+            they are added, as soon as their dependencies are done.
+
+            Inputs:
+                See Task.
+
+            Outputs:
+                task: the Task added.
+        """
+        if name in self.tasks:
+            raise ValueError("Task %s already in the pipeline" % name)
+        for dep in deps:
+            if dep.name not in self.tasks:
+                raise ValueError("Dependency %s of task %s is not in the pipeline" % (dep.name, name))
+        task = Task(name, command, stage, deps=deps, cwd=cwd, inputs=inputs, outputs=outputs, memory=memory, io=io)
+        self.tasks[name] = task
+        return task
+
+    def _completed(self, task):
+        #Whether the task was completed with the same signature and its outputs were not modified since.
+        #Without outputs there is no way to tell whether the products are still there
+        if not task.outputs: return False
+        record = self.state.get(task.name)
+        if record is None or record['signature'] != task.signature:
+            return False
+        return all([file_stat(f) == stat for f, stat in record['outputs']])
+
+    def _save_state(self):
+        if self.state_file: save_json(self.state_file, self.state)
+
+    def footprint(self, task):
+        """Memory (MB) and disk I/O rate (MB/s) expected for a task, None if unknown.
+        """
+        learned = self.footprints.get(task.stage, {})
+        memory = task.memory if task.memory is not None else learned.get('memory')
+        io = task.io if task.io is not None else learned.get('io')
+        return memory, io
+
+    def _admit(self, task, running):
+        #Whether the resources left by the running tasks are enough to start a task
+        if not running: return True
+        if len(running) >= self.ncpus: return False
+        memory, io = self.footprint(task)
+        if self.memory is not None:
+            #Tasks of unknown footprint get a fair share of the memory. The tolerance keeps the rounding
+            #errors of the shares from refusing the last of ncpus tasks of unknown footprint
+            share = self.memory / self.ncpus
+            if memory is None: memory = share
+            if sum([t.footprint[0] or share for t, proc in running.values()]) + memory > self.memory * (1. + 1e-9): return False
+        if self.io is not None and io is not None:
+            if sum([t.footprint[1] or 0. for t, proc in running.values()]) + io > self.io: return False
+        return True
+
+    def _learn(self, task, rusage):
+        #Peak resident memory and disk I/O rate of the task. The footprint of a stage is the
+        #largest measured in the current run, replacing the one learned in previous runs
+        task.peak_memory = rusage.ru_maxrss / 1024.
+        task.io_rate = (rusage.ru_inblock + rusage.ru_oublock) * 512 / 1024.**2 / max(task.end - task.start, 1.)
+        observed = self.observed.setdefault(task.stage, {'memory': 0., 'io': 0., 'tasks': 0})
+        observed['memory'] = max(observed['memory'], task.peak_memory)
+        observed['io'] = max(observed['io'], task.io_rate)
+        observed['tasks'] += 1
+        self.footprints[task.stage] = dict(observed)
+
+    def _start(self, task, stdout):
+        task.status = 'running'
+        task.start = time.time()
+        task.footprint = self.footprint(task)
+        return subprocess.Popen(task.command, shell=True, cwd=task.cwd, stdout=stdout)
+
+    def _finish(self, task, proc, status, rusage):
+        task.end = time.time()
+        self._learn(task, rusage)
+        profiling.record('task:%s' % task.stage, task.end - task.start, task.peak_memory)
+        if os.WIFSIGNALED(status):
+            task.returncode = -os.WTERMSIG(status)
+        else:
+            task.returncode = os.WEXITSTATUS(status)
+        proc.returncode = task.returncode
+        if task.returncode == 0:
+            task.status = 'done'
+            self.state[task.name] = {'signature': task.signature, 'outputs': [[f, file_stat(f)] for f in task.outputs]}
+        else:
+            task.status = 'failed'
+            self.state.pop(task.name, None)
+            print "Task %s failed with exit code %d: %s" % (task.name, task.returncode, task.command)
+        self._save_state()
+
+    def run(self):
+        """Run the tasks of the pipeline. Tasks depending on a failed task are skipped.
+
+            Inputs:
+                None
+
+            Outputs:
+                failed: List of the names of the failed tasks.
+        """
+        pending = [task for task in self.tasks.values() if task.status == 'waiting']
+        running = {}
+        with open(os.devnull, 'w') as FNULL:
+            stdout = FNULL if self.quiet else None
+            while True:
+                #Start the tasks ready to run, skipping the ones completed in previous runs
+                for task in list(pending):
+                    if task.blocked():
+                        task.status = 'skipped'
+                        pending.remove(task)
+                        continue
+                    if not task.ready():
+                        continue
+                    if task.signature is None:
+                        task.compute_signature()
+                        if self._completed(task):
+                            task.status = 'done'
+                            task.cached = True
+                            pending.remove(task)
+                            continue
+                    if self._admit(task, running):
+                        proc = self._start(task, stdout)
+                        running[proc.pid] = (task, proc)
+                        pending.remove(task)
+
+                if not running:
+                    break
+
+                #Wait for any task to exit
+                pid, status, rusage = os.wait4(-1, 0)
+                if pid not in running:
+                    continue
+                task, proc = running.pop(pid)
+                self._finish(task, proc, status, rusage)
+
+        if self.footprints_file and self.observed: save_json(self.footprints_file, self.footprints)
+
+        if pending:
+            raise ValueError("Tasks %s cannot be started" % ', '.join([task.name for task in pending]))
+
+        return [task.name for task in self.tasks.values() if task.status == 'failed']
+
+    def report(self):
+        """Print the number of tasks, the wall time and the largest memory and I/O rate of the tasks of each stage.
+        """
+        print "%-22s %6s %6s %6s %12s %12s %10s %10s" % ('Stage', 'Tasks', 'Cached', 'Failed', 'Wall (s)', 'Tasks (s)', 'RSS (MB)', 'I/O (MB/s)')
+        stages = OrderedDict()
+        for task in self.tasks.values():
+            stages.setdefault(task.stage, []).append(task)
+        for stage, tasks in stages.items():
+            run = [task for task in tasks if task.start is not None]
+            cached = len([task for task in tasks if task.cached])
+            failed = len([task for task in tasks if task.status != 'done'])
+            if run:
+                wall = max([task.end for task in run]) - min([task.start for task in run])
+                total = sum([task.end - task.start for task in run])
+                memory = max([task.peak_memory for task in run])
+                io = max([task.io_rate for task in run])
+            else:
+                wall = total = memory = io = 0.
+            print "%-22s %6d %6d %6d %12.1f %12.1f %10.1f %10.1f" % (stage, len(tasks), cached, failed, wall, total, memory, io)
+
+
+def physical_cores():
+    """Number of physical cores of the machine.
+    """
+    try:
+        lines = subprocess.check_output(['lscpu', '-p']).splitlines()
+        cores = set([tuple(line.split(',')[1:4]) for line in lines if not line.startswith('#')])
+        return len(cores)
+    except (OSError, subprocess.CalledProcessError):
+        return mp.cpu_count()
+
+
+def state_file(out_dir, pipeline, from_scratch=False):
+    """Name of the state file of a pipeline, removing it to start from scratch.
+    """
+    filename = os.path.join(out_dir, '%s_state.json' % pipeline)
+    if from_scratch and os.path.isfile(filename): os.remove(filename)
+    return filename
+
+
+def identify(args):
+    """Pipeline to search a subbanded fits file (formerly FRB121102_*_1.sh).
+    """
+    fits_name = os.path.basename(args.fits)
+    if fits_name.endswith('_subs_0001.fits'): fits_id = fits_name[:-len('_subs_0001.fits')]
+    else: fits_id = os.path.splitext(fits_name)[0]
+    fits_file = os.path.join(args.sub_dir, fits_name)
+    out_dir = os.path.join(args.out_dir, fits_id)
+    temp_dir = os.path.join(out_dir, 'TEMP')
+
+    #Check that subbanded fits file exists
+    if not os.path.isfile(fits_file):
+        print ""
+        print "ATTENTION! Subbanded fits file %s not found. Exiting..." % fits_name
+        return 1
+
+    #Set up the output folder
+    for folder in ['obs_data', 'pulses', 'periodic_cands', 'TEMP']:
+        if not os.path.isdir(os.path.join(out_dir, folder)): os.makedirs(os.path.join(out_dir, folder))
+
+    pipeline = Pipeline(ncpus=args.ncpus, quiet=not args.verbose, state_file=state_file(out_dir, 'identify', args.from_scratch), \
+                        memory=args.memory, io=args.io_bandwidth, footprints_file=args.footprints or os.path.join(args.out_dir, FOOTPRINTS_FILE))
+    #DM trials: a single range, or a de-dispersion plan computed from the fits header
+    if args.hidm is None:
+        steps = [dm_plan.PlanStep(args.lodm, args.dmstep, args.numdms, args.downsamp)]
+        nsamp = 1
+    else:
+        params = dm_plan.fits_parameters(fits_file)
+        steps = dm_plan.plan(args.lodm, args.hidm, params['f_ctr'], params['bw'], params['nchan'], params['tsamp'], smearing=args.smearing, nsub=args.nsub)
+        nsamp = params['nsamp']
+        print dm_plan.describe(steps, nsamp)
+
+    accel_tasks = []
+    sp_tasks = []
+    best_dm = []
+    #The prepsubband calls are grouped in jobs of balanced cost
+    for i, job in enumerate(dm_plan.partition(steps, nsamp, args.prepsubband_jobs)):
+        bases = ['%s_TOPO_DM%.2f' % (fits_id, call.lodm + n * call.dmstep) for call in job for n in range(call.numdms)]
+
+        #Create .dat files
+        calls = []
+        for call in job:
+            command = "python %s -nsub %d -noscales -nooffsets -noweights -nobary -lodm %.2f -numdms %d -dmstep %s -o %s_TOPO -zerodm %s" % \
+                      (os.path.join(SCRIPT_DIR, 'prepsubband_call.py'), args.nsub, call.lodm, call.numdms, call.dmstep, fits_id, fits_file)
+            if call.downsamp > 1: command += " -downsamp %d" % call.downsamp
+            calls.append(command)
+        prep = pipeline.add('prepsubband_%d' % i, ' && '.join(calls), 'prepsubband', cwd=temp_dir, \
+                            inputs=[fits_file], outputs=[base + ext for base in bases for ext in ['.dat', '.inf']])
+
+        for base in bases:
+            #Periodicity search: .fft files, rednoise removal and ACCEL files
+            fft = pipeline.add('realfft_' + base, 'realfft %s.dat' % base, 'realfft', deps=[prep], cwd=temp_dir, outputs=[base + '.fft'])
+            red = pipeline.add('rednoise_' + base, 'rednoise %s.fft && cp %s.inf %s_red.inf' % (base, base, base), 'rednoise', deps=[fft], cwd=temp_dir, \
+                               outputs=[base + '_red.fft', base + '_red.inf'])
+            accel_tasks.append(pipeline.add('accelsearch_' + base, 'accelsearch -zmax 20 %s_red.fft' % base, 'accelsearch', deps=[red], cwd=temp_dir, \
+                                            outputs=[base + '_red_ACCEL_20']))
+
+            #Create .singlepulse files
+            sp_tasks.append(pipeline.add('single_pulse_search_' + base, 'single_pulse_search.py -t 6.0 -b -m 150 %s.dat' % base, 'single_pulse_search', \
+                                         deps=[prep], cwd=temp_dir, outputs=[base + '.singlepulse']))
+
+            #Saving best DM timeseries
+            if base == '%s_TOPO_DM%.2f' % (fits_id, args.best_dm):
+                best_dm.append(pipeline.add('obs_data', 'cp %s.dat %s.inf %s' % (base, base, os.path.join(out_dir, 'obs_data')), 'obs_data', deps=[prep], cwd=temp_dir, \
+                                            outputs=[os.path.join(out_dir, 'obs_data', base + ext) for ext in ['.dat', '.inf']]))
+
+    #Single pulse candidates
+    pipeline.add('pulses_extract', "python %s -db_name %s.hdf5 -fits %s -store_events -idL %s_TOPO -store_dir %s -folder %s -plot_pulses -plot_statistics -parameters_id %s" % \
+                 (os.path.join(SCRIPT_DIR, 'pulses_extract.py'), fits_id, fits_file, fits_id, os.path.join(out_dir, 'pulses'), temp_dir, args.parameters_id), \
+                 'pulses_extract', deps=sp_tasks + best_dm, cwd=temp_dir, inputs=[os.path.join(SCRIPT_DIR, 'obs_parameters.py')], \
+                 outputs=[os.path.join(out_dir, 'pulses', '%s.hdf5' % fits_id)])
+
+    #Periodic candidates
+    pipeline.add('periodic_candidates', "python %s -folder %s -fits %s && for plot in `ls *periodic_cand*.ps`; do convert -rotate 90 -background white -alpha remove $plot %s/${plot%%.ps}.png; done" % \
+                 (os.path.join(SCRIPT_DIR, 'periodic_candidates_plot.py'), temp_dir, fits_file, os.path.join(out_dir, 'periodic_cands')), \
+                 'periodic_candidates', deps=accel_tasks, cwd=temp_dir)
+
+    failed = pipeline.run()
+    pipeline.report()
+
+    #The meta products are kept by default, so that the following runs only compute again the stages that changed
+    if not failed and args.clean_temp:
+        shutil.rmtree(temp_dir)
+
+    return len(failed) > 0
+
+
+def chop(args):
+    """Pipeline to extract raw data around the ranked pulses (formerly FRB121102_*_2.sh).
+    """
+    obs_id = args.obs_id
+    out_dir = os.path.join(args.out_dir, obs_id)
+    pulses_dir = os.path.join(out_dir, 'pulses')
+    db_file = '%s.hdf5' % obs_id
+    cal_file = '%s%04d_cal_0001.fits' % (obs_id[:-4], int(obs_id[-4:]) - 1)
+    fits_name = '%s_subs_0001.fits' % obs_id
+    pulses_txt = os.path.join(pulses_dir, '%s_pulses.txt' % obs_id)
+
+    #Check that database exists
+    if not os.path.isfile(os.path.join(pulses_dir, db_file)):
+        print ""
+        print "ATTENTION! HDF5 database %s not found. Exiting..." % db_file
+        return 1
+    #Check that the calibration file exists
+    if not os.path.isfile(os.path.join(args.raw_dir, cal_file)):
+        print ""
+        print "ATTENTION! Calibration file %s not found." % cal_file
+        if args.no_cal:
+            print "-no_cal option detected. Processing will continue."
+            print ""
+        else:
+            print "Exiting..."
+            return 1
+    #Check that subbanded fits file exists
+    if not os.path.isfile(os.path.join(args.sub_dir, fits_name)):
+        print ""
+        print "ATTENTION! Subbanded fits file %s not found. Exiting..." % fits_name
+        return 1
+
+    #Move RFI pulses in RFI folder
+    rfi_dir = os.path.join(pulses_dir, 'RFI_pulses')
+    if not os.path.isdir(rfi_dir):
+        os.makedirs(rfi_dir)
+    else:
+        for puls in os.listdir(rfi_dir): shutil.move(os.path.join(rfi_dir, puls), pulses_dir)
+    with open(pulses_txt) as f:
+        for line in f:
+            fields = line.split('\t')
+            if len(fields) > 1 and fields[1].strip() == '2' and os.path.exists(os.path.join(pulses_dir, fields[0])):
+                shutil.move(os.path.join(pulses_dir, fields[0]), rfi_dir)
+    if args.ranking_backup: shutil.copy(pulses_txt, args.ranking_backup)
+
+    pipeline = Pipeline(ncpus=args.ncpus, quiet=not args.verbose, state_file=state_file(out_dir, 'chop', args.from_scratch), \
+                        memory=args.memory, io=args.io_bandwidth, footprints_file=args.footprints or os.path.join(args.out_dir, FOOTPRINTS_FILE))
+
+    #Copy subbanded file and calibrator
+    obs_data = os.path.join(out_dir, 'obs_data')
+    if not os.path.isdir(obs_data): os.makedirs(obs_data)
+    if os.path.isfile(os.path.join(args.raw_dir, cal_file)) and not os.path.isfile(os.path.join(obs_data, cal_file)):
+        pipeline.add('copy_calibrator', 'cp %s %s' % (os.path.join(args.raw_dir, cal_file), obs_data), 'copy', \
+                     outputs=[os.path.join(obs_data, cal_file)])
+    if not os.path.isfile(os.path.join(obs_data, fits_name)):
+        pipeline.add('copy_subbanded', 'cp %s %s' % (os.path.join(args.sub_dir, fits_name), obs_data), 'copy', \
+                     outputs=[os.path.join(obs_data, fits_name)])
+
+    #Create raw fits files and psrarchive files
+    extract = pipeline.add('extract_raw', "python %s -db_name %s -pulses_database -pulses_checked %s -store_dir %s -extract_raw %s -plot_statistics" % \
+                           (os.path.join(SCRIPT_DIR, 'pulses_extract.py'), db_file, pulses_txt, pulses_dir, os.path.join(args.raw_dir, obs_id)), 'extract_raw', \
+                           inputs=[pulses_txt])
+    pipeline.add('create_psrchives', "python %s %s -fits_file '%s_*.fits' -obsPATH %s" % \
+                 (os.path.join(SCRIPT_DIR, 'create_psrchives.py'), os.path.join(pulses_dir, db_file), obs_id, pulses_dir), 'create_psrchives', deps=[extract])
+
+    failed = pipeline.run()
+    pipeline.report()
+
+    return len(failed) > 0
+
+
+def command_stage(command):
+    """Stage of a command of a jobs file: the name of the first script it runs, or of its program.
+    """
+    match = re.search(r'[^\s;&|]+\.(py|sh)\b', command)
+    if match: return os.path.basename(match.group(0))
+    return os.path.basename(command.split()[0])
+
+
+def run_jobs(args):
+    """Run the independent commands of a file, one per line (formerly parallel.sh).
+    """
+    footprints = args.footprints or os.path.join(os.path.dirname(os.path.abspath(args.jobs)), FOOTPRINTS_FILE)
+    pipeline = Pipeline(ncpus=args.ncpus, quiet=False, memory=args.memory, io=args.io_bandwidth, footprints_file=footprints)
+    with open(args.jobs) as f:
+        commands = [line.strip() for line in f if line.strip()]
+    for i, command in enumerate(commands):
+        pipeline.add('job_%d' % i, command, command_stage(command))
+
+    failed = pipeline.run()
+    if args.verbose: pipeline.report()
+
+    return len(failed) > 0
+
+
+def parser():
+    # Command-line options
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Pipelines to process Arecibo data of FRB121102.")
+    subparsers = parser.add_subparsers(dest='pipeline')
+
+    parser_identify = subparsers.add_parser('identify', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Identify interesting pulses, store them in a HDF5 database and produce diagnostic plots.")
+    parser_identify.add_argument('fits', help="Name of the subbanded fits file.")
+    parser_identify.add_argument('-sub_dir', help="Folder of the subbanded fits files.", default="/exports/data/puppi/FRB121102_processing/subbanded_data")
+    parser_identify.add_argument('-out_dir', help="Folder of the pipeline products.", default="/exports/data/puppi/FRB121102_processing/pipeline_products")
+    parser_identify.add_argument('-lodm', help="The lowest dispersion measure to de-disperse (cm^-3 pc).", type=float, default=461.0)
+    parser_identify.add_argument('-numdms', help="The number of DMs to de-disperse.", type=int, default=201)
+    parser_identify.add_argument('-dmstep', help="The stepsize in dispersion measure to use (cm^-3 pc).", type=float, default=1.0)
+    parser_identify.add_argument('-nsub', help="The number of sub-bands to use.", type=int, default=64)
+    parser_identify.add_argument('-downsamp', help="The number of neighboring bins to co-add.", type=int, default=1)
+    parser_identify.add_argument('-hidm', help="Highest DM. If set, the DM trials follow a de-dispersion plan from lodm to hidm computed from the fits header and -numdms, -dmstep and -downsamp are ignored.", type=float)
+    parser_identify.add_argument('-smearing', help="Maximum ratio between the total and the unavoidable smearing of the de-dispersion plan.", type=float, default=1.1)
+    parser_identify.add_argument('-prepsubband_jobs', help="Number of prepsubband jobs of balanced cost the DM trials are split into.", type=int, default=1)
+    parser_identify.add_argument('-best_dm', help="DM of the time series saved in obs_data.", type=float, default=561.0)
+    parser_identify.add_argument('-parameters_id', help="Name of the parameter set of pulses_extract.py.", default='FRB121102_Puppi')
+
+    parser_chop = subparsers.add_parser('chop', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Use pulses stored in a HDF5 database to chop raw data around the pulses.")
+    parser_chop.add_argument('obs_id', help="ID of the observation.")
+    parser_chop.add_argument('-sub_dir', help="Folder of the subbanded fits files.", default="/psr_archive/hessels/hessels/AO-FRB/subbanded_data")
+    parser_chop.add_argument('-out_dir', help="Folder of the pipeline products.", default="/data/FRB121102/pipeline_products")
+    parser_chop.add_argument('-raw_dir', help="Folder of the raw fits files.", default="/psr_archive/hessels/hessels/AO-FRB/raw_data")
+    parser_chop.add_argument('-ranking_backup', help="Folder where a copy of the ranking of the pulses is stored.", default='')
+    parser_chop.add_argument('-no_cal', help="Ignore the calibration file.", action='store_true')
+
+    parser_identify.add_argument('-clean_temp', help="Remove the intermediate products in TEMP after a successful run (all the stages will run again in the next run).", action='store_true')
+
+    parser_run = subparsers.add_parser('run', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Run the independent commands of a file, one per line.")
+    parser_run.add_argument('jobs', help="Name of the file of commands.")
+    parser_run.add_argument('-v', '--verbose', help="Print the resources used by the commands.", action='store_true')
+
+    for subparser in [parser_identify, parser_chop]:
+        subparser.add_argument('-v', '--verbose', help="Show the output of the commands.", action='store_true')
+        subparser.add_argument('-from_scratch', help="Run all the tasks, ignoring the ones completed in previous runs.", action='store_true')
+    for subparser in [parser_identify, parser_chop, parser_run]:
+        subparser.add_argument('-ncpus', help="Number of tasks run in parallel (default: number of physical cores).", type=int, default=None)
+        subparser.add_argument('-single_core', help="Run one task at a time.", action='store_true')
+        subparser.add_argument('-memory', help="Memory available to the tasks in MB (default: 90%% of the memory available at start).", type=float, default=None)
+        subparser.add_argument('-io_bandwidth', help="Disk I/O bandwidth available to the tasks in MB/s (default: not limited).", type=float, default=None)
+        subparser.add_argument('-profile', help="Write a profile of the run (time and memory of each stage) in this folder, where the scripts run by the pipeline write theirs too.", \
+                               nargs='?', const='.', default=None)
+        subparser.add_argument('-footprints', help="JSON file of the memory and I/O footprints learned for each stage (default: footprints.json in the output folder, or next to the file of commands).", default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser()
+    if args.single_core: args.ncpus = 1
+    elif args.ncpus is None: args.ncpus = physical_cores()
+    if args.memory is None: args.memory = 0.9 * available_memory()
+    if args.profile is not None: profiling.enable(args.profile)
+
+    if args.pipeline == 'run': sys.exit(run_jobs(args))
+
+    print "Pipeline %s starting..." % args.pipeline
+    print time.ctime()
+    if args.pipeline == 'identify': code = identify(args)
+    else: code = chop(args)
+    print "Pipeline %s finished" % args.pipeline
+    print time.ctime()
+    sys.exit(code)
@@ -1,7 +1,9 @@
-import subprocess
 import argparse
+import sys
 import astropy.io.fits as pyfits
 
+import profiling
+
 def parser():
   # Command-line options
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -18,6 +20,7 @@ def parser():
   parser.add_argument('-nooffsets', help="Do not apply PSRFITS offsets.", action='store_true')
   parser.add_argument('-noscales', help="Do not apply PSRFITS scales.", action='store_true')
   parser.add_argument('-nsub', help="The number of sub-bands to use.", type=int)
+  parser.add_argument('-downsamp', help="The number of neighboring bins to co-add.", type=int)
   
   return parser.parse_args()
   
@@ -37,6 +40,7 @@ def prepsubband(args):
     with pyfits.open(args.fits,memmap=True) as fits:
       header = fits['SUBINT'].header
       numout = header['NSBLK'] * header['NAXIS2']
+    if args.downsamp: numout /= args.downsamp
   if numout % 2: numout += 1
   argument_list.append('-numout')
   argument_list.append(str(numout))
@@ -49,18 +53,20 @@ def prepsubband(args):
   if args.nsub: 
     argument_list.append('-nsub')
     argument_list.append(str(args.nsub))
+  if args.downsamp: 
+    argument_list.append('-downsamp')
+    argument_list.append(str(args.downsamp))
   if args.nobary: argument_list.append('-nobary')
   if args.noweights: argument_list.append('-noweights')
   if args.nooffsets: argument_list.append('-nooffsets')
   if args.noscales: argument_list.append('-noscales')
   argument_list.append(args.fits)
   
-  subprocess.call(argument_list)
-  return
+  return profiling.call(argument_list)
 
 if __name__ == '__main__':
   args = parser()
-  prepsubband(args)
+  sys.exit(prepsubband(args))
   
   
   
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""
+profiling.py
+
+Instrumentation of the pipeline: timers, counters and peak memory of the
+main functions and of the external programs (subprocess stages).
+It is disabled unless the environment variable PULSES_PROFILE is set or
+enable() is called (e.g. by the -profile option of the scripts), so that
+the instrumented functions only cost a check of a flag.
+PULSES_PROFILE is the folder where the profiles are written ('1' for the
+current folder). Since it is inherited, the scripts run by a profiled
+pipeline are profiled too.
+
+Each profiled process writes at exit
+    profile_<script>_<date>_<pid>.json
+    profile_<script>_<date>_<pid>.csv
+with, for each timer, the number of calls, the total, mean, minimum and
+maximum time and the peak resident memory sampled while it was running,
+and the value of each counter. The functions run in worker processes of
+a multiprocessing.Pool are included in the profile of the parent process.
+
+"""
+
+import atexit
+import csv
+import functools
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+ENV_VAR = 'PULSES_PROFILE'
+
+#Seconds between two samples of the resident memory
+SAMPLING_INTERVAL = 0.1
+
+_enabled = False
+_base_name = None
+_start = None
+_parent = None
+_pid = None
+_timers = OrderedDict()
+_counters = OrderedDict()
+_active = {}
+_lock = threading.Lock()
+_local = threading.local()
+_sampler = None
+
+
+def current_memory():
+    """Resident memory of the process (MB).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.**2
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _sample():
+    #Update the peak memory of the sections running in the process
+    while True:
+        memory = current_memory()
+        with _lock:
+            for peak in _active.values():
+                peak[0] = max(peak[0], memory)
+        time.sleep(SAMPLING_INTERVAL)
+
+
+def _check_process():
+    #Processes forked from the profiled one (e.g. pool workers) start with empty
+    #records and their own sampler, and store them in a part of the parent's profile
+    global _pid, _sampler
+    if os.getpid() == _pid: return
+    _pid = os.getpid()
+    _timers.clear()
+    _counters.clear()
+    _active.clear()
+    _sampler = threading.Thread(target=_sample)
+    _sampler.daemon = True
+    _sampler.start()
+
+
+def enable(folder=None):
+    """Start profiling the process.
+
+        Inputs:
+            folder: Folder of the profile files (Default: value of PULSES_PROFILE, or current folder).
+                It is also stored in PULSES_PROFILE, so that the subprocesses are profiled too.
+
+        Outputs:
+            None
+    """
+    global _enabled, _base_name, _start, _parent
+    if _enabled: return
+    if folder is None: folder = os.environ.get(ENV_VAR, '')
+    if folder in ['', '1']: folder = os.getcwd()
+    folder = os.path.abspath(folder)
+    if not os.path.isdir(folder): os.makedirs(folder)
+    os.environ[ENV_VAR] = folder
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if not script or script.startswith('-'): script = 'python'
+    _base_name = os.path.join(folder, 'profile_%s_%s_%d' % (script, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    _start = time.time()
+    _parent = os.getpid()
+    _enabled = True
+    _check_process()
+    atexit.register(write)
+
+
+def enabled():
+    return _enabled
+
+
+def record(name, duration, peak_memory=None):
+    """Add a call of 'duration' seconds to a timer.
+    """
+    if not _enabled: return
+    _check_process()
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = {'calls': 0, 'total': 0., 'min': duration, 'max': duration, 'peak_memory': 0.}
+        timer['calls'] += 1
+        timer['total'] += duration
+        timer['min'] = min(timer['min'], duration)
+        timer['max'] = max(timer['max'], duration)
+        if peak_memory is not None: timer['peak_memory'] = max(timer['peak_memory'], peak_memory)
+    #Worker processes may be terminated without running atexit
+    if os.getpid() != _parent and getattr(_local, 'depth', 0) == 0: _write_part()
+
+
+def count(name, value=1):
+    """Increase a counter.
+    """
+    if not _enabled: return
+    _check_process()
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextmanager
+def timer(name):
+    """Time a block of code and sample its peak memory.
+    """
+    if not _enabled:
+        yield
+        return
+    _check_process()
+    key = object()
+    peak = [current_memory()]
+    with _lock:
+        _active[key] = peak
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        with _lock:
+            del _active[key]
+        _local.depth -= 1
+        record(name, duration, max(peak[0], current_memory()))
+
+
+def profile(name):
+    """Decorator timing every call of a function under the timer 'name'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled: return func(*args, **kwargs)
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def call(command, name=None, **kwargs):
+    """subprocess.call recording the time and peak memory of the program under the timer 'name'
+        (Default: name of the program).
+    """
+    if not _enabled: return subprocess.call(command, **kwargs)
+    if name is None:
+        if isinstance(command, basestring): name = command.split()[0]
+        else: name = command[0]
+        name = os.path.basename(name)
+    start = time.time()
+    proc = subprocess.Popen(command, **kwargs)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status): proc.returncode = -os.WTERMSIG(status)
+    else: proc.returncode = os.WEXITSTATUS(status)
+    count('subprocess_failures', proc.returncode != 0)
+    record(name, time.time() - start, rusage.ru_maxrss / 1024.)
+    return proc.returncode
+
+
+def _write_part():
+    with _lock:
+        content = {'timers': _timers, 'counters': _counters}
+        temp_name = '%s.%d.part.tmp' % (_base_name, os.getpid())
+        with open(temp_name, 'w') as f:
+            json.dump(content, f)
+    os.rename(temp_name, '%s.%d.part' % (_base_name, os.getpid()))
+
+
+def _merge_parts():
+    #Add the records of the worker processes to the ones of the parent
+    for part_name in glob.glob('%s.*.part' % _base_name):
+        with open(part_name) as f:
+            part = json.load(f)
+        for name, t in part['timers'].items():
+            timer = _timers.setdefault(name, {'calls': 0, 'total': 0., 'min': t['min'], 'max': t['max'], 'peak_memory': 0.})
+            timer['calls'] += t['calls']
+            timer['total'] += t['total']
+            timer['min'] = min(timer['min'], t['min'])
+            timer['max'] = max(timer['max'], t['max'])
+            timer['peak_memory'] = max(timer['peak_memory'], t['peak_memory'])
+        for name, value in part['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+        os.remove(part_name)
+
+
+def write():
+    """Write the profile of the run in JSON and CSV files.
+    """
+    if not _enabled or os.getpid() != _parent: return
+    _merge_parts()
+    for timer in _timers.values():
+        timer['mean'] = timer['total'] / timer['calls']
+    profile = OrderedDict([('script', sys.argv[0]), ('argv', sys.argv[1:]), ('host', os.uname()[1]),
+        ('start', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(_start))), ('wall', time.time() - _start),
+        ('peak_memory', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.),
+        ('children_peak_memory', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.),
+        ('timers', _timers), ('counters', _counters)])
+    with open(_base_name + '.json', 'w') as f:
+        json.dump(profile, f, indent=1)
+    with open(_base_name + '.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'calls', 'total_s', 'mean_s', 'min_s', 'max_s', 'peak_memory_MB', 'count'])
+        writer.writerow(['wall', 1, '%.6f' % profile['wall'], '', '', '', '%.1f' % profile['peak_memory'], ''])
+        for name, t in sorted(_timers.items(), key=lambda item: -item[1]['total']):
+            writer.writerow([name, t['calls'], '%.6f' % t['total'], '%.6f' % t['mean'], '%.6f' % t['min'], '%.6f' % t['max'], '%.1f' % t['peak_memory'], ''])
+        for name, value in _counters.items():
+            writer.writerow([name, '', '', '', '', '', '', value])
+    print "Profile written in %s.json" % _base_name
+
+
+if os.environ.get(ENV_VAR): enable()
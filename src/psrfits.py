@@ -21,6 +21,7 @@ import astropy.time as aptime
 import numpy as np
 import psr_utils
 import spectra
+import profiling
 
 # Regular expression for parsing DATE-OBS card's format.
 date_obs_re = re.compile(r"^(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-" \
@@ -175,6 +176,7 @@ class PsrfitsFile(object):
         """
         return self.fits['SUBINT'].data[isub]['DAT_OFFS']
 
+    @profiling.profile('PsrfitsFile.get_spectra')
     def get_spectra(self, startsamp, N):
         """Return 2D array of data from PSRFITS file.
  
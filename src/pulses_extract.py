@@ -13,6 +13,8 @@ from astropy.io import fits as pyfits
 
 import C_Funct
 import auto_waterfaller
+import sp_search
+import profiling
 from extract_psrfits_subints import extract_subints_from_observation
 from obs_parameters import parameters
 
@@ -37,13 +39,22 @@ def parser():
   parser.add_argument('-parameters_id', help="Parameters to search the observation defined in obs_parameters.", default='Default')
   parser.add_argument('-store_dir', help="Path of the folder to store the output.", default='.')
   parser.add_argument('-plot_pulses', help="Save plots of detected pulses.", action='store_true')
+  parser.add_argument('-plot_dm_time', help="Save also DM-time plots of detected pulses.", action='store_true')
+  parser.add_argument('-plot_resolution', help="Resolution of the plots of detected pulses: full or small thumbnails for triage.", default='thumbnail',
+                      choices=['full', 'thumbnail'])
+  parser.add_argument('-plot_promoted', help="Save full resolution plots (*_full.png) of the pulses ranked as 0 or 1.", action='store_true')
+  parser.add_argument('-plot_ncpus', help="Number of processes used to plot the pulses.", default=1, type=int)
   parser.add_argument('-extract_raw', help="Extract raw data specified in this path around detected pulses.", default='')
+  parser.add_argument('-extract_ncpus', help="Number of threads writing the raw data extracted around the pulses.", default=1, type=int)
   parser.add_argument('-pulses_checked', help="Path of a text file containig a list of pulse identifiers to label as RFI.", default='')
   parser.add_argument('-plot_statistics', help="Produce plots with statistics of the pulses.", action='store_true')
   parser.add_argument('-beam_num', help="Number ID of the beam.", type=int, default=None)
   parser.add_argument('-group_num', help="Number ID of the group of beams (i.e. subband).", type=int, default=None)
   parser.add_argument('-beam_comparison', help="Path of databases to merge and compare.", default=None)
   parser.add_argument('-no_RFI', help="Do not select RFI instances.", action='store_false')
+  parser.add_argument('-search_fits', help="Search the .fits file for events in memory instead of loading .singlepulse files.", action='store_true')
+  parser.add_argument('-nsub', help="Number of subbands used to dedisperse the .fits file with -search_fits.", default=64, type=int)
+  parser.add_argument('-profile', help="Write a profile of the run (time and memory of the main functions) in this folder.", nargs='?', const='.', default=None)
   return parser.parse_args()
   
   
@@ -84,21 +95,19 @@ def main(args):
     
   if args.plot_pulses: 
     if pulses.shape[0] > 0:
-      database_path = os.path.join(args.store_dir,args.db_name)
-      params = parameters[args.parameters_id]
-      if (args.parameters_id == "FRB130628_Alfa_s0") or (args.parameters_id == "FRB130628_Alfa_s1"):
-        auto_waterfaller.main(args.fits, database_path, np.array(pulses.Time), np.array(pulses.DM), np.array(pulses.IMJD), np.array(pulses.SMJD), np.array(pulses.Sigma), \
-                                             duration=np.array(pulses.Duration), top_freq=pulses.top_Freq.iloc[0], \
-                                             FRB_name=params['FRB_name'], directory=args.store_dir, \
-                                             pulse_id=np.array(pulses.index), beam=np.array(pulses.Beam), group=np.array(pulses.Group))
-      else:  
-        auto_waterfaller.main(args.fits, database_path, np.array(pulses.Time), np.array(pulses.DM), np.array(pulses.IMJD), np.array(pulses.SMJD), np.array(pulses.Sigma), \
-                                             duration=np.array(pulses.Duration), top_freq=pulses.top_Freq.iloc[0], \
-                                             FRB_name=params['FRB_name'], directory=args.store_dir, pulse_id=np.array(pulses.index))
+      candidate_plots(args, pulses, resolution=args.plot_resolution)
+
+  if args.plot_promoted:
+    #Full resolution plots are produced on demand only for the pulses ranked as real
+    promoted = pulses[(pulses.Pulse == 0) | (pulses.Pulse == 1)]
+    if promoted.shape[0] > 0:
+      candidate_plots(args, promoted, resolution='promoted')
   
   if args.extract_raw: 
     real_pulses = pulses[(pulses.Pulse == 0) | (pulses.Pulse == 1) | (pulses.Pulse == 3)]
-    extract_subints_from_observation(args.extract_raw, args.store_dir, np.array(real_pulses.Time), -2, 8, pulseID=np.array(real_pulses.index).astype(str))
+    with profiling.timer('extract_raw'):
+      extract_subints_from_observation(args.extract_raw, args.store_dir, np.array(real_pulses.Time), -2, 8, pulseID=np.array(real_pulses.index).astype(str),
+                                       ncpus=args.extract_ncpus)
   
   if args.plot_statistics: 
     if args.pulses_checked: ranked = True
@@ -111,28 +120,59 @@ def main(args):
   return
 
 
+def candidate_plots(args, pulses, resolution='full'):
+  #Plot the pulses with auto_waterfaller
+  database_path = os.path.join(args.store_dir,args.db_name)
+  params = parameters[args.parameters_id]
+  if (args.parameters_id == "FRB130628_Alfa_s0") or (args.parameters_id == "FRB130628_Alfa_s1"):
+    auto_waterfaller.main(args.fits, database_path, np.array(pulses.Time), np.array(pulses.DM), np.array(pulses.IMJD), np.array(pulses.SMJD), np.array(pulses.Sigma), \
+                                         duration=np.array(pulses.Duration), top_freq=pulses.top_Freq.iloc[0], \
+                                         FRB_name=params['FRB_name'], directory=args.store_dir, \
+                                         pulse_id=np.array(pulses.index), beam=np.array(pulses.Beam), group=np.array(pulses.Group), \
+                                         plot_dm_time=args.plot_dm_time, ncpus=args.plot_ncpus, resolution=resolution)
+  else:  
+    auto_waterfaller.main(args.fits, database_path, np.array(pulses.Time), np.array(pulses.DM), np.array(pulses.IMJD), np.array(pulses.SMJD), np.array(pulses.Sigma), \
+                                         duration=np.array(pulses.Duration), top_freq=pulses.top_Freq.iloc[0], \
+                                         FRB_name=params['FRB_name'], directory=args.store_dir, pulse_id=np.array(pulses.index), \
+                                         plot_dm_time=args.plot_dm_time, ncpus=args.plot_ncpus, resolution=resolution)
+  return
+
+
+@profiling.profile('events_database')
 def events_database(args, header):
   #Create events database
   params = parameters[args.parameters_id]
-  sp_files = glob.glob(os.path.join(args.folder,'{}*.singlepulse'.format(args.idL)))
-  events = pd.concat(pd.read_csv(f, delim_whitespace=True, dtype=np.float64) for f in sp_files if os.stat(f).st_size > 0)
-  print "Loaded {} events.".format(events.shape[0])
-  events.reset_index(drop=True, inplace=True)
-  events.columns = ['DM','Sigma','Time','Sample','Downfact','a','b']
-  events = events.ix[:,['DM','Sigma','Time','Sample','Downfact']]
-  events.index.name = 'idx'
-  events['Pulse'] = 0
-  events.Pulse = events.Pulse.astype(np.int32)
-
-  #Correct Downfact value including downsample of prepsubband
-  try:
-    dv = params['down_values']
-    df = events.Downfact * 0
-    df[events.DM < min(dv)] = 1
-    for i in sorted(dv):
-      df[events.DM >= i] = dv[i]
-    events.Downfact *= df
-  except KeyError: pass
+  if args.search_fits:
+    #Dedisperse and search the fits file in memory
+    dms = sp_search.dm_trials(params['DM_low'], params['DM_high'], args.DM_step)
+    events = sp_search.search_observation(args.fits, dms, nsub=args.nsub, threshold=params['SNR_min'], 
+                                          max_downfact=params['Downfact_max'], zerodm=True)
+    events = pd.DataFrame(events, columns=['DM','Sigma','Time','Sample','Downfact'])
+    print "Found {} events.".format(events.shape[0])
+    events.index.name = 'idx'
+    events['Pulse'] = 0
+    events.Pulse = events.Pulse.astype(np.int32)
+  
+  else:
+    sp_files = glob.glob(os.path.join(args.folder,'{}*.singlepulse'.format(args.idL)))
+    events = pd.concat(pd.read_csv(f, delim_whitespace=True, dtype=np.float64) for f in sp_files if os.stat(f).st_size > 0)
+    print "Loaded {} events.".format(events.shape[0])
+    events.reset_index(drop=True, inplace=True)
+    events.columns = ['DM','Sigma','Time','Sample','Downfact','a','b']
+    events = events.ix[:,['DM','Sigma','Time','Sample','Downfact']]
+    events.index.name = 'idx'
+    events['Pulse'] = 0
+    events.Pulse = events.Pulse.astype(np.int32)
+
+    #Correct Downfact value including downsample of prepsubband
+    try:
+      dv = params['down_values']
+      df = events.Downfact * 0
+      df[events.DM < min(dv)] = 1
+      for i in sorted(dv):
+        df[events.DM >= i] = dv[i]
+      events.Downfact *= df
+    except KeyError: pass
   
   events.Downfact = events.Downfact.astype(np.int16)
   events.Sample = events.Sample.astype(np.int32)
@@ -142,19 +182,22 @@ def events_database(args, header):
   obs_length = header['NSBLK'] * header['NAXIS2'] * header['TBIN']
   events = events[events.Time < obs_length-10.]
 
-  C_Funct.Get_Group(events.DM.values, events.Sigma.values, events.Time.values, events.Pulse.values, 
-                    args.events_dDM, args.events_dt, args.DM_step)
+  profiling.count('events', events.shape[0])
+  with profiling.timer('Get_Group'):
+    C_Funct.Get_Group(events.DM.values, events.Sigma.values, events.Time.values, events.Pulse.values, 
+                      args.events_dDM, args.events_dt, args.DM_step)
 
   #events = events[events.Pulse >= 0]
 
   if args.store_events:
     store = pd.HDFStore(os.path.join(args.store_dir,args.db_name), 'w')
-    store.append('events',events,data_columns=['Pulse','SAP','BEAM','DM','Time'])
+    store_events(store, events)
     store.close()
     
   return events
   
   
+@profiling.profile('pulses_database')
 def pulses_database(args, header, events=None):
   #Create pulses database
   if args.events_database: events = pd.read_hdf(os.path.join(args.store_dir,args.db_name),'events')
@@ -191,6 +234,7 @@ def pulses_database(args, header, events=None):
 
   n_pulses = pulses.shape[0] #zeroth order pulses
   print "Selected {} pulses.".format(n_pulses)
+  profiling.count('pulses', n_pulses)
   
   if n_pulses > 0 and args.no_RFI:
     RFIexcision(events, pulses, params, args) #1st order
@@ -204,6 +248,7 @@ def pulses_database(args, header, events=None):
   pulses.sort_values(['Pulse','Sigma'], ascending=False, inplace=True) 
   return pulses #2nd (final) order
 
+@profiling.profile('RFIexcision')
 def RFIexcision(events, pulses, params, args):
   RFI_code = 9
   events = events[events.Pulse.isin(pulses.index)]
@@ -330,11 +375,21 @@ def beam_comparison(hdf5_in='*.hdf5', hdf5_out='SinglePulses.hdf5'):
   pulses.Pulse[pulses.apply(lambda x: comparison(x), axis=1)] = 8
   
   pulses.to_hdf(hdf5_out, 'pulses')
-  events.to_hdf(hdf5_out, 'events')
+  store = pd.HDFStore(hdf5_out, 'a')
+  if 'events' in store: store.remove('events')
+  store_events(store, events)
+  store.close()
   return
 
 
+def store_events(store, events):
+  #Events are stored sorted by pulse and indexed on Pulse, so that the events of a single pulse can be selected without reading the table
+  store.append('events', events.sort_values('Pulse', kind='mergesort'), data_columns=['Pulse','SAP','BEAM','DM','Time'])
+  store.create_table_index('events', columns=['Pulse'], optlevel=9, kind='full')
+
+
 if __name__ == '__main__':
   args = parser()
+  if args.profile is not None: profiling.enable(args.profile)
   main(args)
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+ranking.py
+
+Store of the ranking decisions taken while reviewing the candidates
+of an observation. Each decision is written to a SQLite database as
+soon as it is taken, so that an interrupted session can be resumed
+from the last ranked pulse. The decisions are exported on demand to
+the text formats used by viewer.py and by pulses_extract.py
+(-pulses_checked).
+
+"""
+
+import os
+import sqlite3
+import time
+
+
+class RankingSession(object):
+    """A ranking session of a list of pulses stored in a SQLite database.
+    """
+    def __init__(self, filename):
+        """RankingSession constructor.
+
+            Inputs:
+                filename: Name of the SQLite database. It is created
+                    if it does not exist, otherwise the session is resumed.
+
+            Output:
+                session: RankingSession object.
+        """
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pulses ("
+                        "pulse_id INTEGER PRIMARY KEY, "
+                        "position INTEGER, "
+                        "rank INTEGER, "
+                        "components INTEGER DEFAULT 0, "
+                        "bursts INTEGER DEFAULT 0, "
+                        "comment TEXT DEFAULT '', "
+                        "ranked_at REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pulses_position ON pulses (position)")
+        self.db.commit()
+
+    def add_pulses(self, pulse_ids, ranks=None):
+        """Add pulses to the session in the order they will be reviewed.
+            Pulses already in the session are left untouched.
+
+            Inputs:
+                pulse_ids: List of pulse identifiers.
+                ranks: Initial rank of each pulse (Default: -1).
+
+            Outputs:
+                None
+        """
+        if ranks is None:
+            ranks = [-1] * len(pulse_ids)
+        start = self.db.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM pulses").fetchone()[0]
+        self.db.executemany("INSERT OR IGNORE INTO pulses (pulse_id, position, rank) VALUES (?, ?, ?)",
+                            [(int(p), start + i, int(r)) for i, (p, r) in enumerate(zip(pulse_ids, ranks))])
+        self.db.commit()
+
+    def rank(self, pulse_id, rank=None, components=None, bursts=None, comment=None):
+        """Record the decision taken for a pulse.
+
+            Inputs:
+                pulse_id: Pulse identifier.
+                rank: Rank of the pulse (e.g. 0 real, 1 smudge, 2 RFI, 3 maybe).
+                components: Number of additional components.
+                bursts: Number of additional bursts.
+                comment: Free text.
+
+            Outputs:
+                None
+        """
+        if isinstance(comment, str):
+            comment = comment.decode('utf-8', 'replace')
+        values = [('rank', rank), ('components', components), ('bursts', bursts), ('comment', comment)]
+        values = [(k, v) for k, v in values if v is not None] + [('ranked_at', time.time())]
+        self.db.execute("UPDATE pulses SET %s WHERE pulse_id = ?" % ', '.join(['%s = ?' % k for k, v in values]),
+                        [v for k, v in values] + [int(pulse_id)])
+        self.db.commit()
+
+    def pending(self, start=None):
+        """Return the identifiers of the pulses not ranked yet, in review order.
+
+            Inputs:
+                start: Skip the pulses before this pulse identifier (Default: None).
+
+            Outputs:
+                pulse_ids: List of pulse identifiers.
+
+            Raises KeyError if 'start' is not a pulse of the session.
+        """
+        position = -1
+        if start is not None:
+            row = self.db.execute("SELECT position FROM pulses WHERE pulse_id = ?", (int(start),)).fetchone()
+            if row is None:
+                raise KeyError("Pulse %s is not in the ranking session" % start)
+            position = row[0]
+        rows = self.db.execute("SELECT pulse_id FROM pulses WHERE ranked_at IS NULL AND position >= ? "
+                               "ORDER BY position", (position,))
+        return [r[0] for r in rows]
+
+    def progress(self):
+        """Return the number of ranked pulses and the total number of pulses.
+        """
+        return self.db.execute("SELECT COUNT(ranked_at), COUNT(*) FROM pulses").fetchone()
+
+    def decisions(self, ranked_only=False):
+        """Return the (pulse_id, rank, components, bursts, comment) of the pulses in review order.
+        """
+        query = "SELECT pulse_id, rank, components, bursts, comment FROM pulses"
+        if ranked_only:
+            query += " WHERE ranked_at IS NOT NULL"
+        return self.db.execute(query + " ORDER BY position").fetchall()
+
+    def export_ranks(self, filename, ranked_only=False):
+        """Write the ranks in the format of the '_pulses.txt' files,
+            which is also the input of pulses_extract.py -pulses_checked.
+
+            Inputs:
+                filename: Name of the output file.
+                ranked_only: Write only the pulses already ranked (Default: False).
+
+            Outputs:
+                None
+        """
+        with open(filename, 'w') as f:
+            f.write('# PulseID\tRank\n')
+            for pulse_id, rank, components, bursts, comment in self.decisions(ranked_only=ranked_only):
+                f.write('%d\t%d\n' % (pulse_id, rank))
+
+    def export_annotations(self, filename, ranked_only=False):
+        """Write the annotations in the format of the '_annotated.txt' files.
+
+            Inputs:
+                filename: Name of the output file.
+                ranked_only: Write only the pulses already ranked (Default: False).
+
+            Outputs:
+                None
+        """
+        with open(filename, 'w') as f:
+            f.write('# PulseID\tAdditional\tAdditional\tComment\n# \t\tcomponents\tbursts\n')
+            for pulse_id, rank, components, bursts, comment in self.decisions(ranked_only=ranked_only):
+                f.write('%d\t\t%d\t\t%d\t\t%s\n' % (pulse_id, components, bursts, comment.encode('utf-8')))
+
+    def close(self):
+        self.db.close()
+
+
+def session_name(txtfile):
+    """Name of the SQLite database of the ranking session of a list of candidates.
+    """
+    return os.path.splitext(txtfile)[0] + '_ranking.db'
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+"""
+review_server.py
+
+Local web server to review the candidates of an observation with a browser.
+It reads the 'pulses' table of the HDF5 database and the candidate plots
+produced by auto_waterfaller.py, serves paginated candidate grids that
+can be filtered by rank, DM and S/N, and records the ranks given by the
+reviewers in a ranking.RankingSession. Several reviewers can work on the
+same observation at the same time.
+
+The ranks are exported to the pulses_extract.py -pulses_checked format
+with 'viewer.py -export' or from /api/export.
+
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import cgi
+import email.utils
+import json
+import glob
+import os
+import threading
+import urllib
+import urlparse
+
+import numpy as np
+import pandas as pd
+
+import ranking
+
+RANK_LABELS = {-1: 'unranked', 0: 'real', 1: 'smudge', 2: 'RFI', 3: 'maybe'}
+
+
+class Candidates(object):
+    """Pulses of an observation, their plots and their ranks.
+    """
+    def __init__(self, database, plot_dir, session_file):
+        """Candidates constructor.
+
+            Inputs:
+                database: HDF5 database containing the 'pulses' table.
+                plot_dir: Folder containing one sub-folder of plots per pulse.
+                session_file: SQLite database of the ranking session.
+
+            Output:
+                candidates: Candidates object.
+        """
+        self.plot_dir = os.path.abspath(plot_dir)
+        self.session_file = session_file
+        self.lock = threading.Lock()
+
+        pulses = pd.read_hdf(database, 'pulses')
+        self.pulses = pulses[pulses.Pulse < 4].sort_index()
+
+        # Plots of each pulse, indexed once
+        self.images = {}
+        for path in sorted(glob.glob(os.path.join(self.plot_dir, '*', '*.png'))):
+            pulse_id = os.path.basename(os.path.dirname(path))
+            self.images.setdefault(pulse_id, []).append(os.path.basename(path))
+
+        session = ranking.RankingSession(session_file)
+        session.add_pulses(self.pulses.index, self.pulses.Pulse)
+        session.close()
+
+    def ranks(self):
+        """Return the current rank of each pulse as a pandas Series.
+        """
+        session = ranking.RankingSession(self.session_file)
+        decisions = session.decisions()
+        session.close()
+        ranks = pd.Series([d[1] for d in decisions], index=[d[0] for d in decisions])
+        return ranks.reindex(self.pulses.index).fillna(-1).astype(int)
+
+    def select(self, rank=None, dm_min=None, dm_max=None, snr_min=None, snr_max=None, sort='index'):
+        """Return the pulses passing the filters, with their current rank.
+        """
+        pulses = self.pulses.copy()
+        pulses['Rank'] = self.ranks()
+        if rank is not None:
+            pulses = pulses[pulses.Rank.isin(rank)]
+        if dm_min is not None:
+            pulses = pulses[pulses.DM >= dm_min]
+        if dm_max is not None:
+            pulses = pulses[pulses.DM <= dm_max]
+        if snr_min is not None:
+            pulses = pulses[pulses.Sigma >= snr_min]
+        if snr_max is not None:
+            pulses = pulses[pulses.Sigma <= snr_max]
+        if sort in ['Sigma', 'DM', 'Time']:
+            pulses = pulses.sort_values(sort, ascending=(sort != 'Sigma'))
+        return pulses
+
+    def main_image(self, pulse_id):
+        """Name of the standard plot of a pulse (not zoomed nor DM-time).
+        """
+        names = self.images.get(str(pulse_id), [])
+        for name in names:
+            if not name.endswith('zoomed.png') and not name.endswith('downsamped.png') \
+               and not name.endswith('dm_time.png') and not name.endswith('diagnostic.png') \
+               and not name.endswith('_full.png'):
+                return name
+        if names:
+            return names[0]
+        return None
+
+    def rank(self, pulse_id, rank):
+        """Record the rank of a pulse.
+        """
+        with self.lock:
+            session = ranking.RankingSession(self.session_file)
+            session.rank(pulse_id, rank=rank)
+            session.close()
+
+
+def filters(query):
+    """Read the filters of the candidate grid from the parsed query string.
+    """
+    def number(key):
+        try:
+            return float(query[key][0])
+        except (KeyError, ValueError):
+            return None
+    rank = None
+    if query.get('rank', [''])[0] != '':
+        try:
+            rank = [int(r) for r in query['rank'][0].split(',')]
+        except ValueError:
+            rank = None
+    return {'rank': rank, 'dm_min': number('dm_min'), 'dm_max': number('dm_max'),
+            'snr_min': number('snr_min'), 'snr_max': number('snr_max'),
+            'sort': query.get('sort', ['index'])[0]}
+
+
+def page_limits(query, n, per_page):
+    """Return the page number, the first and the last row of a page.
+    """
+    try:
+        page = max(int(query.get('page', ['0'])[0]), 0)
+    except ValueError:
+        page = 0
+    try:
+        per_page = min(max(int(query.get('per_page', [per_page])[0]), 1), 500)
+    except ValueError:
+        pass
+    return page, per_page, page * per_page, min((page + 1) * per_page, n)
+
+
+class ReviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Requests of the review server.
+
+        GET  /                        candidate grid (HTML)
+        GET  /api/pulses              candidates (JSON)
+        GET  /api/export              ranked pulses in -pulses_checked format
+        GET  /plots/<pulse>/<file>    candidate plots (with caching headers)
+        POST /rank                    record a rank (form or JSON body)
+    """
+    server_version = 'PulsesReview/1.0'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/':
+            self.grid(query)
+        elif url.path == '/api/pulses':
+            self.api_pulses(query)
+        elif url.path == '/api/export':
+            self.api_export()
+        elif url.path.startswith('/plots/'):
+            self.plot(urllib.unquote(url.path[len('/plots/'):]))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/rank':
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        if 'json' in self.headers.getheader('content-type', ''):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                self.send_error(400, 'Invalid JSON')
+                return
+        else:
+            data = dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+        try:
+            pulse_id = int(data['pulse_id'])
+            rank = int(data['rank'])
+        except (KeyError, ValueError):
+            self.send_error(400, 'pulse_id and rank are required')
+            return
+        if pulse_id not in self.server.candidates.pulses.index:
+            self.send_error(404, 'Unknown pulse')
+            return
+        self.server.candidates.rank(pulse_id, rank)
+
+        # Redirect back to the grid only within this server
+        if data.get('next', '').startswith('/') and not data['next'].startswith('//'):
+            self.send_response(303)
+            self.send_header('Location', data['next'])
+            self.end_headers()
+        else:
+            self.send_json({'pulse_id': pulse_id, 'rank': rank})
+
+    def send_json(self, obj):
+        body = json.dumps(obj)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def api_pulses(self, query):
+        pulses = self.server.candidates.select(**filters(query))
+        page, per_page, first, last = page_limits(query, pulses.shape[0], self.server.per_page)
+        rows = []
+        for pulse_id, p in pulses.iloc[first:last].iterrows():
+            rows.append({'pulse_id': int(pulse_id), 'rank': int(p.Rank), 'DM': float(p.DM),
+                         'Sigma': float(p.Sigma), 'Time': float(p.Time), 'Duration': float(p.Duration),
+                         'images': self.server.candidates.images.get(str(pulse_id), [])})
+        self.send_json({'total': pulses.shape[0], 'page': page, 'per_page': per_page, 'pulses': rows})
+
+    def api_export(self):
+        pulses = self.server.candidates.select()
+        session = ranking.RankingSession(self.server.candidates.session_file)
+        ranked = set([d[0] for d in session.decisions(ranked_only=True)])
+        session.close()
+        body = '# PulseID\tRank\n' + ''.join(['%d\t%d\n' % (i, r) for i, r in pulses.Rank.iteritems() if i in ranked])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def plot(self, name):
+        plot_dir = self.server.candidates.plot_dir
+        path = os.path.abspath(os.path.join(plot_dir, name))
+        if not path.startswith(plot_dir + os.sep) or not path.endswith('.png') or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        # Plots only change when they are re-rendered: validate with mtime and size
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        last_modified = email.utils.formatdate(int(stat.st_mtime), usegmt=True)
+        not_modified = False
+        if self.headers.getheader('if-none-match') is not None:
+            not_modified = etag in [e.strip() for e in self.headers.getheader('if-none-match').split(',')]
+        elif self.headers.getheader('if-modified-since') is not None:
+            since = email.utils.parsedate_tz(self.headers.getheader('if-modified-since'))
+            not_modified = since is not None and email.utils.mktime_tz(since) >= int(stat.st_mtime)
+
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', 'max-age=%d' % self.server.max_age)
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(stat.st_size))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            self.wfile.write(f.read())
+
+    def grid(self, query):
+        candidates = self.server.candidates
+        pulses = candidates.select(**filters(query))
+        page, per_page, first, last = page_limits(query, pulses.shape[0], self.server.per_page)
+
+        def link(**kwargs):
+            q = dict((k, v[0]) for k, v in query.items())
+            q.update(kwargs)
+            return '/?' + urllib.urlencode(q)
+        here = link()
+
+        html = ['<html><head><title>%s</title>' % cgi.escape(self.server.title),
+                '<style>body{font-family:sans-serif} .c{display:inline-block;margin:4px;width:400px;vertical-align:top}'
+                ' .c img{width:400px} .r0{background:#cfc} .r1{background:#ffc} .r2{background:#fcc} .r3{background:#ccf}</style>'
+                '</head><body>',
+                '<h3>%s: %d candidates</h3>' % (cgi.escape(self.server.title), pulses.shape[0]),
+                '<form method="get" action="/">Rank <input name="rank" size="6" value="%s"> '
+                'DM <input name="dm_min" size="5" value="%s">-<input name="dm_max" size="5" value="%s"> '
+                'S/N <input name="snr_min" size="4" value="%s">-<input name="snr_max" size="4" value="%s"> '
+                'Sort <select name="sort">%s</select> <input type="submit" value="Filter"></form>' % tuple(
+                    [cgi.escape(query.get(k, [''])[0], True) for k in ['rank', 'dm_min', 'dm_max', 'snr_min', 'snr_max']] +
+                    [''.join(['<option%s>%s</option>' % (' selected' if query.get('sort', ['index'])[0] == s else '', s)
+                              for s in ['index', 'Sigma', 'DM', 'Time']])])]
+        nav = []
+        if page > 0:
+            nav.append('<a href="%s">&lt; previous</a>' % cgi.escape(link(page=page - 1), True))
+        nav.append('page %d of %d' % (page + 1, max(int(np.ceil(pulses.shape[0] / float(per_page))), 1)))
+        if last < pulses.shape[0]:
+            nav.append('<a href="%s">next &gt;</a>' % cgi.escape(link(page=page + 1), True))
+        html.append('<p>%s</p>' % ' | '.join(nav))
+
+        for pulse_id, p in pulses.iloc[first:last].iterrows():
+            image = candidates.main_image(pulse_id)
+            buttons = ''.join(['<button name="rank" value="%d">%s</button>' % (r, RANK_LABELS[r]) for r in range(4)])
+            html.append('<div class="c r%d"><b>Pulse %d</b> [%s] DM %.1f, S/N %.1f, t %.3f s<br>' %
+                        (p.Rank, pulse_id, RANK_LABELS.get(p.Rank, p.Rank), p.DM, p.Sigma, p.Time))
+            if image is not None:
+                src = '/plots/%s/%s' % (pulse_id, urllib.quote(image))
+                html.append('<a href="%s"><img src="%s" loading="lazy"></a><br>' % (src, src))
+            html.append('<form method="post" action="/rank"><input type="hidden" name="pulse_id" value="%d">'
+                        '<input type="hidden" name="next" value="%s">%s</form></div>' %
+                        (pulse_id, cgi.escape(here, True), buttons))
+        html.append('<p>%s</p></body></html>' % ' | '.join(nav))
+
+        body = '\n'.join(html)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ReviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Multi-threaded HTTP server of the candidates of an observation.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, candidates, title='', per_page=48, max_age=3600, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReviewHandler)
+        self.candidates = candidates
+        self.title = title
+        self.per_page = per_page
+        self.max_age = max_age
+        self.verbose = verbose
+
+
+def parser():
+    # Command-line options
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Review the candidates of an observation with a web browser.")
+    parser.add_argument('-db_name', help="Filename of the HDF5 database.", default='SinglePulses.hdf5')
+    parser.add_argument('-store_dir', help="Path of the folder containing the database and the plots.", default='.')
+    parser.add_argument('-session', help="SQLite database of the ranking session (Default: <db_name>_pulses_ranking.db).", default=None)
+    parser.add_argument('-host', help="Address to listen on.", default='localhost')
+    parser.add_argument('-port', help="Port to listen on.", default=8000, type=int)
+    parser.add_argument('-per_page', help="Number of candidates per page.", default=48, type=int)
+    parser.add_argument('-v', help="Log the requests.", action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser()
+    obs_id = os.path.splitext(args.db_name)[0]
+    session_file = args.session
+    if session_file is None:
+        session_file = ranking.session_name(os.path.join(args.store_dir, '{}_pulses.txt'.format(obs_id)))
+    candidates = Candidates(os.path.join(args.store_dir, args.db_name), args.store_dir, session_file)
+    server = ReviewServer((args.host, args.port), candidates, title=obs_id, per_page=args.per_page, verbose=args.v)
+    print "Reviewing {} candidates of {} on http://{}:{}/".format(candidates.pulses.shape[0], obs_id, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
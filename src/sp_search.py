@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""
+sp_search.py
+
+In-process single-pulse search of PSRFITS observations.
+The filterbank is dedispersed at all the trial DMs with the subband
+method and each time series is searched with a multi-width boxcar
+matched filter, emulating PRESTO's prepsubband and single_pulse_search.py
+without writing intermediate files. Observations are streamed in chunks,
+so that the memory used does not depend on the observation length.
+
+"""
+
+import argparse
+
+import numpy as np
+
+import psr_utils
+import psrfits
+import spectra
+
+# Boxcar widths (in bins) used by single_pulse_search.py
+DEFAULT_DOWNFACTS = [1, 2, 3, 4, 6, 9, 14, 20, 30, 45, 70, 100, 150, 220, 300]
+
+
+def dm_trials(lodm, hidm, dmstep):
+    """Return the array of trial DMs between 'lodm' and 'hidm' (included).
+    """
+    return lodm + np.arange(int(np.round((hidm - lodm) / dmstep)) + 1) * dmstep
+
+
+def subband_dms(dms, dms_per_subdm=32):
+    """Split the trial DMs in groups sharing the same subbanding DM.
+
+        Inputs:
+            dms: Array of trial DMs.
+            dms_per_subdm: Number of consecutive trial DMs dedispersed
+                from the same set of subbands. (Default: 32)
+
+        Output:
+            plan: List of (subdm, dms) tuples, where subdm is the central
+                DM of each group.
+    """
+    plan = []
+    for i in range(0, len(dms), dms_per_subdm):
+        group = np.asarray(dms[i:i+dms_per_subdm])
+        plan.append((group[len(group)//2], group))
+    return plan
+
+
+def make_subbands(spec, nsub, subdm, zerodm=False):
+    """Return the subbanded data of a Spectra object.
+
+        Inputs:
+            spec: A Spectra object (not modified).
+            nsub: Number of subbands. Must be a factor of the number of channels.
+            subdm: DM used to combine the channels within each subband.
+            zerodm: Subtract the mean of all channels from each sample.
+                (Default: False)
+
+        Outputs:
+            subbands: 2D numpy array (subband, time).
+            sub_freqs: Reference (i.e. highest) frequency of each subband.
+    """
+    data = np.array(np.ma.filled(np.ma.asarray(spec.data), 0.), dtype=np.float32)
+    if zerodm:
+        data -= data.mean(axis=0)
+
+    # Channels are aligned to the highest frequency of each subband
+    nchan_per_sub = spec.numchans // nsub
+    order = np.argsort(spec.freqs)[::-1]
+    freqs = spec.freqs[order]
+    data = data[order]
+    sub_freqs = freqs[np.arange(nsub)*nchan_per_sub]
+
+    delays = psr_utils.delay_from_DM(subdm, freqs) - \
+             psr_utils.delay_from_DM(subdm, sub_freqs).repeat(nchan_per_sub)
+    bins = np.round(delays / spec.dt).astype('int')
+
+    # Channels are shifted to the left, the end of each subband is not fully covered
+    nout = spec.numspectra - bins.max()
+    subbands = np.zeros((nsub, nout), dtype=np.float32)
+    for ii in range(spec.numchans):
+        subbands[ii // nchan_per_sub] += data[ii, bins[ii]:bins[ii]+nout]
+    return subbands, sub_freqs
+
+
+def dedisperse_subbands(subbands, sub_freqs, dt, dm):
+    """Dedisperse subbands at a DM, referenced to the highest subband.
+
+        Inputs:
+            subbands: 2D numpy array (subband, time).
+            sub_freqs: Reference frequency of each subband.
+            dt: Sampling time (in seconds).
+            dm: Dispersion measure (in pc/cm^3).
+
+        Output:
+            timeseries: 1D numpy array. Its length is reduced by the
+                dispersion sweep across the subbands.
+    """
+    delays = psr_utils.delay_from_DM(dm, sub_freqs) - \
+             psr_utils.delay_from_DM(dm, np.max(sub_freqs))
+    bins = np.round(delays / dt).astype('int')
+    nout = subbands.shape[1] - bins.max()
+    timeseries = np.zeros(max(nout, 0), dtype=np.float64)
+    if nout <= 0:
+        return timeseries
+    for ii in range(subbands.shape[0]):
+        timeseries += subbands[ii, bins[ii]:bins[ii]+nout]
+    return timeseries
+
+
+def normalise(timeseries, detrendlen=1000):
+    """Remove the baseline and normalise a time series to unit standard
+        deviation, using robust statistics in blocks of 'detrendlen' bins.
+    """
+    ts = np.array(timeseries, dtype=np.float64)
+    nblocks = max(ts.size // detrendlen, 1)
+    for block in np.array_split(ts, nblocks):
+        block -= np.median(block)
+    std = 1.4826 * np.median(np.abs(ts))
+    if std > 0:
+        ts /= std
+    return ts
+
+
+def boxcar_search(timeseries, threshold=6., downfacts=DEFAULT_DOWNFACTS):
+    """Search a normalised time series with boxcars of different widths.
+        Candidates overlapping a stronger one are removed.
+
+        Inputs:
+            timeseries: 1D numpy array with zero mean and unit standard deviation.
+            threshold: Minimum significance of the candidates. (Default: 6)
+            downfacts: List of boxcar widths (in bins).
+
+        Outputs:
+            samples: Central bin of each candidate.
+            sigmas: Significance of each candidate.
+            widths: Boxcar width (in bins) of each candidate.
+    """
+    nsamp = timeseries.size
+    cumsum = np.concatenate([[0.], np.cumsum(timeseries)])
+    samples, sigmas, widths = [], [], []
+    for width in downfacts:
+        if width >= nsamp:
+            break
+        snr = (cumsum[width:] - cumsum[:-width]) / np.sqrt(width)
+        above = np.flatnonzero(snr > threshold)
+        if above.size == 0:
+            continue
+        # Keep the peak of each group of contiguous bins above threshold
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(above) > 1) + 1])
+        peaks = [run[np.argmax(snr[run])] for run in np.split(above, starts[1:])]
+        peaks = np.array(peaks, dtype=np.int64)
+        samples.append(peaks + width // 2)
+        sigmas.append(snr[peaks])
+        widths.append(np.zeros(peaks.size, dtype=np.int64) + width)
+
+    if not samples:
+        return np.array([], dtype=np.int64), np.array([]), np.array([], dtype=np.int64)
+
+    samples = np.concatenate(samples)
+    sigmas = np.concatenate(sigmas)
+    widths = np.concatenate(widths)
+
+    # Remove candidates centred within the window of a stronger one
+    taken = np.zeros(nsamp, dtype=bool)
+    keep = np.zeros(samples.size, dtype=bool)
+    for ii in np.argsort(sigmas)[::-1]:
+        if taken[samples[ii]]:
+            continue
+        keep[ii] = True
+        taken[max(samples[ii] - widths[ii]//2, 0):samples[ii] + widths[ii]//2 + 1] = True
+    order = np.argsort(samples[keep])
+    return samples[keep][order], sigmas[keep][order], widths[keep][order]
+
+
+EVENTS_DTYPES = [('DM', np.float64), ('Sigma', np.float64), ('Time', np.float64),
+                 ('Sample', np.int32), ('Downfact', np.int16)]
+
+
+def _events_arrays(events):
+    """Concatenate lists of event arrays into a dictionary of arrays.
+    """
+    arrays = {}
+    for key, dtype in EVENTS_DTYPES:
+        if events[key]:
+            arrays[key] = np.concatenate(events[key]).astype(dtype)
+        else:
+            arrays[key] = np.array([], dtype=dtype)
+    return arrays
+
+
+def search_spectra(spec, dms, nsub=64, threshold=6., downfacts=DEFAULT_DOWNFACTS, zerodm=False,
+                   dms_per_subdm=32, detrendlen=1000):
+    """Single-pulse search of a Spectra object at a list of trial DMs.
+
+        Inputs:
+            spec: A Spectra object (not modified).
+            dms: Array of trial DMs.
+            nsub: Number of subbands. (Default: 64)
+            threshold: Minimum significance of the events. (Default: 6)
+            downfacts: List of boxcar widths (in bins).
+            zerodm: Subtract the mean of all channels from each sample.
+                (Default: False)
+            dms_per_subdm: Number of trial DMs sharing the same subbands.
+            detrendlen: Length (in bins) of the blocks used to remove the baseline.
+
+        Output:
+            events: Dictionary of arrays with keys 'DM', 'Sigma', 'Time',
+                'Sample' and 'Downfact', as in .singlepulse files.
+    """
+    nsub = min(nsub, spec.numchans)
+    events = {'DM': [], 'Sigma': [], 'Time': [], 'Sample': [], 'Downfact': []}
+    for subdm, group in subband_dms(dms, dms_per_subdm=dms_per_subdm):
+        subbands, sub_freqs = make_subbands(spec, nsub, subdm, zerodm=zerodm)
+        for dm in group:
+            timeseries = dedisperse_subbands(subbands, sub_freqs, spec.dt, dm)
+            if timeseries.size == 0:
+                continue
+            timeseries = normalise(timeseries, detrendlen=detrendlen)
+            samples, sigmas, widths = boxcar_search(timeseries, threshold=threshold, downfacts=downfacts)
+            events['DM'].append(np.zeros(samples.size) + dm)
+            events['Sigma'].append(sigmas)
+            events['Time'].append(spec.starttime + samples * spec.dt)
+            events['Sample'].append(samples + int(np.round(spec.starttime / spec.dt)))
+            events['Downfact'].append(widths)
+    return _events_arrays(events)
+
+
+def max_delay_bins(freqs, dt, dm):
+    """Return the number of bins spanned by the dispersion sweep of 'dm'
+        across the band 'freqs'.
+    """
+    return int(np.ceil((psr_utils.delay_from_DM(dm, np.min(freqs)) - \
+                        psr_utils.delay_from_DM(dm, np.max(freqs))) / dt)) + 1
+
+
+def stream_dedisperse(rawdata, dms, nsub=64, chunk_nsamp=None, zerodm=False, dms_per_subdm=32):
+    """Dedisperse a PSRFITS observation in chunks with the overlap-save method.
+        Each chunk of raw data is read once. The last 'max_delay' spectra
+        of a chunk are kept in memory and prepended to the next one, so that
+        the memory used depends on the chunk size, not on the observation length.
+
+        Inputs:
+            rawdata: A psrfits.PsrfitsFile instance.
+            dms: Array of trial DMs.
+            nsub: Number of subbands. (Default: 64)
+            chunk_nsamp: Number of new spectra read in each chunk. It is rounded
+                up to a multiple of the subint length.
+                (Default: 4 times the dispersion sweep of the highest DM)
+            zerodm: Subtract the mean of all channels from each sample.
+                (Default: False)
+            dms_per_subdm: Number of trial DMs sharing the same subbands.
+
+        Output (generator):
+            start: Index of the first sample of the time series.
+            dm: Trial DM of the time series.
+            timeseries: 1D numpy array dedispersed at 'dm'. The time series of
+                consecutive chunks are contiguous.
+    """
+    nsub = min(nsub, rawdata.nchan)
+    # Rounding of the subband and DM shifts can add one bin per subband
+    max_delay = max_delay_bins(rawdata.freqs, rawdata.tsamp, np.max(dms)) + nsub
+    if chunk_nsamp is None:
+        chunk_nsamp = 4 * max_delay
+    nsblk = rawdata.nsamp_per_subint
+    chunk_nsamp = int(np.ceil(chunk_nsamp / float(nsblk))) * nsblk
+    plan = subband_dms(dms, dms_per_subdm=dms_per_subdm)
+
+    # The last spectrum is not read, as in waterfaller
+    nspec = int(rawdata.specinfo.N) - 1
+    overlap = None
+    readsamp = 0
+    while readsamp < nspec:
+        nread = min(chunk_nsamp, nspec - readsamp)
+        new = rawdata.get_spectra(readsamp, nread)
+        if overlap is None:
+            spec = new
+        else:
+            spec = spectra.Spectra(new.freqs, new.dt, np.concatenate([overlap, new.data], axis=1),
+                                   starttime=new.starttime - overlap.shape[1] * new.dt)
+        readsamp += nread
+        start = int(np.round(spec.starttime / spec.dt))
+
+        nvalid = spec.numspectra - max_delay
+        if nvalid > 0:
+            for subdm, group in plan:
+                subbands, sub_freqs = make_subbands(spec, nsub, subdm, zerodm=zerodm)
+                for dm in group:
+                    timeseries = dedisperse_subbands(subbands, sub_freqs, spec.dt, dm)
+                    yield start, dm, timeseries[:nvalid]
+            overlap = spec.data[:, nvalid:]
+        else:
+            overlap = spec.data
+
+
+def search_observation(fitsfn, dms, nsub=64, threshold=6., max_downfact=300, zerodm=False,
+                       dms_per_subdm=32, chunk_nsamp=None):
+    """Single-pulse search of a PSRFITS file.
+        The observation is read and dedispersed in chunks (see stream_dedisperse).
+        The last samples of each time series are kept between chunks so that
+        pulses crossing the chunk boundaries are detected once.
+
+        Inputs:
+            fitsfn: Name of the PSRFITS file.
+            dms: Array of trial DMs.
+            nsub: Number of subbands. (Default: 64)
+            threshold: Minimum significance of the events. (Default: 6)
+            max_downfact: Maximum boxcar width (in bins). (Default: 300)
+            zerodm: Subtract the mean of all channels from each sample.
+                (Default: False)
+            chunk_nsamp: Number of spectra read in each chunk.
+                (Default: see stream_dedisperse)
+
+        Output:
+            events: Dictionary of arrays, see search_spectra.
+    """
+    rawdata = psrfits.PsrfitsFile(fitsfn)
+    return search_stream(rawdata, dms, nsub=nsub, threshold=threshold, max_downfact=max_downfact,
+                         zerodm=zerodm, dms_per_subdm=dms_per_subdm, chunk_nsamp=chunk_nsamp)
+
+
+def search_stream(rawdata, dms, nsub=64, threshold=6., max_downfact=300, zerodm=False,
+                  dms_per_subdm=32, chunk_nsamp=None, detrendlen=1000):
+    """Single-pulse search of a psrfits.PsrfitsFile instance read in chunks.
+        See search_observation.
+    """
+    downfacts = [d for d in DEFAULT_DOWNFACTS if d <= max_downfact]
+    half_width = max(downfacts) // 2
+    events = {'DM': [], 'Sigma': [], 'Time': [], 'Sample': [], 'Downfact': []}
+
+    def search(dm, series, offset, lo, hi):
+        # Store the candidates centred in [lo, hi) of the series
+        samples, sigmas, widths = boxcar_search(series, threshold=threshold, downfacts=downfacts)
+        idx = (samples >= lo) & (samples < hi)
+        events['DM'].append(np.zeros(np.count_nonzero(idx)) + dm)
+        events['Sigma'].append(sigmas[idx])
+        events['Time'].append((offset + samples[idx]) * rawdata.tsamp)
+        events['Sample'].append(offset + samples[idx])
+        events['Downfact'].append(widths[idx])
+
+    # Last samples of each time series and index of their first sample,
+    # they are searched again together with the next chunk
+    tails = {}
+    for start, dm, timeseries in stream_dedisperse(rawdata, dms, nsub=nsub, chunk_nsamp=chunk_nsamp,
+                                                    zerodm=zerodm, dms_per_subdm=dms_per_subdm):
+        if dm in tails:
+            tail, offset = tails[dm]
+            lo = max(tail.size - half_width, 0)
+        else:
+            tail, offset = np.array([]), start
+            lo = 0
+        series = np.concatenate([tail, normalise(timeseries, detrendlen=detrendlen)])
+        search(dm, series, offset, lo, series.size - half_width)
+        # Explicit start, since series[-0:] would keep the whole series when half_width is 0
+        tail = series[series.size - 2*half_width:]
+        tails[dm] = (tail, offset + series.size - tail.size)
+
+    # End of the observation
+    for dm, (tail, offset) in tails.items():
+        search(dm, tail, offset, max(tail.size - half_width, 0), tail.size)
+
+    return _events_arrays(events)
+
+
+def parser():
+    # Command-line options
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                    description="The program searches a PSRFITS file for single pulses.")
+    parser.add_argument('fits', help="Name of the PSRFITS file.")
+    parser.add_argument('-lodm', help="The lowest dispersion measure to de-disperse (cm^-3 pc).", type=float, default=461.0)
+    parser.add_argument('-numdms', help="The number of DMs to de-disperse.", type=int, default=201)
+    parser.add_argument('-dmstep', help="The stepsize in dispersion measure to use (cm^-3 pc).", type=float, default=1.0)
+    parser.add_argument('-nsub', help="The number of sub-bands to use.", type=int, default=64)
+    parser.add_argument('-t', help="Minimum significance of the events.", type=float, default=6.)
+    parser.add_argument('-m', help="Maximum boxcar width (in s), as in single_pulse_search.py (Default: %d bins)." % DEFAULT_DOWNFACTS[-1], type=float, default=None)
+    parser.add_argument('-chunk', help="Number of spectra read in each chunk (Default: 4 times the maximum DM sweep).", type=int, default=None)
+    parser.add_argument('-zerodm', help="Subtract the mean of all channels from each sample.", action='store_true')
+    parser.add_argument('-o', help="Name of the output text file.", default='events.singlepulse')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser()
+    dms = args.lodm + np.arange(args.numdms) * args.dmstep
+    rawdata = psrfits.PsrfitsFile(args.fits)
+    if args.m is None: max_downfact = DEFAULT_DOWNFACTS[-1]
+    else: max_downfact = max(int(args.m / rawdata.tsamp), 1)
+    events = search_stream(rawdata, dms, nsub=args.nsub, threshold=args.t, max_downfact=max_downfact, zerodm=args.zerodm,
+                           chunk_nsamp=args.chunk)
+    np.savetxt(args.o, np.column_stack([events['DM'], events['Sigma'], events['Time'], events['Sample'], events['Downfact']]),
+               fmt=['%7.2f', '%7.2f', '%13.6f', '%10d', '%3d'], header='DM      Sigma      Time (s)     Sample    Downfact')
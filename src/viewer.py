@@ -9,6 +9,14 @@ import h5py
 import Tkinter
 import argparse
 import glob
+import threading
+import Queue
+from collections import OrderedDict
+
+import ranking
+
+#Size of the images on screen, the size of the thumbnails of the candidate plots (see auto_waterfaller.PLOT_RESOLUTIONS)
+IMAGE_SIZE = (770, 560)
 
 def select_cands(filename, Master=False, DM_min=None, DM_max=None, Sigma_min=None,duration_max=None, sort=None):
 	cands = pd.read_hdf(filename, 'pulses') #Haven't fully implemented these capabilities yet
@@ -46,206 +54,269 @@ def next_image_quiet(event): #without prompt (view_only_mode)
 #	new_file_pos = current_file - 1
 	#print new_file_pos
 
+def candidate_plot(name):
+	"""
+	Whether an image is the main plot of a candidate, not a zoomed, downsampled, DM-time, diagnostic or full resolution one.
+	"""
+	return name.endswith('.png') and not name.endswith('zoomed.png') and not name.endswith('downsamped.png') \
+		and not name.endswith('dm_time.png') and not name.endswith('diagnostic.png') and not name.endswith('_full.png')
+
+def candidate_images(pattern, select=candidate_plot):
+	"""
+	Index of the candidate images, built with a single glob instead of listing each candidate directory.
+
+	Inputs:
+
+		pattern: glob pattern of the images, e.g. 'pulses/*/*.png'
+		select: function of the file name returning True for the images to show
+
+	Outputs:
+
+		index: dictionary (candidate directory -> sorted list of image paths)
+
+	"""
+	index = {}
+	for path in sorted(glob.glob(pattern)):
+		if select(os.path.basename(path)): index.setdefault(os.path.dirname(path), []).append(path)
+	return index
+
+class ImageCache(object):
+	"""
+	LRU cache of decoded images, resized only if they are larger than the images on screen.
+	A background thread decodes the images following the one on screen while the user is looking at it.
+	"""
+	def __init__(self, paths, size=IMAGE_SIZE, prefetch=8, max_images=32):
+		"""
+		Inputs:
+
+			paths: list of image paths, in the order they are shown
+			size: size of the images on screen
+			prefetch: number of images to decode ahead
+			max_images: maximum number of images kept in memory
+
+		"""
+		self.paths = paths
+		self.size = size
+		self.prefetch = prefetch
+		self.max_images = max(max_images, prefetch + 2)
+		self.current = 0
+		self.images = OrderedDict()
+		self.lock = threading.Lock()
+		self.queue = Queue.Queue()
+		self.thread = threading.Thread(target=self._worker)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _load(self, path):
+		img = Image.open(path)
+		#Thumbnails fit the window and are shown at their native size, larger images are reduced keeping their aspect ratio
+		scale = min(float(self.size[0]) / img.size[0], float(self.size[1]) / img.size[1])
+		if scale >= 1:
+			img.load()
+			return img
+		return img.resize((int(round(img.size[0] * scale)), int(round(img.size[1] * scale))), Image.ANTIALIAS)
+
+	def _store(self, path, img):
+		with self.lock:
+			self.images[path] = img
+			#Least recently used images are dropped first, but never the ones about to be shown
+			upcoming = set(self.paths[self.current : self.current+1+self.prefetch])
+			for old_path in list(self.images):
+				if len(self.images) <= self.max_images: break
+				if old_path not in upcoming: del self.images[old_path]
+
+	def _worker(self):
+		while True:
+			path = self.queue.get()
+			if path is None: break
+			with self.lock:
+				if path in self.images: continue
+			try: img = self._load(path)
+			except IOError: continue
+			self._store(path, img)
+
+	def get(self, idx):
+		"""
+		Returns the image number idx and starts decoding the following ones.
+		"""
+		path = self.paths[idx]
+		with self.lock:
+			self.current = idx
+			img = self.images.pop(path, None)
+			if img is not None: self.images[path] = img
+		if img is None:
+			img = self._load(path)
+			self._store(path, img)
+		for next_path in self.paths[idx+1 : idx+1+self.prefetch]:
+			self.queue.put(next_path)
+		return img
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join(5.)
+
+class ImageWindow(object):
+	"""
+	Single Tk window reused to show all the images. Hit enter to view the next image.
+	"""
+	def __init__(self, size=IMAGE_SIZE):
+		self.root = Tkinter.Tk()
+		self.root.geometry('%dx%d' % size)
+		self.label_image = Tkinter.Label(self.root)
+		self.label_image.place(x=0, y=0, width=size[0], height=size[1])
+		self.prompt = False
+		self.root.bind('<Return>', self._next)
+
+	def _next(self, event):
+		if self.prompt: next_image(event)
+		else: next_image_quiet(event)
+
+	def show(self, img, title, prompt=False):
+		"""
+		Shows the image and waits for the user to hit enter.
+		"""
+		self.prompt = prompt
+		self.tkpi = ImageTk.PhotoImage(img)
+		self.label_image.configure(image=self.tkpi)
+		self.root.title(title)
+		self.root.mainloop()
+
+	def close(self):
+		self.root.destroy()
+
+def image_sequence(cand_images):
+	"""
+	Flattens the list of images of each candidate.
+
+	Inputs:
+
+		cand_images: list with the list of image paths of each candidate
+
+	Outputs:
+
+		images: list of all the image paths
+		first: index in images of the first image of each candidate (one more element for the end)
+
+	"""
+	images = [path for paths in cand_images for path in paths]
+	first = np.cumsum([0,] + [len(paths) for paths in cand_images])
+	return images, first
+
 def masterlist_viewer(txtfile, path_to_pulses, view_only_mode=False, multicomponents=False, multibursts=False, start=None):
-	with open(txtfile, 'r') as tf:
-		pulse_IDs = np.array([]).reshape(0,1)
-		components = np.array([]).reshape(0,1)
-		multi_bursts = np.array([]).reshape(0,1)
-		comments = np.array([]).reshape(0,1)
-		paths = np.array([]).reshape(0,1)
-		next(tf)
-		if view_only_mode:
-			next(tf) #skip over lines to be used for header
-		for row in tf:
-			cols = np.array(row.split())
-			ID = cols[0]
-			path_to_cand = glob.glob('*/pulses/%s'%ID)[0] #relative to path_to_pulses
-			cols = np.array([ID,'','','',path_to_cand])
-			pulse_IDs = np.vstack([pulse_IDs, int(cols[0])])
-			components = np.vstack([components, cols[1]])
-			multi_bursts = np.vstack([multi_bursts, cols[2]])
-			comments = np.vstack([comments, str(cols[3])])
-			paths = np.vstack([paths, cols[4]])
-		comments = comments.astype(object)
-		cands = np.loadtxt(txtfile, usecols=(0,), dtype='int')
-		if view_only_mode:
-			comps = np.loadtxt(txtfile, usecols=(1,), dtype='int')
-			bursts = np.loadtxt(txtfile, usecols=(2,), dtype='int')
-			comments = np.genfromtxt(txtfile, usecols=(6,), delimiter="\t", skip_header=2, dtype=None)
-			comps = np.where(comps>0)[0]
-			bursts = np.where(bursts >0)[0]
-			if multicomponents and not multibursts:
-				cands = cands[comps]
-				paths = paths[comps]
-				comments = comments[comps]
-			if multibursts and not multicomponents:
-				cands = cands[bursts]
-				paths = paths[bursts]
-				comments = comments[bursts]
-			if multibursts and multicomponents:
-				bursts_comps = np.append(comps, bursts)
-				cands = cands[bursts_comps]
-				paths = paths[bursts_comps]
-				comments = comments[bursts_comps]
-
-			root = Tkinter.Tk()
-			root.bind('<Return>', next_image_quiet)
-			#root.bind('<space>', next_image_quiet)
-			#root.bind('<Left>', lambda event: previous_image(event, current_file))
-			for i, cand in enumerate(cands):
-				print 'Viewing pulse %d: '%cand + comments[i]
-				path_to_cand = paths[i][0]
-				abs_path = path_to_pulses + path_to_cand
-				#current_file = 0
-				#global new_file_pos
-				#new_file_pos = 1000 #arbitrary large number
-				for file in os.listdir(abs_path): #turn what follows into a function since im repeating to go to previous image.
-					if not file.endswith('zoomed.png') and not file.endswith('downsamped.png') and file.endswith('.png') :
-						#current_file += 1
-						img = Image.open(os.path.join(abs_path, file))
-						img = img.resize((800, 500), Image.ANTIALIAS)
-						root.geometry('%dx%d' % (img.size[0],img.size[1]))
-						tkpi = ImageTk.PhotoImage(img)
-						label_image = Tkinter.Label(root, image=tkpi)
-						label_image.place(x=0,y=0,width=img.size[0],height=img.size[1])
-						root.title(file)			
-						root.mainloop()
-						#print new_file_pos
-						#print current_file
-						#if new_file_pos < current_file:
-							#break #breaks out of nearest for loop. this isnt useful.
-							#instead of using for loop, try using os.walk and search through list of returned files satisfying the above if conditions.
-
-							
-
-					else:
-						pass
-		else:
-			annotated_file = txtfile.split('.')[0]
-			unfinished = annotated_file + '_annotated_unfinished.txt'
-			continued = annotated_file + '_annotated_continued.txt'
-			annotated_file = annotated_file + '_annotated.txt'
-			if start:
-				start_idx = np.where(cands==start)[0][0]
-			else:
-				start_idx = 0
-			for i, cand in enumerate(cands):
-				if i >= start_idx:
-					path_to_cand = paths[i][0]
-					abs_path = path_to_pulses + path_to_cand
-					root = Tkinter.Tk()
-					root.bind('<Return>', next_image)
-					for file in os.listdir(abs_path):
-						if not file.endswith('zoomed.png') and not file.endswith('downsamped.png') and file.endswith('.png') :
-							img = Image.open(os.path.join(abs_path, file))
-							img = img.resize((800, 500), Image.ANTIALIAS)
-							root.geometry('%dx%d' % (img.size[0],img.size[1]))
-							tkpi = ImageTk.PhotoImage(img)
-							label_image = Tkinter.Label(root, image=tkpi)
-							label_image.place(x=0,y=0,width=img.size[0],height=img.size[1])
-							root.title(file)				
-							root.mainloop()
-						else:
-							pass
-
-					print "NOW EDITING PULSE %d"%cand
-					root.destroy()
-					input = raw_input("How many additional components are there?:")
-					while input.isdigit() == False:
-						input = raw_input("Oops. Please enter an integer:")
-					components[i] = input
-					input = raw_input("How many additional bursts are there?:")
-					while input.isdigit() == False:
-						input = raw_input("Oops. Please enter an integer:")
-					multi_bursts[i] = input
-					comment = raw_input("comments:") #or '\t'
-					comments[i] = comment
-					pulse_IDs=pulse_IDs.flatten()
-					pulse_IDs = pulse_IDs.astype(int)
-					components = components.flatten()
-					multi_bursts = multi_bursts.flatten()
-					comments = comments.flatten()
-					if cand == cands[-1] and not start: 
-						np.savetxt(annotated_file, np.column_stack([pulse_IDs, components, multi_bursts, comments]),\
-				 					delimiter='\t\t', header='PulseID\tAdditional\tAdditional\tComment\n\t\tcomponents\tbursts',fmt="%s")
-						os.remove(unfinished)
-						
-					elif start: #This is a safety, in case classification is interrupted, you don't lose progress and can start classifying at last index and then merge files manually when done.
-						np.savetxt(continued, np.column_stack([pulse_IDs, components, multi_bursts, comments]),\
-				 					delimiter='\t\t', header='PulseID\tAdditional\tAdditional\tComment\n\t\tcomponents\tbursts',fmt="%s")
-
-					else:
-						np.savetxt(unfinished, np.column_stack([pulse_IDs, components, multi_bursts, comments]),\
-				 					delimiter='\t\t', header='PulseID\tAdditional\tAdditional\tComment\n\t\tcomponents\tbursts',fmt="%s")
-				else:
-					pass
-			#
+	#Index of the candidate directories and of their images, built once
+	cand_dirs = {}
+	for path in sorted(glob.glob('*/pulses/*')): cand_dirs.setdefault(os.path.basename(path), path)
+	index = candidate_images(path_to_pulses + '*/pulses/*/*.png')
+
+	cands = np.atleast_1d(np.loadtxt(txtfile, usecols=(0,), dtype='int'))
+	paths = np.array([cand_dirs[str(cand)] for cand in cands]) #relative to path_to_pulses
+	if view_only_mode:
+		comps = np.loadtxt(txtfile, usecols=(1,), dtype='int')
+		bursts = np.loadtxt(txtfile, usecols=(2,), dtype='int')
+		comments = np.genfromtxt(txtfile, usecols=(6,), delimiter="\t", skip_header=2, dtype=None)
+		comps = np.where(comps>0)[0]
+		bursts = np.where(bursts >0)[0]
+		if multicomponents and not multibursts:
+			cands = cands[comps]
+			paths = paths[comps]
+			comments = comments[comps]
+		if multibursts and not multicomponents:
+			cands = cands[bursts]
+			paths = paths[bursts]
+			comments = comments[bursts]
+		if multibursts and multicomponents:
+			bursts_comps = np.append(comps, bursts)
+			cands = cands[bursts_comps]
+			paths = paths[bursts_comps]
+			comments = comments[bursts_comps]
+
+		images, first = image_sequence([index.get(path_to_pulses + paths[i], []) for i in range(cands.size)])
+		cache = ImageCache(images)
+		window = ImageWindow()
+		for i, cand in enumerate(cands):
+			print 'Viewing pulse %d: '%cand + comments[i]
+			for j in range(first[i], first[i+1]):
+				window.show(cache.get(j), os.path.basename(images[j]))
+		window.close()
+		cache.close()
+
+	else:
+		#Decisions are stored as soon as they are taken and the session is resumed from the last annotated pulse
+		annotated_file = txtfile.split('.')[0] + '_annotated.txt'
+		session = ranking.RankingSession(ranking.session_name(annotated_file))
+		session.add_pulses(cands)
+		to_rank = session.pending(start=start)
+		cand_paths = dict(zip(cands, paths))
+
+		images, first = image_sequence([index.get(path_to_pulses + cand_paths[cand], []) for cand in to_rank])
+		cache = ImageCache(images)
+		window = ImageWindow()
+		for i, cand in enumerate(to_rank):
+			for j in range(first[i], first[i+1]):
+				window.show(cache.get(j), os.path.basename(images[j]), prompt=True)
+
+			print "NOW EDITING PULSE %d"%cand
+			input = raw_input("How many additional components are there?:")
+			while input.isdigit() == False:
+				input = raw_input("Oops. Please enter an integer:")
+			components = int(input)
+			input = raw_input("How many additional bursts are there?:")
+			while input.isdigit() == False:
+				input = raw_input("Oops. Please enter an integer:")
+			multi_bursts = int(input)
+			comment = raw_input("comments:") #or '\t'
+			session.rank(cand, components=components, bursts=multi_bursts, comment=comment)
+		window.close()
+		cache.close()
+
+		ranked, total = session.progress()
+		if ranked == total: session.export_annotations(annotated_file)
+		else: print "%d of %d pulses annotated. Run again to resume." % (ranked, total)
+		session.close()
+
 def viewer(txtfile, path_to_pulses, obs, view_only_mode=False,ranks_to_view=None):
 	#put txtfile columns into numpy arrays:
-	with open(txtfile, 'r') as tf:
-		pulse_IDs = np.array([]).reshape(0,1)
-		ranks = np.array([]).reshape(0,1)
-		next(tf)
-		for row in tf:
-			cols = np.array(row.split())
-			pulse_IDs = np.vstack([pulse_IDs, int(cols[0])])
-			ranks = np.vstack([ranks, cols[1]])
-
-	cands = np.loadtxt(txtfile, usecols=(0,), dtype='int')
+	pulse_IDs, ranks = np.loadtxt(txtfile, usecols=(0,1), dtype='int', ndmin=2, unpack=True)
+
+	cands = pulse_IDs
 	if view_only_mode:
-		root = Tkinter.Tk()
-		root.bind('<Return>', next_image_quiet)
-		for i, cand in enumerate(cands):
-			cand_rank = ranks[i]
-			cand_rank = cand_rank.astype(int)
-			if cand_rank in ranks_to_view:
-				path = path_to_pulses + str(cand)
-				for file in os.listdir(path):
-					if file.endswith('.png'):
-						img = Image.open(os.path.join(path, file))
-						img = img.resize((800, 500), Image.ANTIALIAS)
-						root.geometry('%dx%d' % (img.size[0],img.size[1]))
-						tkpi = ImageTk.PhotoImage(img)
-						label_image = Tkinter.Label(root, image=tkpi)
-						label_image.place(x=0,y=0,width=img.size[0],height=img.size[1])
-						root.title(file)				
-						root.mainloop()
-					else:
-						pass
-			else:
-				pass
+		index = candidate_images(path_to_pulses + '*/*.png')
+		images, first = image_sequence([index.get(path_to_pulses + str(cand), []) if ranks[i] in ranks_to_view else [] \
+			for i, cand in enumerate(cands)])
+		cache = ImageCache(images)
+		window = ImageWindow()
+		for j, path in enumerate(images):
+			window.show(cache.get(j), os.path.basename(path))
+		window.close()
+		cache.close()
 	else:
-		for i, cand in enumerate(cands):
-			path = path_to_pulses + str(cand)
-			root = Tkinter.Tk()
-			#root.geometry("800x500")
-			root.bind('<Return>', next_image)
-			for file in os.listdir(path):
-				if file.startswith(file_id): #avoid looking at diagnostic plot. 
-					img = Image.open(os.path.join(path, file))
-					img = img.resize((800, 500), Image.ANTIALIAS)
-					root.geometry('%dx%d' % (img.size[0],img.size[1]))
-					tkpi = ImageTk.PhotoImage(img)
-					label_image = Tkinter.Label(root, image=tkpi)
-					label_image.place(x=0,y=0,width=img.size[0],height=img.size[1])
-					root.title(file)				
-					root.mainloop()
-				else:
-					pass
+		path, txtfilename = os.path.split(txtfile)
+		ranked_file = path + "/" + obs + '_pulses.txt'
+
+		#Ranks are stored as soon as they are given and the session is resumed from the last ranked pulse
+		session = ranking.RankingSession(ranking.session_name(ranked_file))
+		session.add_pulses(pulse_IDs, ranks)
+		to_rank = session.pending()
+
+		index = candidate_images(path_to_pulses + '*/*.png', select=lambda f: f.startswith(file_id) and candidate_plot(f))
+		images, first = image_sequence([index.get(path_to_pulses + str(cand), []) for cand in to_rank])
+		cache = ImageCache(images)
+		window = ImageWindow()
+		for i, cand in enumerate(to_rank):
+			for j in range(first[i], first[i+1]):
+				window.show(cache.get(j), os.path.basename(images[j]), prompt=True)
 			print "Now ranking candidate %d from %s"%(cand,obs)
-			root.destroy()
 			input = raw_input("Provide a ranking for this candidate:")
 			while input.isdigit() == False:
 				input = raw_input("Oups. Please enter an integer:")
-			ranks[i] = input
+			session.rank(cand, rank=int(input))
+		window.close()
+		cache.close()
 
-		pulse_IDs=pulse_IDs.flatten()
-		pulse_IDs = pulse_IDs.astype(int)
-		ranks = ranks.flatten()
-		ranks = ranks.astype(int)
-		path, txtfilename = os.path.split(txtfile)
-		ranked_file = path + "/" + obs + '_pulses.txt'
-		np.savetxt(ranked_file, np.column_stack([pulse_IDs, ranks]), delimiter='\t', header='PulseID\tRank',fmt="%s")
+		ranked, total = session.progress()
+		if ranked == total: session.export_ranks(ranked_file)
+		else: print "%d of %d candidates ranked. Run again to resume." % (ranked, total)
+		session.close()
 	
 if __name__ == '__main__':
 	#filename = 'puppi_57607_C0531+33_0603/pulses/puppi_57607_C0531+33_0603.hdf5'
@@ -262,6 +333,7 @@ if __name__ == '__main__':
 		parser.add_argument('-multicomponents', help="Use this option to view only bursts that show multiple components. To be used in master view-only mode.", action='store_true')
 		parser.add_argument('-multibursts', help="Use this option to view only candidates showing additional bursts. To be used in master view-only mode.", action='store_true')
 		parser.add_argument('-start', help="Start viewer at this pulse ID (works exclusively in master mode at the moment).", default=None, type=int)
+		parser.add_argument('-export', help="Export the decisions of the ranking session, also if unfinished, instead of viewing.", action='store_true')
 		parser.add_argument('-FRB', help="Name of FRB being viewed e.g.'121102'. Default: 121102", default=121102, type=int)
 		return parser.parse_args()
 	args = parser()
@@ -289,6 +361,13 @@ if __name__ == '__main__':
 		if args.create_cand_list:
 			select_cands(filename, Master=True)
 
+		if args.export:
+			annotated_file = (path_to_pulses + obs + '.txt').split('.')[0] + '_annotated.txt'
+			session = ranking.RankingSession(ranking.session_name(annotated_file))
+			session.export_annotations(annotated_file)
+			session.close()
+			sys.exit()
+
 		if args.view_only_mode:
 			txtfile = path_to_pulses + obs + '_annotated.txt'
 			masterlist_viewer(txtfile, '', view_only_mode=True, multibursts=args.multibursts, multicomponents=args.multicomponents)#, start=args.start) need to implement this
@@ -300,6 +379,14 @@ if __name__ == '__main__':
 	if args.create_cand_list:
 		select_cands(filename)
 
+	if args.export:
+		#All the candidates, and the ranked ones only as input of pulses_extract.py -pulses_checked
+		ranked_file = path_to_pulses + obs + '_pulses.txt'
+		session = ranking.RankingSession(ranking.session_name(ranked_file))
+		session.export_ranks(ranked_file)
+		session.export_ranks(path_to_pulses + obs + '_pulses_checked.txt', ranked_only=True)
+		session.close()
+		sys.exit()
 
 	if args.view_only_mode: 
 		txtfile = path_to_pulses + obs + '_pulses.txt'
@@ -25,6 +25,7 @@ import rfifind
 import psrfits
 #import filterbank # need to implement in PRESTO!
 import spectra
+import profiling
 
 SWEEP_STYLES = ['r-', 'b-', 'g-', 'm-', 'c-']
 
@@ -63,6 +64,7 @@ def maskfile(maskfn, data, start_bin, nbinsextra):
     #datacopy = copy.deepcopy(data)
     return data, masked_chans
 
+@profiling.profile('waterfall')
 def waterfall(rawdatafile, start, duration, dm=None, nbins=None, nsub=None,\
               subdm=None, zerodm=False, downsamp=1, scaleindep=False,\
               width_bins=1, mask=False, maskfn=None, bandpass_corr=False, \
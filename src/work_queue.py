@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+"""
+work_queue.py
+
+Queue of observation-level jobs (e.g. one FRB121102_Puppi_1.sh call per
+fits file) shared by several nodes through a common directory.
+Each job is a JSON file moved between the sub-directories
+    pending/ -> running/ -> done/ or failed/
+A worker claims a job by renaming its file from pending/ to running/:
+the rename is atomic, so only one of the workers trying at the same time
+succeeds. While the command runs, the worker touches the file of the job
+(heartbeat). The jobs not touched for longer than a timeout belong to
+dead workers and are moved back to pending/ by any other worker (or by
+the requeue command), until they reach their maximum number of attempts.
+The command of a job is stopped when its worker dies, so that a requeued
+job never runs twice.
+
+Usage:
+    work_queue.py submit QUEUE obs1.fits obs2.fits ...
+    work_queue.py worker QUEUE          (one per core budget, on each node)
+    work_queue.py status QUEUE
+    work_queue.py requeue QUEUE [-failed]
+
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import json
+import multiprocessing as mp
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+#Seconds between the heartbeats of a running job and without heartbeats before a job is considered lost
+HEARTBEAT = 30.
+TIMEOUT = 300.
+
+#Option of prctl (linux/prctl.h) asking for a signal when the parent process dies
+PR_SET_PDEATHSIG = 1
+
+
+def queue_dirs(queue):
+    """Create the sub-directories of a queue if needed and return them by state.
+    """
+    dirs = dict([(state, os.path.join(queue, state)) for state in STATES + ['logs']])
+    for d in dirs.values():
+        try:
+            os.makedirs(d)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+    return dirs
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def write_json(filename, content):
+    #Write a file atomically, so that other workers never read it partially written
+    temp_name = '%s.%s.tmp' % (filename, worker_name())
+    with open(temp_name, 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    os.rename(temp_name, filename)
+
+
+def read_json(filename):
+    """Return the content of a job file, None if it has been moved by another worker.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError, e:
+        if e.errno == errno.ENOENT: return None
+        raise
+
+
+def list_jobs(directory):
+    """Names of the job files in a directory, in submission order.
+    """
+    return sorted([f for f in os.listdir(directory) if f.endswith('.json')])
+
+
+def last_alive(filename):
+    #Both the claim (rename) and the heartbeats (utime) update the status change time of the file
+    stat = os.stat(filename)
+    return max(stat.st_mtime, stat.st_ctime)
+
+
+def submit(queue, items, command, cwd, max_attempts=3):
+    """Add jobs to the queue.
+
+        Inputs:
+            queue: Directory of the queue.
+            items: List of arguments (e.g. fits files), one job each.
+            command: Shell command of the jobs, where '{}' is replaced by the argument.
+            cwd: Working directory of the jobs.
+            max_attempts: Number of times a job is run before being considered failed
+                if its workers die.
+
+        Outputs:
+            ids: List of the identifiers of the jobs.
+    """
+    dirs = queue_dirs(queue)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    ids = []
+    for i, item in enumerate(items):
+        job_id = '%s_%04d_%s' % (stamp, i, os.path.basename(item.rstrip('/')))
+        job = {'id': job_id, 'command': command.replace('{}', item), 'cwd': cwd, 'submitted': time.time(),
+               'attempts': 0, 'max_attempts': max_attempts}
+        write_json(os.path.join(dirs['pending'], job_id + '.json'), job)
+        ids.append(job_id)
+    return ids
+
+
+def claim(queue):
+    """Claim the oldest pending job.
+
+        Inputs:
+            queue: Directory of the queue.
+
+        Outputs:
+            job: Dictionary of the job, None if no job is pending.
+    """
+    dirs = queue_dirs(queue)
+    for name in list_jobs(dirs['pending']):
+        running = os.path.join(dirs['running'], name)
+        try:
+            os.rename(os.path.join(dirs['pending'], name), running)
+        except OSError, e:
+            #Claimed by another worker
+            if e.errno == errno.ENOENT: continue
+            raise
+        job = read_json(running)
+        if job is None: continue
+        job['attempts'] += 1
+        job['worker'] = worker_name()
+        job['claimed'] = time.time()
+        write_json(running, job)
+        return job
+    return None
+
+
+def requeue(queue, timeout=TIMEOUT, failed=False):
+    """Move back to pending the running jobs without heartbeat for longer than 'timeout'.
+        Jobs that reached their maximum number of attempts are moved to failed.
+
+        Inputs:
+            queue: Directory of the queue.
+            timeout: Seconds without heartbeat after which a job is considered lost.
+            failed: Also move back to pending the failed jobs, resetting their attempts.
+
+        Outputs:
+            ids: List of the identifiers of the jobs moved to pending.
+    """
+    dirs = queue_dirs(queue)
+    ids = []
+    now = time.time()
+    for name in list_jobs(dirs['running']):
+        running = os.path.join(dirs['running'], name)
+        try:
+            if now - last_alive(running) < timeout: continue
+        except OSError:
+            continue
+        job = read_json(running)
+        if job is None: continue
+        job.setdefault('lost', []).append(job.pop('worker', None))
+        job.pop('claimed', None)
+        if job['attempts'] >= job['max_attempts']: state = 'failed'
+        else: state = 'pending'
+        #Write the new state aside and move it in place of the running file, so that the job is never lost
+        temp_name = os.path.join(dirs[state], '.%s.%s.tmp' % (name, worker_name()))
+        write_json(temp_name, job)
+        try:
+            os.rename(running, temp_name + '.lost')
+        except OSError:
+            #Finished or requeued by another worker in the meantime
+            os.remove(temp_name)
+            continue
+        os.remove(temp_name + '.lost')
+        os.rename(temp_name, os.path.join(dirs[state], name))
+        print "Job %s of worker %s lost, moved to %s" % (job['id'], job['lost'][-1], state)
+        if state == 'pending': ids.append(job['id'])
+    if failed:
+        for name in list_jobs(dirs['failed']):
+            job = read_json(os.path.join(dirs['failed'], name))
+            if job is None: continue
+            job['attempts'] = 0
+            write_json(os.path.join(dirs['failed'], name), job)
+            os.rename(os.path.join(dirs['failed'], name), os.path.join(dirs['pending'], name))
+            ids.append(job['id'])
+    return ids
+
+
+def die_with_parent(signum=signal.SIGTERM):
+    """Ask the kernel to send 'signum' to the current process when its parent dies (Linux only).
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signum)
+    except (OSError, AttributeError):
+        pass
+
+
+def guard(command, cwd, log, parent):
+    """Run the command of a job and stop all its processes if the worker dies.
+        The command runs in its own process group, so that all its processes can be stopped together.
+        The guard receives SIGTERM when the worker dies, even if killed with SIGKILL, and stops the group,
+        so that a job requeued after the death of its worker is never run twice.
+        It exits with the exit code of the command (128 + signal number if the command was killed).
+    """
+    #Ctrl-C reaches the worker, which stops the guard
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    die_with_parent()
+    proc = subprocess.Popen(command, shell=True, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def stop(signum, frame):
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        proc.wait()
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, stop)
+    #The worker died before the guard asked to be notified
+    if os.getppid() != parent: stop(signal.SIGTERM, None)
+
+    proc.wait()
+    if proc.returncode < 0: sys.exit(128 - proc.returncode)
+    sys.exit(proc.returncode)
+
+
+def run_job(queue, job, heartbeat=HEARTBEAT):
+    """Run the command of a claimed job, touching its file every 'heartbeat' seconds.
+        The output of the command is written in logs/<id>.log.
+
+        Inputs:
+            queue: Directory of the queue.
+            job: Dictionary of the job returned by claim.
+            heartbeat: Seconds between the heartbeats.
+
+        Outputs:
+            returncode: Exit code of the command, None if the job was taken away from the worker.
+    """
+    dirs = queue_dirs(queue)
+    running = os.path.join(dirs['running'], job['id'] + '.json')
+    job['start'] = time.time()
+    with open(os.path.join(dirs['logs'], job['id'] + '.log'), 'a') as log:
+        log.write("# %s attempt %d on %s\n# %s\n" % (time.ctime(), job['attempts'], job['worker'], job['command']))
+        log.flush()
+        proc = mp.Process(target=guard, args=(job['command'], job['cwd'], log, os.getpid()))
+        proc.daemon = True
+        proc.start()
+
+        def stop(signum, frame):
+            #Give the job back to the queue when the worker is stopped
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.join()
+            job.pop('worker', None)
+            job['attempts'] -= 1
+            write_json(running, job)
+            os.rename(running, os.path.join(dirs['pending'], job['id'] + '.json'))
+            raise SystemExit("Worker stopped, job %s moved back to pending" % job['id'])
+        handlers = [signal.signal(signum, stop) for signum in [signal.SIGTERM, signal.SIGINT]]
+
+        try:
+            last = time.time()
+            while proc.is_alive():
+                time.sleep(min(1., heartbeat))
+                if time.time() - last < heartbeat: continue
+                try:
+                    os.utime(running, None)
+                except OSError:
+                    #Considered lost and requeued by another worker: stop the command to avoid running it twice
+                    os.kill(proc.pid, signal.SIGTERM)
+                    proc.join()
+                    print "Job %s was requeued by another worker, stopped" % job['id']
+                    return None
+                last = time.time()
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+    proc.join()
+    job['end'] = time.time()
+    job['returncode'] = proc.exitcode
+    if proc.exitcode == 0: state = 'done'
+    else: state = 'failed'
+    finished = os.path.join(dirs[state], job['id'] + '.json')
+    try:
+        os.rename(running, finished)
+    except OSError:
+        #The file now belongs to another worker, which runs the job again or moved it to failed
+        print "Job %s was requeued by another worker while finishing" % job['id']
+        return None
+    write_json(finished, job)
+    return proc.exitcode
+
+
+def work(queue, wait=False, poll=10., heartbeat=HEARTBEAT, timeout=TIMEOUT, max_jobs=None):
+    """Claim and run the jobs of the queue one at a time.
+
+        Inputs:
+            queue: Directory of the queue.
+            wait: Keep polling the queue for new jobs when it is empty.
+            poll: Seconds between the checks of an empty queue.
+            heartbeat: Seconds between the heartbeats of a running job.
+            timeout: Seconds without heartbeat after which a job is requeued.
+            max_jobs: Maximum number of jobs to run (Default: None, no limit).
+
+        Outputs:
+            njobs: Number of jobs run.
+    """
+    njobs = 0
+    while max_jobs is None or njobs < max_jobs:
+        requeue(queue, timeout=timeout)
+        job = claim(queue)
+        if job is None:
+            if not wait: break
+            time.sleep(poll)
+            continue
+        print "%s: worker %s running job %s (attempt %d)" % (time.ctime(), job['worker'], job['id'], job['attempts'])
+        returncode = run_job(queue, job, heartbeat=heartbeat)
+        print "%s: job %s finished with exit code %s" % (time.ctime(), job['id'], returncode)
+        njobs += 1
+    return njobs
+
+
+def status(queue, timeout=TIMEOUT, window=3600.):
+    """Print the number of jobs in each state, the running jobs and the throughput of the queue.
+
+        Inputs:
+            queue: Directory of the queue.
+            timeout: Seconds without heartbeat after which a running job is reported as lost.
+            window: Seconds over which the throughput is computed.
+    """
+    dirs = queue_dirs(queue)
+    jobs = {}
+    for state in STATES:
+        jobs[state] = [j for j in [read_json(os.path.join(dirs[state], name)) for name in list_jobs(dirs[state])] if j is not None]
+    print "  ".join(["%s: %d" % (state.capitalize(), len(jobs[state])) for state in STATES])
+
+    now = time.time()
+    if jobs['running']:
+        print "\n%-40s %-30s %8s %10s" % ('Running job', 'Worker', 'Attempt', 'Time (s)')
+    for job in jobs['running']:
+        try:
+            lost = now - last_alive(os.path.join(dirs['running'], job['id'] + '.json')) > timeout
+        except OSError:
+            continue
+        print "%-40s %-30s %8d %10.0f%s" % (job['id'], job.get('worker'), job['attempts'], now - job.get('claimed', now), ' (lost)' * lost)
+
+    finished = [job for job in jobs['done'] + jobs['failed'] if 'end' in job]
+    if not finished: return
+    durations = [job['end'] - job['start'] for job in finished]
+    recent = [job for job in finished if now - job['end'] < window]
+    print "\nFinished jobs: %d, mean duration %.0f s, %d in the last %.1f h (%.1f jobs/h)" % \
+        (len(finished), sum(durations) / len(durations), len(recent), window / 3600., len(recent) * 3600. / window)
+    remaining = len(jobs['pending']) + len(jobs['running'])
+    #Workers active now, or in the recent past if none is running a job at the moment
+    workers = len(set([job['worker'] for job in jobs['running'] if 'worker' in job]) or set([job['worker'] for job in recent]))
+    if remaining and workers:
+        print "Remaining jobs: %d, estimated time to complete %.1f h with %d workers" % \
+            (remaining, remaining * sum(durations) / len(durations) / workers / 3600., workers)
+
+
+def parser():
+    # Command-line options
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Queue of observation-level jobs shared by several nodes through a common directory.")
+    subparsers = parser.add_subparsers(dest='action')
+
+    parser_submit = subparsers.add_parser('submit', formatter_class=argparse.ArgumentDefaultsHelpFormatter, help="Add jobs to the queue.")
+    parser_submit.add_argument('queue', help="Directory of the queue.")
+    parser_submit.add_argument('items', help="Arguments of the jobs (e.g. fits files), one job each.", nargs='+')
+    parser_submit.add_argument('-command', help="Shell command of the jobs, '{}' is replaced by the argument.", \
+                               default="bash %s {}" % os.path.join(os.path.dirname(SCRIPT_DIR), 'FRB121102_Puppi_1.sh'))
+    parser_submit.add_argument('-cwd', help="Working directory of the jobs.", default=os.getcwd())
+    parser_submit.add_argument('-max_attempts', help="Number of times a job is run before being considered failed if its workers die.", type=int, default=3)
+
+    parser_worker = subparsers.add_parser('worker', formatter_class=argparse.ArgumentDefaultsHelpFormatter, help="Run the jobs of the queue.")
+    parser_worker.add_argument('queue', help="Directory of the queue.")
+    parser_worker.add_argument('-wait', help="Keep polling the queue for new jobs when it is empty.", action='store_true')
+    parser_worker.add_argument('-poll', help="Seconds between the checks of an empty queue.", type=float, default=10.)
+    parser_worker.add_argument('-heartbeat', help="Seconds between the heartbeats of a running job.", type=float, default=HEARTBEAT)
+    parser_worker.add_argument('-max_jobs', help="Maximum number of jobs to run.", type=int, default=None)
+
+    parser_status = subparsers.add_parser('status', formatter_class=argparse.ArgumentDefaultsHelpFormatter, help="Summary of the queue.")
+    parser_status.add_argument('queue', help="Directory of the queue.")
+    parser_status.add_argument('-window', help="Hours over which the throughput is computed.", type=float, default=1.)
+
+    parser_requeue = subparsers.add_parser('requeue', formatter_class=argparse.ArgumentDefaultsHelpFormatter, help="Move lost jobs back to pending.")
+    parser_requeue.add_argument('queue', help="Directory of the queue.")
+    parser_requeue.add_argument('-failed', help="Also move back to pending the failed jobs.", action='store_true')
+
+    for subparser in [parser_worker, parser_status, parser_requeue]:
+        subparser.add_argument('-timeout', help="Seconds without heartbeat after which a running job is considered lost.", type=float, default=TIMEOUT)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser()
+    if args.action == 'submit':
+        ids = submit(args.queue, args.items, args.command, os.path.abspath(args.cwd), max_attempts=args.max_attempts)
+        print "%d jobs submitted to %s" % (len(ids), args.queue)
+    elif args.action == 'worker':
+        njobs = work(args.queue, wait=args.wait, poll=args.poll, heartbeat=args.heartbeat, timeout=args.timeout, max_jobs=args.max_jobs)
+        print "Worker %s finished after %d jobs" % (worker_name(), njobs)
+    elif args.action == 'status':
+        status(args.queue, timeout=args.timeout, window=args.window * 3600.)
+    else:
+        ids = requeue(args.queue, timeout=args.timeout, failed=args.failed)
+        print "%d jobs moved back to pending" % len(ids)
@@ -1,18 +1,26 @@
 import os
 import argparse
 
-import numpy as np
+import dm_plan
 
 
-def out(SCRIPT_DIR, FITS_FILE, ncores, nsub=64, lodm=461.0, numdms=200, dmstep=1.0, fname='jobs.txt'):
+def job_line(script, n, calls, nsub, FITS_FILE):
+    prep = ["python {} -nsub {} -noscales -nooffsets -noweights -nobary -lodm {} -numdms {} -dmstep {} -downsamp {} -o timeseries_TOPO -zerodm {}".format(
+            script, nsub, call.lodm, call.numdms, call.dmstep, call.downsamp, FITS_FILE) for call in calls]
+    return "mkdir {}; cd {}; {}; cd ..; mv {}/* .; rm -r {}\n".format(n, n, '; '.join(prep), n, n)
+
+
+def out(SCRIPT_DIR, FITS_FILE, ncores, nsub=64, lodm=461.0, numdms=200, dmstep=1.0, fname='jobs.txt', downsamp=1, steps=None, nsamp=1):
+    """Write the prepsubband jobs to run in parallel, one line per core.
+        The DM trials are either a single range (lodm, numdms, dmstep, downsamp)
+        or the steps of a de-dispersion plan (see dm_plan.py); the prepsubband
+        calls are distributed among the cores balanced by their estimated cost.
+    """
     script = os.path.join(SCRIPT_DIR, 'prepsubband_call.py')
-    dm_core = int(np.ceil(numdms / float(ncores)))
+    if steps is None: steps = [dm_plan.PlanStep(lodm, dmstep, numdms, downsamp)]
     with open(fname, 'w') as f:
-        for n in range(ncores):
-            lodm += dm_core
-            line = "mkdir {}; cd {}; python {} -nsub {} -noscales -nooffsets -noweights -nobary -lodm {} -numdms {} -dmstep {} -o timeseries_TOPO -zerodm {}; cd ..; mv {}/* .; rm -r {}\n".format(
-                n, n, script, nsub, lodm, dm_core, dmstep, FITS_FILE, n, n)
-            f.write(line)
+        for n, job in enumerate(dm_plan.partition(steps, nsamp, ncores)):
+            f.write(job_line(script, n, job, nsub, FITS_FILE))
             
             
 def parser():
@@ -26,13 +34,19 @@ def parser():
   parser.add_argument('-lodm', help="The lowest dispersion measure to de-disperse (cm^-3 pc).", type=float, default=461.0)
   parser.add_argument('-numdms', help="The number of DMs to de-disperse.", type=int, default=200)
   parser.add_argument('-dmstep', help="The stepsize in dispersion measure to use (cm^-3 pc).", type=float, default=1.0)
+  parser.add_argument('-downsamp', help="The number of neighboring bins to co-add.", type=int, default=1)
+  parser.add_argument('-hidm', help="Highest DM. If set, the DM trials follow a de-dispersion plan from lodm to hidm computed from the fits header and -numdms, -dmstep and -downsamp are ignored.", type=float)
+  parser.add_argument('-smearing', help="Maximum ratio between the total and the unavoidable smearing of the de-dispersion plan.", type=float, default=1.1)
   parser.add_argument('-fname', help="Name of the output text file.", default='jobs.txt')
   return parser.parse_args()
   
   
 if __name__ == '__main__':
   args = parser()
-  out(args.SCRIPT_DIR, args.FITS_FILE, args.ncores, nsub=args.nsub, lodm=args.lodm, numdms=args.numdms, dmstep=args.dmstep, fname=args.fname)
-
-
-
+  if args.hidm is None:
+    out(args.SCRIPT_DIR, args.FITS_FILE, args.ncores, nsub=args.nsub, lodm=args.lodm, numdms=args.numdms, dmstep=args.dmstep, fname=args.fname, downsamp=args.downsamp)
+  else:
+    params = dm_plan.fits_parameters(args.FITS_FILE)
+    steps = dm_plan.plan(args.lodm, args.hidm, params['f_ctr'], params['bw'], params['nchan'], params['tsamp'], smearing=args.smearing, nsub=args.nsub)
+    print dm_plan.describe(steps, params['nsamp'])
+    out(args.SCRIPT_DIR, args.FITS_FILE, args.ncores, nsub=args.nsub, fname=args.fname, steps=steps, nsamp=params['nsamp'])
@@ -0,0 +1,39 @@
+import numpy as np
+
+import dm_plan
+
+
+def trials(jobs):
+    #Sorted list of (DM, downsamp) of all the calls of the jobs
+    return sorted([(round(call.lodm + n * call.dmstep, 6), call.downsamp) for job in jobs for call in job for n in range(call.numdms)])
+
+
+def test_plan_covers_the_dm_range():
+    steps = dm_plan.plan(0., 1000., 1375., 300., 4096, 1e-5, max_downsamp=32)
+    assert steps[0].lodm == 0.
+    assert steps[-1].lodm + steps[-1].numdms * steps[-1].dmstep >= 1000.
+    for previous, step in zip(steps[:-1], steps[1:]):
+        assert np.isclose(previous.lodm + previous.numdms * previous.dmstep, step.lodm)
+        assert step.downsamp > previous.downsamp
+        assert step.dmstep >= previous.dmstep
+    assert max([step.downsamp for step in steps]) <= 32
+
+
+def test_partition_of_a_single_range():
+    step = dm_plan.PlanStep(461., 1., 201, 1)
+    jobs = dm_plan.partition([step], 1, 8)
+    assert len(jobs) == 8
+    assert trials(jobs) == [(461. + n, 1) for n in range(201)]
+    numdms = [sum([call.numdms for call in job]) for job in jobs]
+    assert max(numdms) - min(numdms) <= 1
+
+
+def test_partition_is_balanced_by_cost():
+    steps = dm_plan.plan(0., 1000., 1375., 300., 4096, 1e-5)
+    nsamp = 2**20
+    for njobs in [1, 3, 8, 16]:
+        jobs = dm_plan.partition(steps, nsamp, njobs)
+        assert trials(jobs) == sorted([(round(s.lodm + n * s.dmstep, 6), s.downsamp) for s in steps for n in range(s.numdms)])
+        loads = [sum([call.cost for call in job]) for job in jobs]
+        assert max(loads) * len(loads) / sum(loads) < 1.1
+        assert all([call.numdms <= 1000 for job in jobs for call in job])
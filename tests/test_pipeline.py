@@ -0,0 +1,136 @@
+import argparse
+import os
+import stat
+
+import pipeline
+import prepsubband_call
+
+
+def test_tasks_run_after_their_dependencies(tmpdir):
+    out = str(tmpdir.join('order.txt'))
+    p = pipeline.Pipeline(ncpus=4)
+    first = p.add('first', 'sleep 0.2; echo first >> %s' % out, 'stage')
+    second = p.add('second', 'echo second >> %s' % out, 'stage', deps=[first])
+    p.add('third', 'echo third >> %s' % out, 'stage', deps=[second])
+    assert p.run() == []
+    with open(out) as f:
+        assert f.read().split() == ['first', 'second', 'third']
+
+
+def test_tasks_depending_on_a_failed_task_are_skipped():
+    p = pipeline.Pipeline(ncpus=2)
+    bad = p.add('bad', 'exit 3', 'stage')
+    after = p.add('after', 'true', 'stage', deps=[bad])
+    later = p.add('later', 'true', 'stage', deps=[after])
+    other = p.add('other', 'true', 'stage')
+    assert p.run() == ['bad']
+    assert bad.returncode == 3
+    assert after.status == 'skipped'
+    assert later.status == 'skipped'
+    assert other.status == 'done'
+
+
+def test_unknown_dependency_is_rejected():
+    p = pipeline.Pipeline()
+    task = pipeline.Task('orphan', 'true', 'stage')
+    try:
+        p.add('child', 'true', 'stage', deps=[task])
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError not raised"
+
+
+def test_prepsubband_call_returns_the_exit_code(tmpdir, monkeypatch):
+    #Fake prepsubband failing with exit code 2
+    fake = tmpdir.join('prepsubband')
+    fake.write('#!/bin/sh\nexit 2\n')
+    os.chmod(str(fake), stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+    args = argparse.Namespace(fits='obs.fits', o='obs_TOPO', zerodm=True, dmstep=1., numout=1000, numdms=10, lodm=500.,
+                              nobary=True, noweights=True, nooffsets=True, noscales=True, nsub=64, downsamp=None)
+    assert prepsubband_call.prepsubband(args) == 2
+
+
+def resumable_pipeline(folder, state_file, parameter='1'):
+    #Two stages writing a file each, the second one from the output of the first one
+    p = pipeline.Pipeline(ncpus=2, state_file=state_file)
+    first = p.add('first', 'echo %s > a.txt' % parameter, 'first', cwd=folder, inputs=['params.txt'], outputs=['a.txt'])
+    second = p.add('second', 'cat a.txt > b.txt; echo run >> runs.txt', 'second', deps=[first], cwd=folder, outputs=['b.txt'])
+    return p, first, second
+
+
+def test_completed_tasks_are_skipped_in_the_next_run(tmpdir):
+    folder, state = str(tmpdir), str(tmpdir.join('state.json'))
+    tmpdir.join('params.txt').write('x')
+    p, first, second = resumable_pipeline(folder, state)
+    assert p.run() == []
+    assert not first.cached and not second.cached
+
+    p, first, second = resumable_pipeline(folder, state)
+    assert p.run() == []
+    assert first.cached and second.cached
+    assert tmpdir.join('runs.txt').read().split() == ['run']
+
+
+def test_changed_inputs_and_outputs_are_computed_again(tmpdir):
+    folder, state = str(tmpdir), str(tmpdir.join('state.json'))
+    tmpdir.join('params.txt').write('x')
+    resumable_pipeline(folder, state)[0].run()
+
+    #A modified input invalidates the task and the ones depending on it
+    tmpdir.join('params.txt').write('y')
+    p, first, second = resumable_pipeline(folder, state)
+    p.run()
+    assert not first.cached and not second.cached
+
+    #A deleted output only invalidates its task
+    tmpdir.join('b.txt').remove()
+    p, first, second = resumable_pipeline(folder, state)
+    p.run()
+    assert first.cached and not second.cached
+    assert tmpdir.join('b.txt').check()
+
+    #A changed command
+    p, first, second = resumable_pipeline(folder, state, parameter='2')
+    p.run()
+    assert not first.cached and not second.cached
+    assert tmpdir.join('b.txt').read().strip() == '2'
+
+
+def test_failed_and_output_less_tasks_are_not_cached(tmpdir):
+    state = str(tmpdir.join('state.json'))
+    for n in range(2):
+        p = pipeline.Pipeline(state_file=state)
+        no_outputs = p.add('no_outputs', 'true', 'stage')
+        bad = p.add('bad', 'exit 1', 'stage', cwd=str(tmpdir), outputs=['state.json'])
+        p.run()
+        assert not no_outputs.cached and no_outputs.status == 'done'
+        assert not bad.cached and bad.status == 'failed'
+
+
+def test_memory_shares_admit_ncpus_tasks_of_unknown_footprint(tmpdir):
+    #Each task waits until all of them are running, and fails if they are not admitted together
+    wait = 'touch %d; for i in $(seq 50); do [ $(ls | wc -l) -ge 6 ] && exit 0; sleep 0.1; done; exit 1'
+    for memory in [7000., 100.]:
+        folder = tmpdir.mkdir(str(int(memory)))
+        p = pipeline.Pipeline(ncpus=6, memory=memory)
+        for n in range(6):
+            p.add('task%d' % n, wait % n, 'stage', cwd=str(folder))
+        assert p.run() == []
+
+
+def test_tasks_are_not_admitted_beyond_the_memory():
+    p = pipeline.Pipeline(ncpus=6, memory=7000.)
+    hog = p.add('hog', 'true', 'stage', memory=5000.)
+    small = p.add('small', 'true', 'stage', memory=1000.)
+    unknown = p.add('unknown', 'true', 'other')
+    hog.footprint = p.footprint(hog)
+    running = {1: (hog, None)}
+    assert p._admit(small, running)
+    assert not p._admit(hog, running)
+    #Fair share of 7000 / 6 MB
+    assert p._admit(unknown, running)
+    small.footprint = p.footprint(small)
+    running[2] = (small, None)
+    assert not p._admit(unknown, running)
@@ -0,0 +1,48 @@
+import numpy as np
+
+import sp_search
+import spectra
+
+
+class FakeRawdata(object):
+    #In-memory stand-in of psrfits.PsrfitsFile, with the attributes used by stream_dedisperse
+    class specinfo(object):
+        pass
+
+    def __init__(self, data, freqs, tsamp, nsamp_per_subint=100):
+        self.data = data
+        self.freqs = freqs
+        self.tsamp = tsamp
+        self.nchan = data.shape[0]
+        self.nsamp_per_subint = nsamp_per_subint
+        self.specinfo = FakeRawdata.specinfo()
+        self.specinfo.N = data.shape[1]
+
+    def get_spectra(self, startsamp, N):
+        return spectra.Spectra(self.freqs, self.tsamp, self.data[:, startsamp:startsamp+N].copy(),
+                               starttime=startsamp * self.tsamp)
+
+
+def test_stream_search_of_single_bins_keeps_a_bounded_tail(monkeypatch):
+    rng = np.random.RandomState(0)
+    nsamp = 20000
+    data = rng.normal(size=(8, nsamp))
+    pulses = [1234, 5000, 9999, 10000 + 777, 18888]
+    data[:, pulses] += 8.
+    rawdata = FakeRawdata(data, np.linspace(1500., 1400., 8), 1e-3)
+
+    sizes = []
+    boxcar_search = sp_search.boxcar_search
+    def recorded_search(timeseries, **kwargs):
+        sizes.append(timeseries.size)
+        return boxcar_search(timeseries, **kwargs)
+    monkeypatch.setattr(sp_search, 'boxcar_search', recorded_search)
+
+    chunk = sp_search.search_stream(rawdata, [0.], nsub=8, threshold=10., max_downfact=1, chunk_nsamp=2000)
+    #Series of a chunk, without any sample carried from the previous ones
+    assert max(sizes) <= 2000
+
+    whole = sp_search.search_stream(rawdata, [0.], nsub=8, threshold=10., max_downfact=1, chunk_nsamp=nsamp)
+    assert sorted(chunk['Sample']) == sorted(whole['Sample'])
+    assert set(pulses) <= set(chunk['Sample'])
+    assert np.all(chunk['Downfact'] == 1)
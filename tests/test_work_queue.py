@@ -0,0 +1,84 @@
+import errno
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import work_queue
+
+
+def job_file(queue, state, job_id):
+    return os.path.join(str(queue), state, job_id + '.json')
+
+
+def test_jobs_are_claimed_once_in_submission_order(tmpdir):
+    ids = work_queue.submit(str(tmpdir), ['a.fits', 'b.fits'], 'echo {}', str(tmpdir))
+    first = work_queue.claim(str(tmpdir))
+    second = work_queue.claim(str(tmpdir))
+    assert [first['id'], second['id']] == ids
+    assert first['command'] == 'echo a.fits'
+    assert first['attempts'] == 1
+    assert work_queue.claim(str(tmpdir)) is None
+    assert os.path.exists(job_file(tmpdir, 'running', ids[0]))
+
+
+def test_lost_jobs_are_requeued_until_their_maximum_attempts(tmpdir):
+    job_id, = work_queue.submit(str(tmpdir), ['a.fits'], 'echo {}', str(tmpdir), max_attempts=2)
+    for attempt in range(2):
+        job = work_queue.claim(str(tmpdir))
+        assert job['attempts'] == attempt + 1
+        #Recent heartbeat: the job is still running
+        assert work_queue.requeue(str(tmpdir)) == []
+        ids = work_queue.requeue(str(tmpdir), timeout=-1)
+    assert ids == []
+    job = work_queue.read_json(job_file(tmpdir, 'failed', job_id))
+    assert len(job['lost']) == 2
+    assert work_queue.requeue(str(tmpdir), failed=True) == [job_id]
+    assert work_queue.claim(str(tmpdir))['attempts'] == 1
+
+
+def test_finished_jobs_are_moved_to_done_or_failed(tmpdir):
+    ok, bad = work_queue.submit(str(tmpdir), ['0', '3'], 'exit {}', str(tmpdir))
+    assert work_queue.run_job(str(tmpdir), work_queue.claim(str(tmpdir))) == 0
+    assert work_queue.run_job(str(tmpdir), work_queue.claim(str(tmpdir))) == 3
+    assert work_queue.read_json(job_file(tmpdir, 'done', ok))['returncode'] == 0
+    assert work_queue.read_json(job_file(tmpdir, 'failed', bad))['returncode'] == 3
+    assert os.listdir(os.path.join(str(tmpdir), 'running')) == []
+
+
+def test_job_requeued_while_finishing_is_not_duplicated(tmpdir):
+    #The command moves its own file back to pending, as another worker requeueing it would do
+    job_id, = work_queue.submit(str(tmpdir), ['a'], 'true', str(tmpdir))
+    job = work_queue.claim(str(tmpdir))
+    job['command'] = 'mv running/%s.json pending/' % job_id
+    assert work_queue.run_job(str(tmpdir), job) is None
+    assert os.listdir(os.path.join(str(tmpdir), 'done')) == []
+    assert os.path.exists(job_file(tmpdir, 'pending', job_id))
+
+
+def test_command_is_stopped_when_the_worker_is_killed(tmpdir):
+    pid_file = str(tmpdir.join('pid'))
+    work_queue.submit(str(tmpdir.join('queue')), ['30'], 'echo $$ > %s; sleep {}' % pid_file, str(tmpdir))
+    worker = subprocess.Popen([sys.executable, work_queue.__file__.replace('.pyc', '.py'), 'worker', str(tmpdir.join('queue'))])
+    try:
+        for i in range(100):
+            if os.path.exists(pid_file) and os.path.getsize(pid_file): break
+            time.sleep(0.1)
+        with open(pid_file) as f:
+            pgid = int(f.read())
+    finally:
+        worker.kill()
+        worker.wait()
+
+    #The shell of the command leads the process group of the job
+    for i in range(100):
+        try:
+            os.killpg(pgid, 0)
+        except OSError, e:
+            assert e.errno == errno.ESRCH
+            break
+        time.sleep(0.1)
+    else:
+        os.killpg(pgid, signal.SIGKILL)
+        assert False, "Command still running after the death of its worker"